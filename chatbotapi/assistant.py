@@ -2,8 +2,12 @@ import google.generativeai as genai
 import os
 import json
 import re
+import time
 from typing import List, Dict
 
+from nutrient_schema import RESPONSE_NUTRIENT_KEYS
+from response_formatter import prettify_text, render_json
+
 class ChatbotAssistant:
     def __init__(self, api_key: str):
         if not api_key:
@@ -162,95 +166,19 @@ Hãy trả lời thân thiện, hữu ích và chính xác!"""
             text = response.text.strip()
 
             # Thử parse JSON nếu model trả về JSON để render đẹp hơn
-            import json
             try:
                 parsed = json.loads(text)
-                # Build a pretty Vietnamese text from parsed fields
-                parts = []
                 if isinstance(parsed, dict):
-                    if parsed.get('title'):
-                        parts.append(parsed.get('title').strip())
-                        parts.append('')
-                    if parsed.get('summary'):
-                        parts.append(parsed.get('summary').strip())
-                        parts.append('')
-                    if parsed.get('bullets') and isinstance(parsed.get('bullets'), list):
-                        # join bullets into a sentence paragraph
-                        bullets = [b.strip().rstrip('.') for b in parsed.get('bullets') if b]
-                        if bullets:
-                            parts.append('Bạn nên: ' + ', '.join(bullets) + '.')
-                            parts.append('')
-                    if parsed.get('meals') and isinstance(parsed.get('meals'), list):
-                        parts.append('\n'.join([m.strip() for m in parsed.get('meals') if m]))
-                        parts.append('')
-                    if parsed.get('notes'):
-                        parts.append('Ghi chú: ' + parsed.get('notes').strip())
-
-                    pretty = '\n'.join([p for p in parts if p is not None and p != ''])
-                    return pretty
+                    return render_json(parsed)
             except Exception:
                 # Nếu không parse được JSON, fallback: prettify raw text (loại bỏ markdown/list markers)
-                return self._prettify_text(text)
+                return prettify_text(text)
             
         except Exception as e:
             error_msg = f"Lỗi khi lấy phản hồi từ Gemini: {str(e)}"
             print(error_msg)
             raise ValueError(error_msg)
 
-    def _prettify_text(self, raw: str) -> str:
-        """Cố gắng chuyển các bullet/markdown thành đoạn văn tiếng Việt đẹp hơn.
-
-        Heuristics:
-        - Loại bỏ ký hiệu **, *, +, -, •, ✅, ❌
-        - Tách các dòng rỗng thành đoạn
-        - Gom các dòng bullet thành câu liệt kê phân cách bằng dấu phẩy
-        - Giữ các câu có ngắt dòng hợp lý
-        """
-        import re
-
-        if not raw or not raw.strip():
-            return raw
-
-        s = raw
-        # Remove bold/markdown markers
-        s = s.replace('**', '')
-        s = s.replace('`', '')
-        # Remove common icons
-        s = re.sub(r'[•*+\-✅❌]', '', s)
-
-        # Normalize Windows newlines and trim spaces on lines
-        lines = [ln.strip() for ln in re.split(r'[\r\n]+', s) if ln.strip()]
-        if not lines:
-            return s.strip()
-
-        paragraphs = []
-        i = 0
-        while i < len(lines):
-            line = lines[i]
-            # If line ends with ':' treat following lines as list -> join with commas
-            if line.endswith(':') or re.search(r'^(Nên|Ưu|Hạn chế|Gợi ý|Gợi ý bữa|Bạn nên|Nên hạn chế)', line, re.I):
-                header = line.rstrip(':').strip()
-                items = []
-                j = i + 1
-                while j < len(lines) and not lines[j].endswith(':'):
-                    items.append(lines[j].strip())
-                    j += 1
-                if items:
-                    # clean items remove leading bullets symbols again
-                    clean_items = [re.sub(r'^[\-\*\u2022\+\s]+', '', it).strip().rstrip('.') for it in items]
-                    para = header + ': ' + ', '.join(clean_items) + '.'
-                    paragraphs.append(para)
-                    i = j
-                    continue
-            # Default: treat as normal paragraph
-            paragraphs.append(line)
-            i += 1
-
-        pretty = '\n\n'.join(paragraphs)
-        # final cleanup: collapse multiple spaces
-        pretty = re.sub(r'\s{2,}', ' ', pretty)
-        return pretty.strip()
-
     async def analyze_food_image(self, image_bytes: bytes) -> dict:
         """
         Phân tích hình ảnh thức ăn/đồ uống bằng Gemini Vision
@@ -281,10 +209,14 @@ Hãy trả lời thân thiện, hữu ích và chính xác!"""
             # Ensure model is ready
             self._ensure_model_ready()
             
-            # Load image
-            from PIL import Image
-            import io
-            image = Image.open(io.BytesIO(image_bytes))
+            # Load image: decode ở tỉ lệ giảm, xoay theo EXIF, bỏ EXIF, thu nhỏ trước khi gửi Vision
+            from image_preprocess import preprocess_image
+            preprocessed = preprocess_image(image_bytes)
+            # Gửi thẳng JPEG đã re-encode (SDK không phải encode lại PIL image)
+            image = {"mime_type": "image/jpeg", "data": preprocessed.jpeg_bytes}
+            print(f"🖼️  Vision input: {len(image_bytes)} → {len(preprocessed.jpeg_bytes)} bytes "
+                  f"({preprocessed.original_width}x{preprocessed.original_height} → "
+                  f"{preprocessed.width}x{preprocessed.height})")
             
             # Prompt for Gemini Vision
             vision_prompt = """Bạn là chuyên gia phân tích dinh dưỡng. Hãy phân tích hình ảnh này và trả về JSON theo format sau:
@@ -379,8 +311,11 @@ Hãy trả lời thân thiện, hữu ích và chính xác!"""
 
 Hãy phân tích chính xác và trả về JSON thuần (không markdown)."""
             
-            # Send image to Gemini Vision
+            # Send image to Gemini Vision (ghi lại độ trễ thật để replay ở chế độ mock)
+            from latency_model import record_latency
+            vision_start = time.perf_counter()
             response = self.model.generate_content([vision_prompt, image])
+            record_latency(time.perf_counter() - vision_start)
             
             if not response.text:
                 raise ValueError("Không nhận được phản hồi từ Gemini Vision")
@@ -402,21 +337,8 @@ Hãy phân tích chính xác và trả về JSON thuần (không markdown)."""
                 if "nutrients" not in item:
                     item["nutrients"] = {}
                 
-                # Ensure all 76 nutrients exist
-                nutrient_keys = [
-                    "enerc_kcal", "procnt", "fat", "chocdf",
-                    "fibtg", "fib_sol", "fib_insol", "fib_rs", "fib_bglu",
-                    "cholesterol",
-                    "vita", "vitd", "vite", "vitk", "vitc",
-                    "vitb1", "vitb2", "vitb3", "vitb5", "vitb6", "vitb7", "vitb9", "vitb12",
-                    "ca", "p", "mg", "k", "na", "fe", "zn", "cu", "mn", "i", "se", "cr", "mo", "f",
-                    "fams", "fapu", "fasat", "fatrn", "faepa", "fadha", "faepa_dha", "fa18_2n6c", "fa18_3n3",
-                    "amino_his", "amino_ile", "amino_leu", "amino_lys", "amino_met",
-                    "amino_phe", "amino_thr", "amino_trp", "amino_val",
-                    "ala", "epa_dha", "la"
-                ]
-                
-                for key in nutrient_keys:
+                # Ensure all schema response nutrients exist
+                for key in RESPONSE_NUTRIENT_KEYS:
                     if key not in item["nutrients"]:
                         item["nutrients"][key] = 0
             
@@ -1,11 +1,21 @@
 import os
 import json
-import re
 import base64
-from typing import List, Dict
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Dict
 import httpx
 import google.generativeai as genai
 from cache_manager import get_cache_instance
+from circuit_breaker import CircuitOpenError, CircuitPermit, create_circuit_breaker_registry
+from gemini_models import create_model_registry, is_model_not_found_error
+from metrics import LLM_IN_FLIGHT, record_llm_call, record_llm_tokens, stage_timer
+from prompt_builder import AssembledPrompt, create_prompt_assembler
+from response_cache import get_response_cache_instance
+from response_formatter import StreamFormatter, format_response
+from tracing import SPAN_KIND_CLIENT, bind_context, current_span, span, start_span
 
 class ChatbotAssistant:
     def __init__(self, gemini_api_key: str = None, openrouter_api_key: str = None):
@@ -28,6 +38,43 @@ class ChatbotAssistant:
         
         # Gemini Direct API setup (lazy-load)
         self.gemini_model = None
+        # Circuit breaker theo provider ("gemini", "openrouter") và theo model ("gemini:<model>")
+        self.circuit_breakers = create_circuit_breaker_registry()
+        # Hedge: Gemini chưa trả lời sau p95 độ trễ gần đây → gọi song song OpenRouter
+        self.hedge_enabled = os.getenv("CHAT_HEDGE_ENABLED", "1") == "1"
+        self.hedge_percentile = float(os.getenv("CHAT_HEDGE_PERCENTILE", "95"))
+        self.hedge_min_samples = int(os.getenv("CHAT_HEDGE_MIN_SAMPLES", "20"))
+        # Dùng khi chưa đủ mẫu độ trễ (0 = không hedge cho tới khi đủ mẫu)
+        self.hedge_default_delay = float(os.getenv("CHAT_HEDGE_DEFAULT_DELAY", "10"))
+        self.hedge_min_delay = float(os.getenv("CHAT_HEDGE_MIN_DELAY", "1"))
+        self.hedge_max_delay = float(os.getenv("CHAT_HEDGE_MAX_DELAY", "20"))
+        # SDK Gemini là synchronous → chạy trên thread pool riêng để không block event loop
+        # GEMINI_MAX_CONCURRENCY giới hạn số Gemini call chạy song song
+        self.gemini_max_concurrency = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+        self.gemini_executor = ThreadPoolExecutor(
+            max_workers=self.gemini_max_concurrency,
+            thread_name_prefix="gemini"
+        )
+        
+        # OpenRouter: một httpx.AsyncClient dùng chung (keep-alive, HTTP/2, connection pool)
+        # Tạo ở FastAPI startup (astart), đóng ở shutdown (aclose)
+        self.openrouter_client = None
+        self.openrouter_http2 = os.getenv("OPENROUTER_HTTP2", "1") == "1"
+        self.openrouter_limits = httpx.Limits(
+            max_connections=int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.getenv("OPENROUTER_MAX_KEEPALIVE", "10")),
+            keepalive_expiry=float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", "30"))
+        )
+        self.openrouter_timeout = httpx.Timeout(
+            connect=float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5")),
+            read=float(os.getenv("OPENROUTER_READ_TIMEOUT", "45")),
+            write=float(os.getenv("OPENROUTER_WRITE_TIMEOUT", "10")),
+            pool=float(os.getenv("OPENROUTER_POOL_TIMEOUT", "5"))
+        )
+        self.openrouter_total_timeout = float(os.getenv("OPENROUTER_TOTAL_TIMEOUT", "60"))
+        
+        # Cache câu trả lời cho các câu hỏi lặp lại (exact + near-duplicate)
+        self.response_cache = get_response_cache_instance()
         if gemini_api_key:
             try:
                 genai.configure(api_key=gemini_api_key)
@@ -47,6 +94,10 @@ NGUYÊN TẮC:
 - Nếu không chắc → khuyên tham khảo chuyên gia
 
 ĐỊNH DẠNG: Trả về văn bản thuần tiếng Việt, không markdown, không ký tự biểu tượng. Ưu tiên JSON nếu có thể, nếu không thì plain text."""
+        # History chọn theo ngân sách token (thay vì cố định 10 message), lượt cũ nén thành summary
+        self.prompt_assembler = create_prompt_assembler(self.system_prompt)
+        # System prompt gửi qua system_instruction / context cache của Gemini (xem gemini_models)
+        self.model_registry = create_model_registry(self.system_prompt)
         
         print(f"✅ ChatbotAssistant initialized with fallback chain")
         if self.gemini_api_key:
@@ -63,222 +114,603 @@ NGUYÊN TẮC:
         if not question.strip():
             raise ValueError("Câu hỏi không được để trống")
 
-        # Build messages array (tối ưu: chỉ lấy 5-10 messages gần nhất để giảm token)
-        messages = [{"role": "system", "content": self.system_prompt}]
+        with span("chat.get_response", **{"chat.history_messages": len(history or ())}) as chat_span:
+            with stage_timer("chat_cache_lookup"):
+                cached_answer = self.response_cache.get(question, history)
+            chat_span.set_attribute("chat.cached", cached_answer is not None)
+            if cached_answer is not None:
+                print("✅ Chat response served from cache")
+                return cached_answer
 
-        # Limit history to last 10 messages to save tokens
-        if history:
-            limited_history = history[-10:] if len(history) > 10 else history
-            for msg in limited_history:
-                role = msg.get("role", "")
-                content = msg.get("content", "")
-                if role and content and role in ["user", "assistant"]:
-                    messages.append({"role": role, "content": content})
+            answer = await self._get_provider_response(question, history)
+            with stage_timer("chat_cache_store"):
+                self.response_cache.set(question, history, answer)
+            return answer
 
-        messages.append({"role": "user", "content": question})
+    async def _get_provider_response(self, question: str, history: List[Dict[str, str]] = None) -> str:
+        """
+        Gọi LLM providers theo fallback chain (không qua cache)
+        - Provider/model đang open-circuit bị bỏ qua ngay, không chờ lỗi
+        - Hedge: Gemini chậm hơn p95 của chính model đó → gọi song song OpenRouter,
+          lấy kết quả nào về trước
+        """
+        prompt = self._assemble_prompt(question, history)
+        last_error = None
+        # OpenRouter chỉ được gọi một lần mỗi request (hedge hoặc fallback)
+        openrouter_tried = False
+        tasks = []
+
+        try:
+            # Try 1: Gemini Direct (Primary)
+            if self.gemini_api_key:
+                gemini_failed = False
+                for model_name in await self._gemini_candidates():
+                    tasks = [asyncio.ensure_future(self._call_gemini(model_name, prompt))]
+                    hedge_delay = None if openrouter_tried else self._hedge_delay(model_name)
+                    if hedge_delay is not None:
+                        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                        if not done:
+                            print(f"⏱️  Gemini ({model_name}) slower than {hedge_delay:.1f}s → hedging with OpenRouter")
+                            current_span().add_event("hedge", **{
+                                "gen_ai.request.model": model_name, "hedge.delay_seconds": hedge_delay
+                            })
+                            openrouter_tried = True
+                            tasks.append(asyncio.ensure_future(self._call_openrouter(prompt.messages)))
+
+                    text, error = await self._first_success(tasks)
+                    if text is not None:
+                        with stage_timer("prettify"):
+                            return format_response(text)
+                    last_error = error
+                    gemini_failed = True
+
+                # All Gemini models failed
+                if gemini_failed:
+                    print(f"❌ All Gemini models failed. Last error: {last_error}")
+
+            # Try 2: OpenRouter (Fallback)
+            if self.openrouter_api_key and not openrouter_tried:
+                tasks = [asyncio.ensure_future(self._call_openrouter(prompt.messages))]
+                text, error = await self._first_success(tasks)
+                if text is not None:
+                    with stage_timer("prettify"):
+                        return format_response(text)
+                last_error = error
+        finally:
+            # Client ngắt kết nối / request bị huỷ → không để task mồ côi
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        # All providers failed
+        raise ValueError(f"Tất cả providers đều thất bại. Lỗi cuối: {last_error}")
 
-        # Fallback chain: Gemini → OpenRouter
+    async def _gemini_candidates(self) -> List[str]:
+        """Danh sách Gemini model theo thứ tự thử, bỏ các model (hoặc cả provider) đang open-circuit"""
+        if not self.circuit_breakers.is_available("gemini"):
+            print("⏭️  Gemini Direct circuit open → skip")
+            current_span().add_event("circuit_open", provider="gemini")
+            return []
+        with span("chat.gemini_candidates") as candidates_span:
+            # Lần đầu (danh sách chưa resolve) sẽ gọi genai.list_models() → span con gemini.list_models
+            models = await self._run_in_gemini_executor(self.model_registry.candidates)
+            available = [m for m in models if self.circuit_breakers.is_available(f"gemini:{m}")]
+            candidates_span.set_attribute("gemini.candidates", len(available))
+            candidates_span.set_attribute("gemini.skipped_open_circuit", len(models) - len(available))
+        if len(available) < len(models):
+            print(f"⏭️  Skipping {len(models) - len(available)} Gemini model(s) with open circuit")
+        return available
+
+    def _hedge_delay(self, model_name: str):
+        """
+        Sau bao lâu thì hedge sang OpenRouter (None = không hedge)
+        Dùng p95 độ trễ gần đây của model; chưa đủ mẫu thì dùng CHAT_HEDGE_DEFAULT_DELAY
+        """
+        if not self.hedge_enabled or not self.openrouter_api_key:
+            return None
+        if not self.circuit_breakers.is_available("openrouter", f"openrouter:{self.openrouter_model}"):
+            return None
+        delay = self.circuit_breakers.get(f"gemini:{model_name}").latency_percentile(
+            self.hedge_percentile, self.hedge_min_samples
+        )
+        if delay is None:
+            delay = self.hedge_default_delay
+            if delay <= 0:
+                return None
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    async def _first_success(self, tasks: list):
+        """
+        Chờ task đầu tiên trả về text, huỷ các task còn lại
+
+        Returns:
+            (text, None) nếu có task thành công, (None, lỗi cuối) nếu tất cả lỗi
+        """
+        pending = set(tasks)
         last_error = None
-        
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                error = task.exception()
+                if error is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result(), None
+                # asyncio.TimeoutError (total budget) không có message
+                last_error = str(error) or type(error).__name__
+        return None, last_error
+
+    async def _call_gemini(self, model_name: str, prompt: AssembledPrompt) -> str:
+        """Một lần gọi Gemini (qua circuit breaker của provider và của model)"""
+        permit = self.circuit_breakers.acquire("gemini", f"gemini:{model_name}")
+        if permit is None:
+            record_llm_call("gemini", model_name, "circuit_open")
+            current_span().add_event("circuit_open", provider="gemini", **{"gen_ai.request.model": model_name})
+            raise CircuitOpenError(f"Gemini Direct ({model_name}) circuit open")
+
+        print(f"🔄 Trying Gemini Direct (Primary) with {model_name}...")
+        # Span kết thúc trong done-callback (thread SDK có thể chạy lâu hơn request nếu thua hedge)
+        llm_span = start_span("llm.gemini", SPAN_KIND_CLIENT, **{
+            "gen_ai.system": "gemini", "gen_ai.request.model": model_name, "llm.probe": any(permit.probes)
+        })
+        in_flight = LLM_IN_FLIGHT.labels("gemini")
+        in_flight.inc()
+        try:
+            # Reuse model instance đã khởi tạo từ registry
+            test_model = self.model_registry.get_model(model_name)
+            # generate_content chạy trên executor, event loop vẫn phục vụ request khác
+            future = asyncio.get_running_loop().run_in_executor(
+                self.gemini_executor, self._generate_gemini_text, test_model, self._gemini_prompt_text(prompt)
+            )
+        except Exception as e:
+            in_flight.dec()
+            permit.failure()
+            record_llm_call("gemini", model_name, "error", permit.elapsed())
+            llm_span.end(e)
+            raise
+        # Thread của SDK không huỷ được: kết quả (và độ trễ) được ghi khi thread xong,
+        # kể cả khi request đã lấy câu trả lời từ OpenRouter (hedge) → p95 không bị lệch
+        future.add_done_callback(functools.partial(self._record_gemini_outcome, permit, model_name, llm_span))
+
+        try:
+            text, _, _ = await asyncio.shield(future)
+            if not text:
+                raise ValueError("Empty response from Gemini")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error_msg = str(e)
+            # Check if it's an API not enabled error
+            if "API key not valid" in error_msg or "not enabled" in error_msg.lower():
+                print(f"❌ Gemini API error: {error_msg}")
+                print("💡 HINT: Make sure Gemini API is enabled in Google Cloud Console")
+                print("   Visit: https://makersuite.google.com/app/apikey")
+            elif is_model_not_found_error(e):
+                print(f"❌ Model {model_name} not found: {error_msg[:100]}")
+            else:
+                print(f"❌ Gemini Direct failed with {model_name}: {error_msg[:200]}")
+            raise ValueError(f"Gemini Direct: {error_msg}") from e
+
+        print(f"✅ Success with Gemini Direct ({model_name})")
+        # Save working model for next time
+        self.gemini_model = test_model
+        self.gemini_model_name = model_name
+        self.model_registry.mark_success(model_name)
+        return text
+
+    def _record_gemini_outcome(self, permit: CircuitPermit, model_name: str, llm_span, future):
+        """Done-callback của Gemini call (chạy trên event loop): ghi circuit breaker, metrics và kết thúc span"""
+        LLM_IN_FLIGHT.labels("gemini").dec()
+        elapsed = permit.elapsed()
+        if future.cancelled():
+            permit.release()
+            record_llm_call("gemini", model_name, "cancelled")
+            llm_span.set_attribute("llm.outcome", "cancelled")
+            llm_span.end()
+            return
+        error = future.exception()
+        if error is None:
+            text, prompt_tokens, completion_tokens = future.result()
+            record_llm_tokens("gemini", model_name, prompt_tokens, completion_tokens)
+            llm_span.set_attribute("gen_ai.usage.input_tokens", prompt_tokens)
+            llm_span.set_attribute("gen_ai.usage.output_tokens", completion_tokens)
+            if text:
+                permit.success()
+                record_llm_call("gemini", model_name, "success", elapsed)
+                llm_span.set_attribute("llm.outcome", "success")
+                llm_span.end()
+            else:
+                permit.failure()
+                record_llm_call("gemini", model_name, "error", elapsed)
+                llm_span.set_attribute("llm.outcome", "error")
+                llm_span.end(ValueError("Empty response from Gemini"))
+        elif is_model_not_found_error(error):
+            # 404 không phải lỗi tạm thời: negative-cache ở registry, không tính vào circuit
+            permit.release()
+            self.model_registry.mark_not_found(model_name)
+            record_llm_call("gemini", model_name, "not_found")
+            llm_span.set_attribute("llm.outcome", "not_found")
+            llm_span.end(error)
+        else:
+            permit.failure()
+            record_llm_call("gemini", model_name, "error", elapsed)
+            llm_span.set_attribute("llm.outcome", "error")
+            llm_span.end(error)
+
+    async def _call_openrouter(self, messages: List[Dict[str, str]]) -> str:
+        """Một lần gọi OpenRouter (qua circuit breaker)"""
+        permit = self.circuit_breakers.acquire("openrouter", f"openrouter:{self.openrouter_model}")
+        if permit is None:
+            print("⏭️  OpenRouter circuit open → skip")
+            record_llm_call("openrouter", self.openrouter_model, "circuit_open")
+            current_span().add_event("circuit_open", provider="openrouter")
+            raise CircuitOpenError("OpenRouter circuit open")
+
+        llm_span = start_span("llm.openrouter", SPAN_KIND_CLIENT, **{
+            "gen_ai.system": "openrouter",
+            "gen_ai.request.model": self.openrouter_model,
+            "llm.probe": any(permit.probes)
+        })
+        in_flight = LLM_IN_FLIGHT.labels("openrouter")
+        in_flight.inc()
+        try:
+            print("🔄 Falling back to OpenRouter...")
+            client = self._get_openrouter_client()
+            # connect/read timeout do client lo, tổng thời gian bị chặn bởi total budget
+            response = await asyncio.wait_for(
+                client.post(
+                    "/chat/completions",
+                    json={"model": self.openrouter_model, "messages": messages}
+                ),
+                timeout=self.openrouter_total_timeout
+            )
+
+            if response.status_code != 200:
+                # Rate limit or error
+                if response.status_code == 429:
+                    raise ValueError(f"OpenRouter rate limited: {response.text}")
+                raise ValueError(f"OpenRouter error {response.status_code}: {response.text}")
+
+            result = response.json()
+            usage = result.get("usage") or {}
+            self.prompt_assembler.estimator.observe_messages(messages, usage.get("prompt_tokens"))
+            record_llm_tokens("openrouter", self.openrouter_model, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+            llm_span.set_attribute("gen_ai.usage.input_tokens", usage.get("prompt_tokens"))
+            llm_span.set_attribute("gen_ai.usage.output_tokens", usage.get("completion_tokens"))
+            text = ""
+            if "choices" in result and len(result["choices"]) > 0:
+                text = result["choices"][0]["message"]["content"].strip()
+            if not text:
+                raise ValueError("Empty response from OpenRouter")
+        except asyncio.CancelledError:
+            # Thua hedge / client ngắt kết nối: không tính là lỗi của provider
+            permit.release()
+            record_llm_call("openrouter", self.openrouter_model, "cancelled")
+            llm_span.set_attribute("llm.outcome", "cancelled")
+            llm_span.end()
+            raise
+        except Exception as e:
+            permit.failure()
+            record_llm_call("openrouter", self.openrouter_model, "error", permit.elapsed())
+            llm_span.set_attribute("llm.outcome", "error")
+            llm_span.end(e)
+            print(f"❌ OpenRouter failed: {str(e) or type(e).__name__}")
+            raise
+        finally:
+            in_flight.dec()
+
+        permit.success()
+        record_llm_call("openrouter", self.openrouter_model, "success", permit.elapsed())
+        llm_span.set_attribute("llm.outcome", "success")
+        llm_span.end()
+        print("✅ Success with OpenRouter")
+        return text
+
+    def _assemble_prompt(self, question: str, history: List[Dict[str, str]] = None) -> AssembledPrompt:
+        """Dựng prompt một lần cho cả request (history theo ngân sách token, xem prompt_builder)"""
+        with stage_timer("prompt_assembly") as timer:
+            prompt = self.prompt_assembler.assemble(question, history)
+            timer.span.set_attribute("prompt.tokens", prompt.tokens)
+            timer.span.set_attribute("prompt.history_kept", prompt.kept)
+            timer.span.set_attribute("prompt.history_compacted", prompt.compacted)
+        if prompt.compacted:
+            print(f"✂️  History: kept {prompt.kept} messages, compacted {prompt.compacted} older into summary "
+                  f"(~{prompt.tokens} prompt tokens)")
+        return prompt
+
+    def _gemini_prompt_text(self, prompt: AssembledPrompt) -> str:
+        """Model đã mang system prompt (system_instruction/cached content) → chỉ gửi phần dialogue"""
+        return prompt.dialogue if self.model_registry.carries_system_prompt else prompt.text
+
+    async def stream_response(self, question: str, history: List[Dict[str, str]] = None) -> AsyncIterator[str]:
+        """
+        Stream câu trả lời đã prettify theo từng phần, nối lại = câu trả lời của get_response (dùng cho /chat/stream)
+        Fallback chain giống get_response: Gemini → OpenRouter
+        """
+        if not question.strip():
+            raise ValueError("Câu hỏi không được để trống")
+
+        with span("chat.stream_response", **{"chat.history_messages": len(history or ())}) as chat_span:
+            with stage_timer("chat_cache_lookup"):
+                cached_answer = self.response_cache.get(question, history)
+            chat_span.set_attribute("chat.cached", cached_answer is not None)
+            if cached_answer is not None:
+                print("✅ Chat response served from cache")
+                yield cached_answer
+                return
+
+            deltas = []
+            async for delta in self._prettify_stream(self._stream_provider_text(question, history)):
+                deltas.append(delta)
+                yield delta
+
+            # Nối các delta = đúng câu trả lời get_response trả về cho cùng text
+            answer = "".join(deltas)
+            if answer:
+                with stage_timer("chat_cache_store"):
+                    self.response_cache.set(question, history, answer)
+
+    async def _stream_provider_text(self, question: str, history: List[Dict[str, str]] = None) -> AsyncIterator[str]:
+        """
+        Stream raw text từ providers. Chỉ chuyển sang model/provider tiếp theo
+        nếu lỗi xảy ra TRƯỚC khi có token đầu tiên. Provider/model open-circuit bị bỏ qua
+        (không hedge khi stream: đã gửi token cho client thì không đổi provider được)
+        """
+        prompt = self._assemble_prompt(question, history)
+        last_error = None
+
         # Try 1: Gemini Direct (Primary)
-        gemini_error = None
         if self.gemini_api_key:
-            # First, try to list available models
-            available_models = []
-            try:
-                print("🔍 Listing available Gemini models...")
-                for model in genai.list_models():
-                    if 'generateContent' in model.supported_generation_methods:
-                        model_name = model.name.replace('models/', '')
-                        available_models.append(model_name)
-                        print(f"   ✅ Found: {model_name}")
-                
-                if available_models:
-                    print(f"📋 Using first available model: {available_models[0]}")
-                    gemini_models = available_models
-                else:
-                    # Fallback to common model names if list_models fails
-                    gemini_models = [
-                        "gemini-pro",
-                        "gemini-1.5-pro",
-                        "gemini-1.5-flash",
-                        "models/gemini-pro",
-                        "models/gemini-1.5-pro"
-                    ]
-            except Exception as list_error:
-                print(f"⚠️  Could not list models: {list_error}")
-                # Fallback to common model names
-                gemini_models = [
-                    "gemini-pro",
-                    "gemini-1.5-pro", 
-                    "gemini-1.5-flash",
-                    "models/gemini-pro",
-                    "models/gemini-1.5-pro"
-                ]
+            gemini_models = await self._gemini_candidates()
             
             for model_name in gemini_models:
+                permit = self.circuit_breakers.acquire("gemini", f"gemini:{model_name}")
+                if permit is None:
+                    record_llm_call("gemini", model_name, "circuit_open")
+                    last_error = f"Gemini Direct ({model_name}) circuit open"
+                    continue
+                started = False
                 try:
-                    print(f"🔄 Trying Gemini Direct (Primary) with {model_name}...")
-                    # Create new model instance for each try
-                    test_model = genai.GenerativeModel(model_name)
-                    
-                    # Build prompt with system message and history
-                    full_prompt = self.system_prompt + "\n\n"
-                    
-                    # Add history
-                    for msg in messages[1:-1]:  # Skip system and last user message
-                        role = msg["role"]
-                        content = msg["content"]
-                        if role == "user":
-                            full_prompt += f"User: {content}\n"
-                        elif role == "assistant":
-                            full_prompt += f"Assistant: {content}\n"
-                    
-                    # Add current question
-                    full_prompt += f"User: {question}\nAssistant:"
-                    
-                    # Try generate_content directly (simpler approach)
-                    response = test_model.generate_content(full_prompt)
-                    text = response.text.strip() if response.text else None
-                    
-                    if text:
-                        print(f"✅ Success with Gemini Direct ({model_name})")
-                        # Save working model for next time
-                        self.gemini_model = test_model
-                        self.gemini_model_name = model_name
-                        return self._process_response(text)
-                    else:
+                    print(f"🔄 Streaming Gemini Direct (Primary) with {model_name}...")
+                    test_model = self.model_registry.get_model(model_name)
+                    async for text in self._metered_stream("gemini", model_name, prompt,
+                                                        self._stream_gemini(test_model, self._gemini_prompt_text(prompt))):
+                        if not started:
+                            started = True
+                            # Độ trễ stream (time-to-first-token) không ghi vào cửa sổ p95
+                            permit.success(measure=False)
+                        yield text
+                    if not started:
                         raise ValueError("Empty response from Gemini")
-                        
+                    print(f"✅ Streamed with Gemini Direct ({model_name})")
+                    self.gemini_model = test_model
+                    self.gemini_model_name = model_name
+                    self.model_registry.mark_success(model_name)
+                    return
                 except Exception as e:
-                    gemini_error = str(e)
+                    if started:
+                        raise
                     error_msg = str(e)
-                    # Check if it's an API not enabled error
-                    if "API key not valid" in error_msg or "not enabled" in error_msg.lower():
-                        print(f"❌ Gemini API error: {error_msg}")
-                        print("💡 HINT: Make sure Gemini API is enabled in Google Cloud Console")
-                        print("   Visit: https://makersuite.google.com/app/apikey")
-                    elif "404" in error_msg or "not found" in error_msg.lower():
-                        print(f"❌ Model {model_name} not found: {error_msg[:100]}")
+                    last_error = f"Gemini Direct: {error_msg}"
+                    if is_model_not_found_error(e):
+                        permit.release()
+                        self.model_registry.mark_not_found(model_name)
                     else:
-                        print(f"❌ Gemini Direct failed with {model_name}: {error_msg[:200]}")
-                    # Try next model
+                        permit.failure()
+                    print(f"❌ Gemini stream failed with {model_name}: {error_msg[:200]}")
                     continue
-            
-            # All Gemini models failed
-            if gemini_error:
-                last_error = f"Gemini Direct: {gemini_error}"
-                print(f"❌ All Gemini models failed. Last error: {last_error}")
-        
+                finally:
+                    # Bị huỷ trước token đầu tiên → trả lại quyền gọi, không tính lỗi
+                    permit.release()
+
         # Try 2: OpenRouter (Fallback)
         if self.openrouter_api_key:
-            try:
-                print("🔄 Falling back to OpenRouter...")
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    response = await client.post(
-                        f"{self.base_url}/chat/completions",
-                        headers={
-                            "Authorization": f"Bearer {self.openrouter_api_key}",
-                            "Content-Type": "application/json",
-                            "HTTP-Referer": "https://mydiary.app",
-                            "X-Title": "My Diary Nutrition App"
-                        },
-                        json={"model": self.openrouter_model, "messages": messages}
-                    )
-                
-                    if response.status_code == 200:
-                        result = response.json()
-                        if "choices" in result and len(result["choices"]) > 0:
-                            text = result["choices"][0]["message"]["content"].strip()
-                            if text:
-                                print("✅ Success with OpenRouter")
-                                return self._process_response(text)
-                    else:
-                        # Rate limit or error
-                        if response.status_code == 429:
-                            raise ValueError(f"OpenRouter rate limited: {response.text}")
-                        else:
-                            raise ValueError(f"OpenRouter error {response.status_code}: {response.text}")
-                        
-            except Exception as e:
-                last_error = str(e)
-                print(f"❌ OpenRouter failed: {last_error}")
-        
+            permit = self.circuit_breakers.acquire("openrouter", f"openrouter:{self.openrouter_model}")
+            if permit is None:
+                print("⏭️  OpenRouter circuit open → skip")
+                record_llm_call("openrouter", self.openrouter_model, "circuit_open")
+                last_error = "OpenRouter circuit open"
+            else:
+                started = False
+                try:
+                    print("🔄 Streaming from OpenRouter...")
+                    async for text in self._metered_stream("openrouter", self.openrouter_model, prompt,
+                                                            self._stream_openrouter(prompt.messages)):
+                        if not started:
+                            started = True
+                            permit.success(measure=False)
+                        yield text
+                    if started:
+                        print("✅ Streamed with OpenRouter")
+                        return
+                    raise ValueError("Empty response from OpenRouter")
+                except Exception as e:
+                    if started:
+                        raise
+                    permit.failure()
+                    last_error = str(e) or type(e).__name__
+                    print(f"❌ OpenRouter stream failed: {last_error}")
+                finally:
+                    permit.release()
+
         # All providers failed
         raise ValueError(f"Tất cả providers đều thất bại. Lỗi cuối: {last_error}")
-    
-    def _process_response(self, text: str) -> str:
-        """Process và prettify response text"""
+
+    async def _metered_stream(self, provider: str, model: str, prompt: AssembledPrompt,
+                              chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Metrics cho một stream: in-flight, kết quả, thời gian tới hết stream, token (ước lượng)"""
+        estimator = self.prompt_assembler.estimator
+        in_flight = LLM_IN_FLIGHT.labels(provider)
+        in_flight.inc()
+        # Span thủ công: generator yield giữa chừng nên không dùng làm span hiện tại
+        llm_span = start_span(f"llm.{provider}", SPAN_KIND_CLIENT, **{
+            "gen_ai.system": provider, "gen_ai.request.model": model, "llm.stream": True
+        })
+        started = time.perf_counter()
+        completion_raw = 0.0
+        outcome = "error"
+        error = None
         try:
-            parsed = json.loads(text)
-            # Build pretty text from JSON
-            parts = []
-            if isinstance(parsed, dict):
-                if parsed.get('title'):
-                    parts.append(parsed.get('title').strip())
-                    parts.append('')
-                if parsed.get('summary'):
-                    parts.append(parsed.get('summary').strip())
-                    parts.append('')
-                if parsed.get('bullets') and isinstance(parsed.get('bullets'), list):
-                    bullets = [b.strip().rstrip('.') for b in parsed.get('bullets') if b]
-                    if bullets:
-                        parts.append('Bạn nên: ' + ', '.join(bullets) + '.')
-                        parts.append('')
-                if parsed.get('meals') and isinstance(parsed.get('meals'), list):
-                    parts.append('\n'.join([m.strip() for m in parsed.get('meals') if m]))
-                    parts.append('')
-                if parsed.get('notes'):
-                    parts.append('Ghi chú: ' + parsed.get('notes').strip())
-            
-            pretty = '\n'.join([p for p in parts if p is not None and p != ''])
-            return pretty if pretty else self._prettify_text(text)
-        except:
-            return self._prettify_text(text)
-
-    def _prettify_text(self, raw: str) -> str:
-        """Cố gắng chuyển các bullet/markdown thành đoạn văn tiếng Việt đẹp hơn."""
-        if not raw or not raw.strip():
-            return raw
-
-        s = raw
-        # Remove bold/markdown markers
-        s = s.replace('**', '')
-        s = s.replace('`', '')
-        # Remove common icons
-        s = re.sub(r'[•*+\-✅❌]', '', s)
-
-        # Normalize newlines and trim spaces
-        lines = [ln.strip() for ln in re.split(r'[\r\n]+', s) if ln.strip()]
-        if not lines:
-            return s.strip()
-
-        paragraphs = []
-        i = 0
-        while i < len(lines):
-            line = lines[i]
-            # If line ends with ':' treat following lines as list -> join with commas
-            if line.endswith(':') or re.search(r'^(Nên|Ưu|Hạn chế|Gợi ý|Gợi ý bữa|Bạn nên|Nên hạn chế)', line, re.I):
-                header = line.rstrip(':').strip()
-                items = []
-                j = i + 1
-                while j < len(lines) and not lines[j].endswith(':'):
-                    items.append(lines[j].strip())
-                    j += 1
-                if items:
-                    clean_items = [re.sub(r'^[\-\*\u2022\+\s]+', '', it).strip().rstrip('.') for it in items]
-                    para = header + ': ' + ', '.join(clean_items) + '.'
-                    paragraphs.append(para)
-                    i = j
+            async for text in chunks:
+                if not completion_raw:
+                    llm_span.add_event("first_token")
+                completion_raw += estimator.raw(text)
+                yield text
+            if completion_raw:
+                outcome = "success"
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            in_flight.dec()
+            record_llm_call(provider, model, outcome, time.perf_counter() - started if outcome == "success" else None)
+            if completion_raw:
+                record_llm_tokens(provider, model, prompt.tokens, int(completion_raw * estimator.scale) + 1)
+            llm_span.set_attribute("llm.outcome", outcome)
+            llm_span.end(error)
+
+    async def _stream_gemini(self, model, prompt: str) -> AsyncIterator[str]:
+        """generate_content(stream=True) chạy trên executor, chunk được đẩy về event loop qua queue"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        end_of_stream = object()
+
+        def produce():
+            try:
+                for chunk in model.generate_content(prompt, stream=True):
+                    if chunk.text:
+                        loop.call_soon_threadsafe(queue.put_nowait, chunk.text)
+                loop.call_soon_threadsafe(queue.put_nowait, end_of_stream)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        loop.run_in_executor(self.gemini_executor, produce)
+        while True:
+            item = await queue.get()
+            if item is end_of_stream:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def _stream_openrouter(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        """Stream từ OpenRouter (stream: true, định dạng SSE của OpenAI)"""
+        client = self._get_openrouter_client()
+        deadline = asyncio.get_running_loop().time() + self.openrouter_total_timeout
+        async with client.stream(
+            "POST",
+            "/chat/completions",
+            json={"model": self.openrouter_model, "messages": messages, "stream": True}
+        ) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                if response.status_code == 429:
+                    raise ValueError(f"OpenRouter rate limited: {body}")
+                raise ValueError(f"OpenRouter error {response.status_code}: {body}")
+
+            async for line in response.aiter_lines():
+                if asyncio.get_running_loop().time() > deadline:
+                    raise asyncio.TimeoutError()
+                # Bỏ qua comment (": OPENROUTER PROCESSING") và dòng trống
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    return
+                try:
+                    payload = json.loads(data)
+                except ValueError:
                     continue
-            # Default: treat as normal paragraph
-            paragraphs.append(line)
-            i += 1
+                choices = payload.get("choices") or []
+                if choices:
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield delta
+
+    async def _prettify_stream(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        Prettify tăng dần: mỗi phần câu trả lời được trả về ngay khi chắc chắn không đổi
+        (xem response_formatter.StreamFormatter). Câu trả lời dạng JSON được gom lại và xử lý ở cuối
+        """
+        formatter = StreamFormatter()
+        async for chunk in chunks:
+            for delta in formatter.feed(chunk):
+                yield delta
+        for delta in formatter.close():
+            yield delta
+
+    async def _run_in_gemini_executor(self, func, *args):
+        """Chạy blocking call của Gemini SDK trên bounded thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.gemini_executor, bind_context(func, *args))
+
+    def _generate_gemini_text(self, model, prompt: str):
+        """
+        Gọi generate_content (blocking) và lấy text; chạy trong executor
+
+        Returns:
+            (text, prompt_tokens, completion_tokens) — số token 0 nếu SDK không báo usage
+        """
+        response = model.generate_content(prompt)
+        # Hiệu chỉnh TokenEstimator theo số prompt token thật
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = completion_tokens = 0
+        if usage is not None:
+            prompt_tokens = getattr(usage, "prompt_token_count", 0)
+            completion_tokens = getattr(usage, "candidates_token_count", 0)
+            estimator = self.prompt_assembler.estimator
+            raw = estimator.raw(prompt)
+            if self.model_registry.carries_system_prompt:
+                # prompt_token_count tính cả system_instruction / cached content
+                raw += estimator.raw(self.system_prompt)
+            estimator.observe(raw, prompt_tokens)
+        return (response.text.strip() if response.text else None), prompt_tokens, completion_tokens
 
-        pretty = '\n\n'.join(paragraphs)
-        # Final cleanup: collapse multiple spaces
-        pretty = re.sub(r'\s{2,}', ' ', pretty)
-        return pretty.strip()
+    def _create_openrouter_client(self) -> httpx.AsyncClient:
+        """Tạo AsyncClient dùng chung cho OpenRouter"""
+        kwargs = dict(
+            base_url=self.base_url,
+            headers={
+                "Authorization": f"Bearer {self.openrouter_api_key}",
+                "Content-Type": "application/json",
+                "HTTP-Referer": "https://mydiary.app",
+                "X-Title": "My Diary Nutrition App"
+            },
+            limits=self.openrouter_limits,
+            timeout=self.openrouter_timeout
+        )
+        try:
+            return httpx.AsyncClient(http2=self.openrouter_http2, **kwargs)
+        except ImportError:
+            # HTTP/2 cần package h2 (httpx[http2]), fallback về HTTP/1.1 keep-alive
+            print("⚠️  h2 not installed, OpenRouter client uses HTTP/1.1")
+            return httpx.AsyncClient(**kwargs)
+
+    def _get_openrouter_client(self) -> httpx.AsyncClient:
+        """Lấy client dùng chung (tạo lazy nếu chưa gọi astart, VD khi chạy ngoài FastAPI)"""
+        if self.openrouter_client is None or self.openrouter_client.is_closed:
+            self.openrouter_client = self._create_openrouter_client()
+        return self.openrouter_client
+
+    async def astart(self):
+        """Khởi tạo tài nguyên dùng chung khi server startup"""
+        if self.openrouter_api_key:
+            self._get_openrouter_client()
+
+    async def aclose(self):
+        """Giải phóng tài nguyên khi server shutdown"""
+        if self.openrouter_client is not None:
+            await self.openrouter_client.aclose()
+            self.openrouter_client = None
+        if self.model_registry.context_cache is not None:
+            # Xoá cached content phía Gemini (tính phí lưu trữ theo thời gian)
+            await self._run_in_gemini_executor(self.model_registry.context_cache.close)
+        self.gemini_executor.shutdown(wait=False)
 
     async def analyze_food_image(self, image_bytes: bytes, filename: str = "default") -> dict:
         """
@@ -310,47 +742,24 @@ NGUYÊN TẮC:
         print("📸 Image analysis: Using MOCK DATA only (no API calls to save tokens)")
         
         # Import mock data function
-        from mock_nutrition_data import get_mock_nutrition_by_filename
-        
-        # Get mock data based on filename
-        mock_result = get_mock_nutrition_by_filename(filename)
+        from mock_nutrition_data import get_mock_nutrition_by_filename, nutrient_payload
         
-        # Convert to analyze-image format
-        nutrients_obj = {}
-        for nutrient in mock_result.get("nutrients", []):
-            code = nutrient["nutrient_code"]
-            # Remove MIN_ prefix from minerals
-            if code.startswith("MIN_"):
-                code = code.replace("MIN_", "")
-            # Convert to lowercase
-            code = code.lower()
-            nutrients_obj[code] = nutrient["amount"]
-        
-        # Ensure all 76 nutrients exist (fill missing with 0)
-        nutrient_keys = [
-            "enerc_kcal", "procnt", "fat", "chocdf",
-            "fibtg", "fib_sol", "fib_insol", "fib_rs", "fib_bglu",
-            "cholesterol",
-            "vita", "vitd", "vite", "vitk", "vitc",
-            "vitb1", "vitb2", "vitb3", "vitb5", "vitb6", "vitb7", "vitb9", "vitb12",
-            "ca", "p", "mg", "k", "na", "fe", "zn", "cu", "mn", "i", "se", "cr", "mo", "f",
-            "fams", "fapu", "fasat", "fatrn", "faepa", "fadha", "faepa_dha", "fa18_2n6c", "fa18_3n3",
-            "amino_his", "amino_ile", "amino_leu", "amino_lys", "amino_met",
-            "amino_phe", "amino_thr", "amino_trp", "amino_val",
-            "ala", "epa_dha", "la"
-        ]
-        
-        for key in nutrient_keys:
-            if key not in nutrients_obj:
-                nutrients_obj[key] = 0
-        
-        # Random confidence between 90-95%
-        import random
-        random_confidence = random.uniform(0.90, 0.95)
-        
-        # Simulate processing delay (1-2 seconds)
-        import asyncio
-        await asyncio.sleep(random.uniform(1, 2))
+        with span("image.analyze_food_image", **{"image.filename": filename, "image.bytes": len(image_bytes or b"")}) as image_span:
+            # Get mock data based on filename
+            with span("image.mock_lookup"):
+                mock_result = get_mock_nutrition_by_filename(filename)
+                # Nutrients dạng object (bỏ MIN_, lowercase, đủ các key, thiếu = 0) đã dựng sẵn cho mỗi món
+                payload = nutrient_payload(mock_result["nutrients"])
+            image_span.set_attribute("image.food_name", mock_result.get("food_name"))
+            
+            # Random confidence between 90-95%
+            import random
+            random_confidence = random.uniform(0.90, 0.95)
+            
+            # Simulate processing delay (SIMULATED_LATENCY_ASSISTANT_IMAGE, mặc định 1-2 giây)
+            from latency_model import get_latency_model
+            with stage_timer("analysis"):
+                await get_latency_model("assistant_image").wait()
         
         result = {
             "items": [{
@@ -359,8 +768,9 @@ NGUYÊN TẮC:
                 "confidence_score": random_confidence,
                 "estimated_volume_ml": 250,
                 "estimated_weight_g": 200,
-                "water_ml": nutrients_obj.get("water", 0),
-                "nutrients": nutrients_obj
+                "water_ml": payload.water_ml,
+                # Copy: payload dùng chung giữa các request (read-only)
+                "nutrients": dict(payload.nutrients_obj_full)
             }]
         }
         
@@ -0,0 +1,5 @@
+"""
+Benchmark thủ công (không chạy trong pytest), chạy từ thư mục chatbotapi:
+
+    python -m benchmarks.bench_cache
+"""
@@ -0,0 +1,128 @@
+"""
+Benchmark: prompt token và độ trễ khi gửi system prompt theo từng cách (gọi API thật)
+- Gemini "inline": system prompt chèn vào đầu text prompt (cách cũ)
+- Gemini "system_instruction": gửi riêng, prefix cố định (implicit caching nếu model hỗ trợ)
+- Gemini "cached": context cache phía Gemini (CachedContent), request chỉ gửi dialogue
+- OpenRouter có / không có cache_control trên system message
+
+Cần GEMINI_API_KEY và/hoặc OPENROUTER_API_KEY (đọc từ .env)
+
+    python -m benchmarks.bench_context_cache [model] [số_request]
+"""
+import os
+import statistics
+import sys
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import google.generativeai as genai
+
+from assistant_openrouter import ChatbotAssistant
+from gemini_models import (
+    SUPPORTS_SYSTEM_INSTRUCTION, GeminiContextCache, GeminiModelRegistry, genai_caching
+)
+from prompt_builder import PromptAssembler, TokenEstimator
+
+MODEL = sys.argv[1] if len(sys.argv) > 1 else "gemini-1.5-flash-001"
+REQUESTS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+QUESTIONS = [
+    "Người bị tiểu đường nên ăn gì?",
+    "Bữa sáng cho người giảm cân?",
+    "Uống nước chanh mỗi ngày có tốt không?",
+    "Phở bò bao nhiêu calo?",
+    "Người cao huyết áp nên hạn chế món gì?",
+]
+
+
+def report(label: str, rows: list):
+    """rows: (latency_s, prompt_tokens, cached_tokens)"""
+    if not rows:
+        print(f"{label:<34} (không chạy được)")
+        return
+    latency = statistics.median(r[0] for r in rows) * 1000
+    prompt_tokens = statistics.median(r[1] for r in rows)
+    cached_tokens = statistics.median(r[2] for r in rows)
+    print(f"{label:<34} p50 {latency:8.0f} ms   prompt tokens {prompt_tokens:7.0f}   cached {cached_tokens:6.0f}")
+
+
+def run_gemini(model, assembler: PromptAssembler, inline: bool) -> list:
+    rows = []
+    for i in range(REQUESTS):
+        prompt = assembler.assemble(QUESTIONS[i % len(QUESTIONS)])
+        start = time.perf_counter()
+        try:
+            response = model.generate_content(prompt.text if inline else prompt.dialogue)
+            response.text
+        except Exception as e:
+            print(f"   ❌ {str(e)[:150]}")
+            continue
+        usage = getattr(response, "usage_metadata", None)
+        rows.append((
+            time.perf_counter() - start,
+            getattr(usage, "prompt_token_count", 0),
+            getattr(usage, "cached_content_token_count", 0)
+        ))
+    return rows
+
+
+def run_openrouter(api_key: str, model: str, assembler: PromptAssembler) -> list:
+    rows = []
+    with httpx.Client(base_url="https://openrouter.ai/api/v1", timeout=60,
+                      headers={"Authorization": f"Bearer {api_key}"}) as client:
+        for i in range(REQUESTS):
+            prompt = assembler.assemble(QUESTIONS[i % len(QUESTIONS)])
+            start = time.perf_counter()
+            response = client.post("/chat/completions", json={"model": model, "messages": prompt.messages})
+            if response.status_code != 200:
+                print(f"   ❌ OpenRouter {response.status_code}: {response.text[:150]}")
+                continue
+            usage = response.json().get("usage") or {}
+            rows.append((
+                time.perf_counter() - start,
+                usage.get("prompt_tokens", 0),
+                (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+            ))
+    return rows
+
+
+if __name__ == "__main__":
+    gemini_key = os.getenv("GEMINI_API_KEY")
+    openrouter_key = os.getenv("OPENROUTER_API_KEY")
+    if not gemini_key and not openrouter_key:
+        sys.exit("Cần GEMINI_API_KEY hoặc OPENROUTER_API_KEY")
+
+    system_prompt = ChatbotAssistant(gemini_key, openrouter_key).system_prompt
+    estimator = TokenEstimator()
+    print(f"🧪 BENCHMARK: system prompt caching ({REQUESTS} requests per mode)")
+    print("=" * 90)
+
+    if gemini_key:
+        genai.configure(api_key=gemini_key)
+        assembler = PromptAssembler(system_prompt, estimator)
+        report(f"Gemini inline ({MODEL})", run_gemini(genai.GenerativeModel(MODEL), assembler, inline=True))
+        if SUPPORTS_SYSTEM_INSTRUCTION:
+            registry = GeminiModelRegistry(system_instruction=system_prompt)
+            report("Gemini system_instruction", run_gemini(registry.get_model(MODEL), assembler, inline=False))
+        else:
+            print("Gemini system_instruction            cần google-generativeai >= 0.5")
+        if genai_caching is not None:
+            cache = GeminiContextCache(system_prompt, ttl_seconds=300)
+            if cache.warm(MODEL):
+                report("Gemini cached content", run_gemini(cache.get_model(MODEL), assembler, inline=False))
+            else:
+                print(f"Gemini cached content                không tạo được (tối thiểu {cache.min_tokens} token, xem log)")
+            cache.close()
+        else:
+            print("Gemini cached content                cần google-generativeai >= 0.7")
+
+    if openrouter_key:
+        model = os.getenv("OPENROUTER_MODEL", "google/gemini-2.0-flash-exp:free")
+        report("OpenRouter plain system message",
+               run_openrouter(openrouter_key, model, PromptAssembler(system_prompt, estimator)))
+        report("OpenRouter cache_control",
+               run_openrouter(openrouter_key, model, PromptAssembler(system_prompt, estimator, cache_control=True)))
+    print("=" * 90)
@@ -0,0 +1,79 @@
+"""
+Benchmark: tra món ăn theo tên file khi catalogue lớn dần
+- "legacy": 5 lần .replace, quét mọi key bằng substring, MISS thì dựng lại list key + MD5
+- "indexed": _FoodIndex (alias dict + Aho-Corasick + tuple key cố định)
+
+    python -m benchmarks.bench_food_lookup
+"""
+import hashlib
+import random
+import statistics
+import string
+import time
+
+from mock_nutrition_data import MOCK_NUTRITION_DATABASE, _FoodIndex
+
+CATALOGUE_SIZES = [sum(isinstance(v, dict) for v in MOCK_NUTRITION_DATABASE.values()), 1000, 5000]
+LOOKUPS = 2000
+
+def legacy_lookup(database: dict, filename: str) -> dict:
+    """Thuật toán cũ của get_mock_nutrition_by_filename (chỉ phần chọn món)"""
+    normalized = filename.lower().replace('.jpg', '').replace('.jpeg', '').replace('.png', '').replace('-', '').replace('_', '')
+    if normalized in database and isinstance(database[normalized], str):
+        return database[database[normalized]]
+    for key in database.keys():
+        if isinstance(database[key], dict) and key.replace('-', '') in normalized:
+            return database[key]
+    hash_value = int(hashlib.md5(filename.encode()).hexdigest(), 16)
+    food_keys = [k for k in database.keys() if isinstance(database[k], dict) and k != "default"]
+    return database[food_keys[hash_value % len(food_keys)]]
+
+def make_catalogue(size: int, rng: random.Random) -> dict:
+    """Catalogue thật + các món giả tên ngẫu nhiên cho đủ size"""
+    database = dict(MOCK_NUTRITION_DATABASE)
+    template = MOCK_NUTRITION_DATABASE["pho-bo"]
+    while sum(isinstance(v, dict) for v in database.values()) < size:
+        name = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(6, 14)))
+        database[name] = dict(template, food_name=name)
+    return database
+
+def make_filenames(database: dict, rng: random.Random) -> list:
+    """Trộn: alias scaledNN, tên chứa key, tên camera không khớp (→ MD5 fallback)"""
+    keys = [k for k, v in database.items() if isinstance(v, dict)]
+    aliases = [k for k, v in database.items() if isinstance(v, str)]
+    filenames = []
+    for _ in range(LOOKUPS):
+        kind = rng.random()
+        if kind < 0.2:
+            filenames.append(f"{rng.choice(aliases)}.jpg")
+        elif kind < 0.6:
+            filenames.append(f"IMG_{rng.randint(1000, 9999)}_{rng.choice(keys)}.jpeg")
+        else:
+            filenames.append(f"IMG_2024{rng.randint(100000, 999999)}.jpg")
+    return filenames
+
+def measure(lookup, filenames: list) -> float:
+    """Thời gian trung bình mỗi lookup (µs), median của 5 lần chạy"""
+    runs = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for filename in filenames:
+            lookup(filename)
+        runs.append((time.perf_counter() - start) / len(filenames) * 1e6)
+    return statistics.median(runs)
+
+if __name__ == "__main__":
+    rng = random.Random(7)
+    print(f"🧪 BENCHMARK: food lookup by filename ({LOOKUPS} lookups per run)")
+    print("=" * 60)
+    for size in CATALOGUE_SIZES:
+        database = make_catalogue(size, rng)
+        filenames = make_filenames(database, rng)
+        index = _FoodIndex(database)
+
+        mismatches = sum(index.lookup(f) is not legacy_lookup(database, f) for f in filenames)
+        legacy_us = measure(lambda f: legacy_lookup(database, f), filenames)
+        indexed_us = measure(index.lookup, filenames)
+        print(f"{size:>5} dishes   legacy {legacy_us:9.2f} µs   indexed {indexed_us:6.2f} µs   "
+              f"({legacy_us / indexed_us:6.1f}x, mismatches: {mismatches})")
+    print("=" * 60)
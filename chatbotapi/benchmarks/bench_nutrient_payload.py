@@ -0,0 +1,114 @@
+"""
+Microbenchmark: CPU time mỗi request để dựng response nutrients
+- "legacy": mỗi request dựng lại nutrients list từ NUTRIENT_INFO, rồi endpoint lặp lại
+  để bỏ MIN_, lowercase (và điền 0 cho đủ key ở assistant_openrouter)
+- "precomputed": NutrientPayload dựng sẵn, request chỉ gắn confidence và copy dict nutrients
+
+Đo bằng time.process_time (CPU của process, không tính thời gian chờ)
+
+    python -m benchmarks.bench_nutrient_payload
+"""
+import random
+import time
+
+from mock_nutrition_data import (
+    NUTRIENT_INFO, RESPONSE_NUTRIENT_KEYS, _FOOD_INDEX,
+    get_mock_nutrition_by_filename, nutrient_payload
+)
+
+REQUESTS = 20000
+FILENAMES = ["pho-bo.jpg", "scaled35.jpg", "IMG_1234_lauthai.png", "IMG_20240101_120000.jpg"]
+
+def legacy_mock_result(filename: str) -> dict:
+    """get_mock_nutrition_by_filename trước đây: dựng nutrients list mỗi lần"""
+    food_data = _FOOD_INDEX.lookup(filename)
+    nutrients_list = []
+    for code, amount in food_data["nutrients"].items():
+        info = NUTRIENT_INFO.get(code, {"name": code, "unit": "g"})
+        nutrients_list.append({
+            "nutrient_code": code,
+            "nutrient_name": info["name"],
+            "amount": amount,
+            "unit": info["unit"]
+        })
+    return {
+        "is_food": True,
+        "food_name": food_data["food_name"],
+        "confidence": random.uniform(0.90, 0.95),
+        "nutrients": nutrients_list
+    }
+
+def legacy_items(mock_result: dict, fill_missing: bool) -> dict:
+    nutrients_obj = {}
+    for nutrient in mock_result.get("nutrients", []):
+        code = nutrient["nutrient_code"]
+        if code.startswith("MIN_"):
+            code = code.replace("MIN_", "")
+        code = code.lower()
+        nutrients_obj[code] = nutrient["amount"]
+    if fill_missing:
+        for key in RESPONSE_NUTRIENT_KEYS:
+            if key not in nutrients_obj:
+                nutrients_obj[key] = 0
+    return {
+        "items": [{
+            "item_name": mock_result.get("food_name", "Món ăn"),
+            "item_type": "food",
+            "confidence_score": random.uniform(0.90, 0.95),
+            "estimated_volume_ml": 250,
+            "estimated_weight_g": 200,
+            "water_ml": nutrients_obj.get("water", 0),
+            "nutrients": nutrients_obj
+        }]
+    }
+
+def precomputed_items(mock_result: dict, fill_missing: bool) -> dict:
+    payload = nutrient_payload(mock_result.get("nutrients", ()))
+    return {
+        "items": [{
+            "item_name": mock_result.get("food_name", "Món ăn"),
+            "item_type": "food",
+            "confidence_score": random.uniform(0.90, 0.95),
+            "estimated_volume_ml": 250,
+            "estimated_weight_g": 200,
+            "water_ml": payload.water_ml,
+            "nutrients": dict(payload.nutrients_obj_full if fill_missing else payload.nutrients_obj)
+        }]
+    }
+
+SCENARIOS = {
+    "/analyze-nutrition (list)": (
+        lambda f: legacy_mock_result(f),
+        lambda f: get_mock_nutrition_by_filename(f)
+    ),
+    "/analyze-image (dict)": (
+        lambda f: legacy_items(legacy_mock_result(f), False),
+        lambda f: precomputed_items(get_mock_nutrition_by_filename(f), False)
+    ),
+    "assistant mock (dict + fill)": (
+        lambda f: legacy_items(legacy_mock_result(f), True),
+        lambda f: precomputed_items(get_mock_nutrition_by_filename(f), True)
+    ),
+}
+
+def cpu_us_per_request(build) -> float:
+    start = time.process_time()
+    for i in range(REQUESTS):
+        build(FILENAMES[i % len(FILENAMES)])
+    return (time.process_time() - start) / REQUESTS * 1e6
+
+if __name__ == "__main__":
+    print(f"🧪 MICROBENCHMARK: CPU time per request ({REQUESTS} requests)")
+    print("=" * 60)
+    for name, (legacy, precomputed) in SCENARIOS.items():
+        for filename in FILENAMES:
+            legacy_result, new_result = legacy(filename), precomputed(filename)
+            if "items" in legacy_result:
+                assert legacy_result["items"][0]["nutrients"] == new_result["items"][0]["nutrients"], name
+            else:
+                assert legacy_result["nutrients"] == list(new_result["nutrients"]), name
+        legacy_us = cpu_us_per_request(legacy)
+        precomputed_us = cpu_us_per_request(precomputed)
+        print(f"{name:<30} legacy {legacy_us:7.2f} µs   precomputed {precomputed_us:6.2f} µs   "
+              f"({legacy_us / precomputed_us:4.1f}x)")
+    print("=" * 60)
@@ -0,0 +1,76 @@
+"""
+Benchmark: tổng hợp 10k bữa ăn (nhân khẩu phần, cộng, so với mục tiêu hàng ngày)
+- "dict": mỗi bữa là dict {code: amount}, cộng theo key string
+- "vector": MealLog trên array('d') theo nutrient_schema
+  (NumPy nếu có cài; luôn đo thêm nhánh array('d') thuần để so sánh)
+
+    python -m benchmarks.bench_nutrient_vectors [số_bữa]
+"""
+import random
+import statistics
+import sys
+import time
+
+import nutrient_schema
+from mock_nutrition_data import _FOOD_INDEX
+from nutrient_schema import MealLog, compare_to_targets, targets_vector
+
+NUM_MEALS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+RUNS = 5
+# Mục tiêu mẫu chỉ để benchmark (không phải khuyến nghị dinh dưỡng)
+SAMPLE_TARGETS = {"ENERC_KCAL": 2000, "PROCNT": 60, "FAT": 65, "CHOCDF": 300, "MIN_CA": 1000, "MIN_FE": 18}
+
+def dict_aggregate(meals: list, targets: dict) -> dict:
+    """Cách dùng dict: scale + cộng theo key, rồi chia cho mục tiêu"""
+    total = {}
+    for amounts, portion in meals:
+        for code, amount in amounts.items():
+            total[code] = total.get(code, 0) + amount * portion
+    return {code: (total.get(code, 0) / target if target else 0.0) for code, target in targets.items()}
+
+def vector_aggregate(meals: list, targets) -> object:
+    log = MealLog()
+    log.extend(meals)
+    return compare_to_targets(log.total(), targets)
+
+def median_ms(func, *args) -> float:
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+def total_only_ms(log: MealLog) -> float:
+    return median_ms(log.total)
+
+if __name__ == "__main__":
+    rng = random.Random(3)
+    keys = list(_FOOD_INDEX.foods)
+    picks = [(rng.choice(keys), rng.choice([0.5, 1, 1, 1.5, 2])) for _ in range(NUM_MEALS)]
+    dict_meals = [(_FOOD_INDEX.foods[key]["nutrients"], portion) for key, portion in picks]
+    vector_meals = [(_FOOD_INDEX.payloads[key].vector, portion) for key, portion in picks]
+    targets = targets_vector(SAMPLE_TARGETS)
+
+    # Kết quả hai cách phải khớp
+    ratios = vector_aggregate(vector_meals, targets)
+    for code, ratio in dict_aggregate(dict_meals, SAMPLE_TARGETS).items():
+        assert abs(ratios[nutrient_schema.INDEX[code]] - ratio) < 1e-6, code
+
+    log = MealLog()
+    log.extend(vector_meals)
+
+    print(f"🧪 BENCHMARK: aggregate {NUM_MEALS:,} meal entries ({nutrient_schema.NUM_NUTRIENTS} nutrients)")
+    print("=" * 60)
+    print(f"dict (string keys)          {median_ms(dict_aggregate, dict_meals, SAMPLE_TARGETS):8.2f} ms")
+
+    numpy_module = nutrient_schema.np
+    backends = [("array('d')", None)] + ([("NumPy", numpy_module)] if numpy_module is not None else [])
+    for label, backend in backends:
+        nutrient_schema.np = backend
+        print(f"vector {label:<12} log+total {median_ms(vector_aggregate, vector_meals, targets):8.2f} ms   "
+              f"total only {total_only_ms(log):8.2f} ms")
+    nutrient_schema.np = numpy_module
+    if numpy_module is None:
+        print("(NumPy chưa cài: pip install numpy để đo nhánh NumPy)")
+    print("=" * 60)
@@ -0,0 +1,76 @@
+"""
+Benchmark: tìm ảnh gần giống theo perceptual hash trên index lớn
+- "linear": quét toàn bộ hash, popcount từng cặp (cách làm ngây thơ)
+- "multi-index": PerceptualHashIndex (4 đoạn 16 bit, tra biến thể lân cận)
+
+    python -m benchmarks.bench_phash [số_entry] [max_distance]
+
+Query gồm ảnh đã có (lệch vài bit, giả lập re-compress) và ảnh mới (không khớp)
+"""
+import random
+import statistics
+import sys
+import time
+
+from perceptual_index import PHASH_MAX_DISTANCE, PerceptualHashIndex, hamming_distance
+
+NUM_ENTRIES = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+MAX_DISTANCE = int(sys.argv[2]) if len(sys.argv) > 2 else PHASH_MAX_DISTANCE
+NUM_QUERIES = 1000
+LINEAR_QUERIES = 20
+
+def flip_bits(value: int, count: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+def percentiles(samples: list) -> str:
+    samples = sorted(samples)
+    p50 = statistics.median(samples) * 1000
+    p99 = samples[int(len(samples) * 0.99) - 1] * 1000
+    return f"p50 {p50:8.3f} ms   p99 {p99:8.3f} ms"
+
+def linear_nearest(values: list, query: int, max_distance: int):
+    best = None
+    for value in values:
+        distance = hamming_distance(query, value)
+        if distance <= max_distance and (best is None or distance < best[1]):
+            best = (value, distance)
+    return best
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    values = [rng.getrandbits(64) for _ in range(NUM_ENTRIES)]
+
+    index = PerceptualHashIndex(MAX_DISTANCE)
+    start = time.perf_counter()
+    index.bulk_load((f"sha-{i}", f"{value:016x}") for i, value in enumerate(values))
+    build_time = time.perf_counter() - start
+
+    queries = []
+    for _ in range(NUM_QUERIES):
+        if rng.random() < 0.5:
+            queries.append((flip_bits(rng.choice(values), rng.randint(0, MAX_DISTANCE), rng), True))
+        else:
+            queries.append((rng.getrandbits(64), False))
+
+    print(f"🧪 BENCHMARK: perceptual hash lookup, {NUM_ENTRIES:,} entries, max distance {MAX_DISTANCE}")
+    print("=" * 60)
+    print(f"Index build: {build_time:.2f}s")
+
+    timings, misses = [], 0
+    for query, expected in queries:
+        start = time.perf_counter()
+        match = index.nearest(f"{query:016x}")
+        timings.append(time.perf_counter() - start)
+        if expected and match is None:
+            misses += 1
+    print(f"multi-index  {percentiles(timings)}   (near-duplicates missed: {misses})")
+
+    timings = []
+    for query, _ in queries[:LINEAR_QUERIES]:
+        start = time.perf_counter()
+        linear_nearest(values, query, MAX_DISTANCE)
+        timings.append(time.perf_counter() - start)
+    print(f"linear       {percentiles(timings)}   ({LINEAR_QUERIES} queries)")
+    print("=" * 60)
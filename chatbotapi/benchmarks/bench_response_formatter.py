@@ -0,0 +1,159 @@
+"""
+Benchmark: format câu trả lời của model (10–100 KB)
+- "legacy": _process_response/_prettify_text cũ (json.loads mọi câu trả lời, regex biên dịch lại mỗi lần,
+  nhiều lượt re.sub/split/list comprehension)
+- "formatter": response_formatter.format_response (sniff JSON, str.replace + một lượt state machine)
+- "stream": StreamFormatter với chunk ~40 ký tự như khi stream từ provider
+
+Kiểm tra kết quả: formatter == legacy (từng byte) và nối các delta của stream == formatter.
+legacy_* cũng được tests/test_response_formatter.py dùng làm chuẩn (golden)
+
+    python -m benchmarks.bench_response_formatter
+"""
+import json
+import random
+import re
+import statistics
+import time
+
+from response_formatter import StreamFormatter, format_response
+
+SIZES_KB = [10, 25, 50, 100]
+CHUNK_CHARS = 40
+
+SENTENCES = [
+    "Người bị tiểu đường nên ưu tiên thực phẩm có chỉ số đường huyết thấp.",
+    "Phở bò cung cấp khoảng 350 kcal mỗi tô vừa, giàu đạm nhưng khá nhiều natri.",
+    "Uống đủ nước mỗi ngày giúp cơ thể trao đổi chất tốt hơn.",
+    "Nên kết hợp **rau xanh** với `đạm nạc` trong mỗi bữa ăn.",
+    "Hạn chế đồ chiên rán và nước ngọt có ga ✅",
+]
+ITEMS = ["rau muống luộc", "cá hồi áp chảo.", "đậu phụ", "gạo lứt", "trứng luộc", "sữa chua không đường"]
+HEADERS = ["Nên ăn:", "Hạn chế:", "Gợi ý bữa sáng:", "**Bạn nên:**", "Lưu ý:"]
+
+
+def legacy_prettify_text(raw: str) -> str:
+    """_prettify_text cũ"""
+    if not raw or not raw.strip():
+        return raw
+    s = raw
+    s = s.replace('**', '')
+    s = s.replace('`', '')
+    s = re.sub(r'[•*+\-✅❌]', '', s)
+    lines = [ln.strip() for ln in re.split(r'[\r\n]+', s) if ln.strip()]
+    if not lines:
+        return s.strip()
+    paragraphs = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.endswith(':') or re.search(r'^(Nên|Ưu|Hạn chế|Gợi ý|Gợi ý bữa|Bạn nên|Nên hạn chế)', line, re.I):
+            header = line.rstrip(':').strip()
+            items = []
+            j = i + 1
+            while j < len(lines) and not lines[j].endswith(':'):
+                items.append(lines[j].strip())
+                j += 1
+            if items:
+                clean_items = [re.sub(r'^[\-\*•\+\s]+', '', it).strip().rstrip('.') for it in items]
+                paragraphs.append(header + ': ' + ', '.join(clean_items) + '.')
+                i = j
+                continue
+        paragraphs.append(line)
+        i += 1
+    pretty = '\n\n'.join(paragraphs)
+    pretty = re.sub(r'\s{2,}', ' ', pretty)
+    return pretty.strip()
+
+
+def legacy_process_response(text: str) -> str:
+    """_process_response cũ"""
+    try:
+        parsed = json.loads(text)
+        parts = []
+        if isinstance(parsed, dict):
+            if parsed.get('title'):
+                parts.append(parsed.get('title').strip())
+                parts.append('')
+            if parsed.get('summary'):
+                parts.append(parsed.get('summary').strip())
+                parts.append('')
+            if parsed.get('bullets') and isinstance(parsed.get('bullets'), list):
+                bullets = [b.strip().rstrip('.') for b in parsed.get('bullets') if b]
+                if bullets:
+                    parts.append('Bạn nên: ' + ', '.join(bullets) + '.')
+                    parts.append('')
+            if parsed.get('meals') and isinstance(parsed.get('meals'), list):
+                parts.append('\n'.join([m.strip() for m in parsed.get('meals') if m]))
+                parts.append('')
+            if parsed.get('notes'):
+                parts.append('Ghi chú: ' + parsed.get('notes').strip())
+        pretty = '\n'.join([p for p in parts if p is not None and p != ''])
+        return pretty if pretty else legacy_prettify_text(text)
+    except:
+        return legacy_prettify_text(text)
+
+
+def make_text(size: int, rng: random.Random) -> str:
+    """Câu trả lời kiểu markdown: nửa đầu là đoạn văn, sau đó các khối header/bullet, cách nhau dòng trống"""
+    blocks = []
+    total = 0
+    while total < size // 2:
+        # Câu đầu không bắt đầu bằng "Nên/Hạn chế..." (sẽ thành header)
+        first = rng.choice(SENTENCES[:3])
+        block = " ".join([first] + [rng.choice(SENTENCES) for _ in range(rng.randint(0, 3))])
+        blocks.append(block)
+        total += len(block) + 2
+    while total < size:
+        bullets = "\n".join(f"{rng.choice('-*•')} {rng.choice(ITEMS)}" for _ in range(rng.randint(2, 6)))
+        block = f"{rng.choice(HEADERS)}\n{bullets}"
+        blocks.append(block)
+        total += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+def make_json(size: int, rng: random.Random) -> str:
+    bullets = []
+    while sum(len(b) for b in bullets) < size:
+        bullets.append(rng.choice(SENTENCES))
+    return json.dumps({"title": "Chế độ ăn", "summary": rng.choice(SENTENCES), "bullets": bullets,
+                       "meals": ["Sáng: phở", "Trưa: cơm gạo lứt"], "notes": "Tham khảo bác sĩ"}, ensure_ascii=False)
+
+
+def stream_format(text: str, chunk_chars: int = CHUNK_CHARS) -> str:
+    formatter = StreamFormatter()
+    deltas = []
+    for start in range(0, len(text), chunk_chars):
+        deltas.extend(formatter.feed(text[start:start + chunk_chars]))
+    deltas.extend(formatter.close())
+    return "".join(deltas)
+
+
+def measure(func, text: str) -> float:
+    """Thời gian mỗi lần format (ms), median của 7 lần chạy"""
+    runs = []
+    for _ in range(7):
+        start = time.perf_counter()
+        func(text)
+        runs.append((time.perf_counter() - start) * 1000)
+    return statistics.median(runs)
+
+
+if __name__ == "__main__":
+    rng = random.Random(11)
+    print("🧪 BENCHMARK: response formatting")
+    print("=" * 96)
+    for kind, make in (("text", make_text), ("json", make_json)):
+        for size_kb in SIZES_KB:
+            text = make(size_kb * 1024, rng)
+            expected = format_response(text)
+            legacy = legacy_process_response(text)
+            matches_legacy = expected == legacy
+            matches_stream = stream_format(text) == expected
+            legacy_ms = measure(legacy_process_response, text)
+            new_ms = measure(format_response, text)
+            stream_ms = measure(stream_format, text)
+            print(f"{kind:<4} {size_kb:>4} KB   legacy {legacy_ms:8.2f} ms   formatter {new_ms:7.2f} ms "
+                  f"({legacy_ms / new_ms:5.1f}x)   stream {stream_ms:7.2f} ms   "
+                  f"same as legacy: {matches_legacy}, stream: {matches_stream}")
+    print("=" * 96)
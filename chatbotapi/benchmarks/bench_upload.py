@@ -0,0 +1,111 @@
+"""
+Benchmark: peak RSS khi xử lý 50 upload 8 MB đồng thời
+- "naive": cách cũ (await file.read() / request.json() + b64decode + BytesIO)
+- "streaming": upload_handler (spool theo chunk + SHA256 tăng dần, base64 decode theo khối)
+
+Mỗi mode chạy trong subprocess riêng để đo ru_maxrss độc lập
+
+    python -m benchmarks.bench_upload
+"""
+import asyncio
+import base64
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+
+CONCURRENT_UPLOADS = 50
+UPLOAD_BYTES = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Thời gian giữ upload (giả lập phân tích) để các request thực sự chồng nhau
+HOLD_SECONDS = 0.5
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def multipart_chunks():
+    """Giả lập body multipart đến theo chunk từ socket"""
+    chunk = os.urandom(CHUNK_SIZE)
+    for _ in range(UPLOAD_BYTES // CHUNK_SIZE):
+        await asyncio.sleep(0)
+        yield chunk
+
+async def json_chunks():
+    """Giả lập JSON body {"filename": ..., "image": "<base64>"} đến theo chunk"""
+    encoded = base64.b64encode(os.urandom(CHUNK_SIZE * 3)).decode()
+    yield b'{"filename": "pho-bo.jpg", "image": "'
+    for _ in range(UPLOAD_BYTES // (CHUNK_SIZE * 3)):
+        await asyncio.sleep(0)
+        yield encoded.encode()
+    yield b'"}'
+
+async def naive_multipart():
+    body = b"".join([chunk async for chunk in multipart_chunks()])
+    image = io.BytesIO(body)
+    await asyncio.sleep(HOLD_SECONDS)
+    return len(image.getvalue())
+
+async def naive_json():
+    raw = b"".join([chunk async for chunk in json_chunks()])
+    body = json.loads(raw)
+    image_data = base64.b64decode(body["image"])
+    image = io.BytesIO(image_data)
+    await asyncio.sleep(HOLD_SECONDS)
+    return len(image.getvalue())
+
+async def streaming_multipart():
+    from upload_handler import spool_stream
+    with await spool_stream(multipart_chunks(), max_bytes=UPLOAD_BYTES) as upload:
+        await asyncio.sleep(HOLD_SECONDS)
+        return upload.size
+
+async def streaming_json():
+    from upload_handler import spool_base64
+    body = bytearray()
+    async for chunk in json_chunks():
+        body.extend(chunk)
+    payload = json.loads(body)
+    del body
+    upload = await spool_base64(payload.pop("image"), max_bytes=UPLOAD_BYTES)
+    with upload:
+        await asyncio.sleep(HOLD_SECONDS)
+        return upload.size
+
+MODES = {
+    "naive-multipart": naive_multipart,
+    "streaming-multipart": streaming_multipart,
+    "naive-json": naive_json,
+    "streaming-json": streaming_json,
+}
+
+def run_child(mode: str):
+    """Chạy trong subprocess: xử lý N upload đồng thời, in baseline và peak RSS"""
+    if mode.startswith("streaming"):
+        import upload_handler  # noqa: F401  (import trước khi đo baseline)
+    baseline = peak_rss_mb()
+
+    async def main():
+        await asyncio.gather(*[MODES[mode]() for _ in range(CONCURRENT_UPLOADS)])
+
+    asyncio.run(main())
+    print(json.dumps({"baseline_mb": baseline, "peak_mb": peak_rss_mb()}))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        run_child(sys.argv[2])
+        sys.exit(0)
+
+    print(f"🧪 BENCHMARK: peak RSS, {CONCURRENT_UPLOADS} concurrent uploads x {UPLOAD_BYTES // (1024 * 1024)} MB")
+    print("=" * 60)
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_upload", "--child", mode],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip().splitlines()[-1]
+        result = json.loads(output)
+        delta = result["peak_mb"] - result["baseline_mb"]
+        print(f"{mode:<22} peak RSS: {result['peak_mb']:8.1f} MB   (+{delta:.1f} MB over baseline)")
+    print("=" * 60)
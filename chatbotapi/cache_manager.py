@@ -1,26 +1,341 @@
+import asyncio
+import functools
 import hashlib
 import json
+import os
 import sqlite3
+import threading
 import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Awaitable, Callable, Optional, Dict
+
+from perceptual_index import PHASH_MAX_DISTANCE, PerceptualHashIndex, is_degenerate_phash
+from tracing import bind_context, span
+
+
+def json_default(obj):
+    """json.dumps default: Mapping read-only (MappingProxyType của catalogue mock) → dict"""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# SQL dùng lại nguyên văn để sqlite3 statement cache (per connection) tái sử dụng prepared statement
+_SELECT_ENTRY_SQL = """
+    SELECT analysis_result, created_at, access_count
+    FROM analysis_cache
+    WHERE image_hash = ?
+"""
+_UPSERT_ENTRY_SQL = """
+    INSERT INTO analysis_cache 
+    (image_hash, analysis_result, created_at, accessed_at, access_count, perceptual_hash)
+    VALUES (?, ?, ?, ?, 1, ?)
+    ON CONFLICT(image_hash) DO UPDATE SET
+        analysis_result = excluded.analysis_result,
+        created_at = excluded.created_at,
+        accessed_at = excluded.accessed_at,
+        access_count = 1,
+        perceptual_hash = COALESCE(excluded.perceptual_hash, perceptual_hash)
+"""
+# Nạp perceptual hash vào index Hamming trong memory khi khởi động
+_SELECT_PERCEPTUAL_HASHES_SQL = """
+    SELECT image_hash, perceptual_hash FROM analysis_cache
+    WHERE perceptual_hash IS NOT NULL
+"""
+_DELETE_ENTRY_SQL = "DELETE FROM analysis_cache WHERE image_hash = ?"
+# Eviction theo batch: chọn key qua index (idx_created_at / idx_accessed_at), xóa từng batch nhỏ
+_SELECT_EXPIRED_BATCH_SQL = """
+    SELECT image_hash FROM analysis_cache
+    WHERE created_at < ?
+    ORDER BY created_at
+    LIMIT ?
+"""
+_SELECT_LRU_BATCH_SQL = """
+    SELECT image_hash FROM analysis_cache
+    ORDER BY accessed_at
+    LIMIT ?
+"""
+_ENTRY_COUNT_SQL = "SELECT total_entries FROM cache_counters WHERE id = 1"
+_COUNTERS_SQL = "SELECT total_entries, total_hits, total_bytes FROM cache_counters WHERE id = 1"
+_AGE_BUCKETS_SQL = "SELECT created_day, entries FROM cache_age_buckets WHERE entries > 0"
+_TOP_HASHES_SQL = """
+    SELECT image_hash, access_count
+    FROM analysis_cache
+    ORDER BY access_count DESC
+    LIMIT ?
+"""
+
+# Counters được trigger cập nhật trong cùng transaction với mỗi thay đổi của analysis_cache,
+# nên get_stats chỉ đọc 1 dòng thay vì COUNT/SUM/AVG trên cả bảng.
+# UPSERT (ON CONFLICT DO UPDATE) bắn trigger UPDATE, không phải DELETE + INSERT như REPLACE.
+# Không dùng INSERT OR IGNORE trong trigger: ON CONFLICT của statement ngoài sẽ override nó.
+_STATS_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS cache_counters (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_entries INTEGER NOT NULL,
+        total_hits INTEGER NOT NULL,
+        total_bytes INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS cache_age_buckets (
+        created_day INTEGER PRIMARY KEY,
+        entries INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_access_count ON analysis_cache(access_count);
+    
+    CREATE TRIGGER IF NOT EXISTS trg_cache_insert AFTER INSERT ON analysis_cache BEGIN
+        UPDATE cache_counters SET
+            total_entries = total_entries + 1,
+            total_hits = total_hits + NEW.access_count,
+            total_bytes = total_bytes + length(CAST(NEW.analysis_result AS BLOB))
+        WHERE id = 1;
+        INSERT INTO cache_age_buckets (created_day, entries)
+            SELECT NEW.created_at / 86400, 0
+            WHERE NOT EXISTS (SELECT 1 FROM cache_age_buckets WHERE created_day = NEW.created_at / 86400);
+        UPDATE cache_age_buckets SET entries = entries + 1 WHERE created_day = NEW.created_at / 86400;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS trg_cache_delete AFTER DELETE ON analysis_cache BEGIN
+        UPDATE cache_counters SET
+            total_entries = total_entries - 1,
+            total_hits = total_hits - OLD.access_count,
+            total_bytes = total_bytes - length(CAST(OLD.analysis_result AS BLOB))
+        WHERE id = 1;
+        UPDATE cache_age_buckets SET entries = entries - 1 WHERE created_day = OLD.created_at / 86400;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS trg_cache_update_hits AFTER UPDATE OF access_count ON analysis_cache BEGIN
+        UPDATE cache_counters SET total_hits = total_hits + NEW.access_count - OLD.access_count WHERE id = 1;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS trg_cache_update_result AFTER UPDATE OF analysis_result ON analysis_cache BEGIN
+        UPDATE cache_counters SET total_bytes = total_bytes
+            + length(CAST(NEW.analysis_result AS BLOB)) - length(CAST(OLD.analysis_result AS BLOB))
+        WHERE id = 1;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS trg_cache_update_created AFTER UPDATE OF created_at ON analysis_cache BEGIN
+        UPDATE cache_age_buckets SET entries = entries - 1 WHERE created_day = OLD.created_at / 86400;
+        INSERT INTO cache_age_buckets (created_day, entries)
+            SELECT NEW.created_at / 86400, 0
+            WHERE NOT EXISTS (SELECT 1 FROM cache_age_buckets WHERE created_day = NEW.created_at / 86400);
+        UPDATE cache_age_buckets SET entries = entries + 1 WHERE created_day = NEW.created_at / 86400;
+    END;
+"""
+
+# Seed counters một lần (DB cũ chưa có bảng counters) - full scan duy nhất
+_SEED_COUNTERS_SQL = """
+    INSERT OR IGNORE INTO cache_counters (id, total_entries, total_hits, total_bytes)
+    SELECT 1, COUNT(*), COALESCE(SUM(access_count), 0),
+           COALESCE(SUM(length(CAST(analysis_result AS BLOB))), 0)
+    FROM analysis_cache
+"""
+_SEED_AGE_BUCKETS_SQL = """
+    INSERT INTO cache_age_buckets (created_day, entries)
+    SELECT created_at / 86400, COUNT(*) FROM analysis_cache GROUP BY created_at / 86400
+"""
+
+# Entry-age histogram: (nhãn, tuổi tối thiểu theo ngày)
+_AGE_HISTOGRAM_BUCKETS = [("<1d", 0), ("1-7d", 1), ("7-30d", 7), (">=30d", 30)]
+# Sliding window cho hit ratio (giây)
+_HIT_RATIO_WINDOWS = {"1m": 60, "5m": 300, "15m": 900}
+
+_FLUSH_ACCESS_SQL = """
+    UPDATE analysis_cache
+    SET accessed_at = MAX(accessed_at, ?), access_count = access_count + ?
+    WHERE image_hash = ?
+"""
+
+class _MemoryLRU:
+    """
+    L1 cache trong process: giữ kết quả đã parse, giới hạn theo số entry và tổng bytes
+    (bytes ước lượng bằng độ dài JSON đã lưu ở L2)
+    """
+    
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # hash -> (result, created_at, size)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, image_hash: str) -> Optional[tuple]:
+        """Trả về (result, created_at) và đánh dấu most-recently-used"""
+        with self._lock:
+            entry = self._entries.get(image_hash)
+            if entry is None:
+                return None
+            self._entries.move_to_end(image_hash)
+            return entry[0], entry[1]
+    
+    def put(self, image_hash: str, result: Dict, created_at: int, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(image_hash, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            self._entries[image_hash] = (result, created_at, size)
+            self.total_bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+    
+    def discard(self, image_hash: str):
+        with self._lock:
+            old = self._entries.pop(image_hash, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+    
+    def discard_older_than(self, cutoff_time: int):
+        """Bỏ các entry có created_at < cutoff_time"""
+        with self._lock:
+            expired = [h for h, (_, created_at, _) in self._entries.items() if created_at < cutoff_time]
+            for image_hash in expired:
+                self.total_bytes -= self._entries.pop(image_hash)[2]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+class _HitWindow:
+    """
+    Đếm hit/miss theo từng giây trong ring buffer cố định, dùng để tính
+    hit ratio trên các sliding window (1m/5m/15m) mà không cần lưu từng request
+    """
+    
+    def __init__(self, span_seconds: int = 900):
+        self.span = span_seconds
+        self._seconds = [0] * span_seconds
+        self._hits = [0] * span_seconds
+        self._misses = [0] * span_seconds
+        self._lock = threading.Lock()
+    
+    def record(self, hit: bool):
+        now = int(time.time())
+        slot = now % self.span
+        with self._lock:
+            if self._seconds[slot] != now:
+                self._seconds[slot] = now
+                self._hits[slot] = 0
+                self._misses[slot] = 0
+            if hit:
+                self._hits[slot] += 1
+            else:
+                self._misses[slot] += 1
+    
+    def ratio(self, window_seconds: int) -> Dict:
+        now = int(time.time())
+        hits = misses = 0
+        with self._lock:
+            for slot in range(self.span):
+                if now - self._seconds[slot] < window_seconds:
+                    hits += self._hits[slot]
+                    misses += self._misses[slot]
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else 0.0
+        }
 
 class ImageAnalysisCache:
     """
     Cache manager cho AI image analysis results
-    - Sử dụng SHA256 hash của image bytes làm key
-    - Lưu vào SQLite database
-    - TTL: 30 days (có thể customize)
+    - Sử dụng SHA256 hash của image bytes làm key, kèm dHash (perceptual_hash) để
+      ảnh gần giống nhau dùng chung kết quả (index Hamming trong memory, bán kính phash_max_distance)
+    - Lưu vào SQLite database (WAL mode, synchronous=NORMAL, mmap)
+    - Mỗi thread giữ một connection riêng, không mở/đóng connection mỗi lần gọi
+    - access_count/accessed_at được gom lại và flush định kỳ thay vì commit mỗi lần HIT
+    - Async façade (aget/aset/astats/acleanup) chạy SQLite trên executor riêng
+      để không block event loop của FastAPI
+    - Hai tầng: L1 LRU trong memory (kết quả đã parse) → L2 SQLite
+      Kết quả trả về từ L1 là object dùng chung, caller không được sửa trực tiếp
+    - TTL: 30 days (có thể customize). get() chỉ đọc; entry hết hạn được background
+      eviction worker xóa theo batch nhỏ, kèm giới hạn số entry (LRU theo accessed_at)
     """
     
-    def __init__(self, db_path: str = "ai_analysis_cache.db", ttl_days: int = 30):
+    def __init__(self, db_path: str = "ai_analysis_cache.db", ttl_days: int = 30,
+                 mmap_size: int = 64 * 1024 * 1024, flush_interval: float = 5.0,
+                 flush_batch_size: int = 256, io_workers: int = 4,
+                 l1_max_entries: int = 512, l1_max_bytes: int = 16 * 1024 * 1024,
+                 max_entries: Optional[int] = None, eviction_interval: float = 60.0,
+                 eviction_batch_size: int = 500, eviction_pause: float = 0.01,
+                 phash_max_distance: int = PHASH_MAX_DISTANCE):
         self.db_path = db_path
         self.ttl_seconds = ttl_days * 24 * 3600
+        self.mmap_size = mmap_size
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.max_entries = max_entries
+        self.eviction_interval = eviction_interval
+        self.eviction_batch_size = eviction_batch_size
+        self.eviction_pause = eviction_pause
+        
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        
+        # image_hash -> [last accessed_at, số lần HIT chưa flush]
+        self._pending_access: Dict[str, list] = {}
+        self._pending_lock = threading.Lock()
+        
+        # Executor riêng cho async façade + các lookup đang chạy (coalesce theo hash)
+        self._io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="cache-io")
+        self._inflight_gets: Dict[str, asyncio.Task] = {}
+        # Single-flight: các upload giống hệt nhau đang chờ chung một lần phân tích
+        self._inflight_computes: Dict[str, asyncio.Task] = {}
+        
+        # L1 in-process LRU + hit/miss counters cho từng tầng
+        self._l1 = _MemoryLRU(l1_max_entries, l1_max_bytes)
+        self._counter_lock = threading.Lock()
+        self.l1_hits = 0
+        self.l1_misses = 0
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self._hit_window = _HitWindow(max(_HIT_RATIO_WINDOWS.values()))
+        
+        # perceptual hash → image_hash, tìm theo khoảng cách Hamming
+        self._phash_index = PerceptualHashIndex(phash_max_distance)
+        
         self._init_db()
         
+        self._stop_event = threading.Event()
+        self._flush_thread = threading.Thread(
+            target=self._flush_loop, name="cache-access-flush", daemon=True
+        )
+        self._flush_thread.start()
+        self._eviction_thread = threading.Thread(
+            target=self._eviction_loop, name="cache-eviction", daemon=True
+        )
+        self._eviction_thread.start()
+        self._phash_load_thread = threading.Thread(
+            target=self._load_perceptual_index, name="cache-phash-load", daemon=True
+        )
+        self._phash_load_thread.start()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Connection của thread hiện tại (tạo một lần, cấu hình PRAGMA)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+        
     def _init_db(self):
         """Khởi tạo database và table"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -29,20 +344,49 @@ class ImageAnalysisCache:
                 analysis_result TEXT NOT NULL,
                 created_at INTEGER NOT NULL,
                 accessed_at INTEGER NOT NULL,
-                access_count INTEGER DEFAULT 1
+                access_count INTEGER DEFAULT 1,
+                perceptual_hash TEXT
             )
         """)
         
+        # DB cũ chưa có cột perceptual_hash
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(analysis_cache)")}
+        if "perceptual_hash" not in columns:
+            cursor.execute("ALTER TABLE analysis_cache ADD COLUMN perceptual_hash TEXT")
+        
         # Index for cleanup
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_created_at 
             ON analysis_cache(created_at)
         """)
         
+        # Index cho LRU eviction
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_accessed_at 
+            ON analysis_cache(accessed_at)
+        """)
         conn.commit()
-        conn.close()
         
-        print(f"✅ Cache database initialized at {self.db_path}")
+        # Counters + triggers cho get_stats O(1); seed trong cùng transaction để không lệch số
+        has_counters = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cache_counters'"
+        ).fetchone()
+        if not has_counters:
+            conn.executescript("BEGIN IMMEDIATE;" + _STATS_SCHEMA_SQL + _SEED_COUNTERS_SQL + ";"
+                               + _SEED_AGE_BUCKETS_SQL + "; COMMIT;")
+        else:
+            conn.executescript(_STATS_SCHEMA_SQL)
+        
+        print(f"✅ Cache database initialized at {self.db_path} (WAL mode)")
+    
+    def _load_perceptual_index(self):
+        """Background thread: nạp perceptual hash từ SQLite vào index (cache lớn mất vài giây)"""
+        try:
+            start_time = time.perf_counter()
+            loaded = self._phash_index.bulk_load(self._connect().execute(_SELECT_PERCEPTUAL_HASHES_SQL))
+            print(f"🖼️  Indexed {loaded} perceptual hashes in {time.perf_counter() - start_time:.2f}s")
+        except Exception as e:
+            print(f"⚠️  Perceptual hash index load failed: {e}")
     
     def _compute_hash(self, image_bytes: bytes) -> str:
         """Tính SHA256 hash của image"""
@@ -55,49 +399,141 @@ class ImageAnalysisCache:
         Returns:
             Dict với analysis result hoặc None nếu cache miss
         """
-        image_hash = self._compute_hash(image_bytes)
+        return self.get_by_hash(self._compute_hash(image_bytes))
+    
+    def get_by_hash(self, image_hash: str) -> Optional[Dict]:
+        """Lấy cached result theo SHA256 hash đã tính sẵn (L1 trước, rồi L2)"""
+        with span("image_cache.get", **{"image.hash": image_hash[:16]}) as s:
+            result, outcome = self._lookup(image_hash)
+            s.set_attribute("cache.result", outcome)
+            return result
+    
+    def _lookup(self, image_hash: str) -> tuple:
+        """Tra L1 rồi L2, trả về (result, "l1_hit" | "l2_hit" | "miss" | "expired")"""
+        current_time = int(time.time())
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # L1: kết quả đã parse, không cần SQLite / json.loads
+        cached = self._l1.get(image_hash)
+        if cached is not None:
+            result, created_at = cached
+            if current_time - created_at <= self.ttl_seconds:
+                self._record_access(image_hash, current_time)
+                with self._counter_lock:
+                    self.l1_hits += 1
+                self._hit_window.record(True)
+                print(f"✅ Cache HIT (L1) for hash: {image_hash[:16]}...")
+                return result, "l1_hit"
+            self._l1.discard(image_hash)
         
-        cursor.execute("""
-            SELECT analysis_result, created_at, access_count
-            FROM analysis_cache
-            WHERE image_hash = ?
-        """, (image_hash,))
+        with self._counter_lock:
+            self.l1_misses += 1
         
-        row = cursor.fetchone()
+        conn = self._connect()
+        row = conn.execute(_SELECT_ENTRY_SQL, (image_hash,)).fetchone()
         
         if row is None:
-            conn.close()
+            with self._counter_lock:
+                self.l2_misses += 1
+            self._hit_window.record(False)
             print(f"❌ Cache MISS for hash: {image_hash[:16]}...")
-            return None
+            return None, "miss"
         
         analysis_json, created_at, access_count = row
-        current_time = int(time.time())
         
-        # Check TTL
+        # Check TTL (read-only: eviction worker sẽ xóa entry hết hạn)
         if current_time - created_at > self.ttl_seconds:
-            # Expired - delete and return None
-            cursor.execute("DELETE FROM analysis_cache WHERE image_hash = ?", (image_hash,))
-            conn.commit()
-            conn.close()
+            with self._counter_lock:
+                self.l2_misses += 1
+            self._hit_window.record(False)
             print(f"⏰ Cache EXPIRED for hash: {image_hash[:16]}...")
-            return None
+            return None, "expired"
         
-        # Update access stats
-        cursor.execute("""
-            UPDATE analysis_cache
-            SET accessed_at = ?, access_count = ?
-            WHERE image_hash = ?
-        """, (current_time, access_count + 1, image_hash))
+        # Update access stats: chỉ ghi vào buffer, flush theo batch
+        pending_count = self._record_access(image_hash, current_time)
+        with self._counter_lock:
+            self.l2_hits += 1
+        self._hit_window.record(True)
+        
+        print(f"✅ Cache HIT (L2) for hash: {image_hash[:16]}... (accessed {access_count + pending_count} times)")
+        
+        # Promote lên L1
+        result = json.loads(analysis_json)
+        self._l1.put(image_hash, result, created_at, len(analysis_json))
+        return result, "l2_hit"
+    
+    def _record_access(self, image_hash: str, accessed_at: int) -> int:
+        """Ghi nhận một lần HIT vào buffer; flush ngay nếu buffer đầy"""
+        with self._pending_lock:
+            pending = self._pending_access.get(image_hash)
+            if pending is None:
+                pending = self._pending_access[image_hash] = [accessed_at, 0]
+            pending[0] = accessed_at
+            pending[1] += 1
+            pending_count = pending[1]
+            should_flush = len(self._pending_access) >= self.flush_batch_size
+        
+        if should_flush:
+            self.flush_access_stats()
+        return pending_count
+    
+    def flush_access_stats(self) -> int:
+        """
+        Ghi các access_count/accessed_at đang chờ xuống SQLite trong một transaction
+        
+        Returns:
+            Số entry được cập nhật
+        """
+        with self._pending_lock:
+            if not self._pending_access:
+                return 0
+            pending = self._pending_access
+            self._pending_access = {}
         
+        conn = self._connect()
+        conn.executemany(
+            _FLUSH_ACCESS_SQL,
+            [(accessed_at, count, image_hash) for image_hash, (accessed_at, count) in pending.items()]
+        )
         conn.commit()
-        conn.close()
+        return len(pending)
+    
+    def _flush_loop(self):
+        """Background thread: flush access stats định kỳ"""
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush_access_stats()
+            except Exception as e:
+                print(f"⚠️  Cache access flush failed: {e}")
+    
+    def get_by_perceptual_hash(self, perceptual_hash: str, max_distance: Optional[int] = None) -> Optional[Dict]:
+        """
+        Lấy cached result của ảnh gần giống (VD cùng ảnh nhưng re-compress/resize)
         
-        print(f"✅ Cache HIT for hash: {image_hash[:16]}... (accessed {access_count + 1} times)")
+        Args:
+            perceptual_hash: dHash hex của ảnh đã chuẩn hóa
+            max_distance: Khoảng cách Hamming tối đa (mặc định phash_max_distance)
         
-        return json.loads(analysis_json)
+        Returns:
+            Dict với analysis result hoặc None nếu không có ảnh nào đủ gần
+        """
+        with span("image_cache.get_perceptual", **{"image.dhash": perceptual_hash}) as s:
+            if is_degenerate_phash(perceptual_hash):
+                # Ảnh phẳng / ít texture: dHash không phân biệt được ảnh → chỉ tra theo SHA256
+                s.set_attribute("cache.result", "skipped")
+                return None
+            match = self._phash_index.nearest(perceptual_hash, max_distance)
+            if match is None:
+                s.set_attribute("cache.result", "miss")
+                return None
+            image_hash, distance = match
+            s.set_attribute("phash.distance", distance)
+            print(f"🖼️  Perceptual match {perceptual_hash} (distance {distance}) → hash: {image_hash[:16]}...")
+            result = self.get_by_hash(image_hash)
+            if result is None:
+                # Entry đã bị xóa/hết hạn trong lúc index đang nạp
+                self._phash_index.discard(image_hash)
+            s.set_attribute("cache.result", "miss" if result is None else "hit")
+            return result
     
     def set(self, image_bytes: bytes, analysis_result: Dict):
         """
@@ -107,78 +543,290 @@ class ImageAnalysisCache:
             image_bytes: Raw image bytes
             analysis_result: Dict result từ AI analysis
         """
-        image_hash = self._compute_hash(image_bytes)
-        analysis_json = json.dumps(analysis_result, ensure_ascii=False)
-        current_time = int(time.time())
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT OR REPLACE INTO analysis_cache 
-            (image_hash, analysis_result, created_at, accessed_at, access_count)
-            VALUES (?, ?, ?, ?, 1)
-        """, (image_hash, analysis_json, current_time, current_time))
+        self.set_by_hash(self._compute_hash(image_bytes), analysis_result)
+    
+    def set_by_hash(self, image_hash: str, analysis_result: Dict, perceptual_hash: Optional[str] = None):
+        """
+        Lưu analysis result theo SHA256 hash đã tính sẵn
         
-        conn.commit()
-        conn.close()
+        Args:
+            perceptual_hash: dHash của ảnh đã chuẩn hóa (để ảnh gần giống dùng chung kết quả);
+                hash suy biến (ảnh phẳng / ít texture) không được lưu
+        """
+        if perceptual_hash is not None and is_degenerate_phash(perceptual_hash):
+            perceptual_hash = None
+        with span("image_cache.set", **{"image.hash": image_hash[:16]}) as s:
+            analysis_json = json.dumps(analysis_result, ensure_ascii=False, default=json_default)
+            current_time = int(time.time())
+            s.set_attribute("cache.entry_bytes", len(analysis_json))
+            
+            conn = self._connect()
+            conn.execute(_UPSERT_ENTRY_SQL, (image_hash, analysis_json, current_time, current_time, perceptual_hash))
+            conn.commit()
+            
+            # Entry mới có access_count = 1, bỏ các HIT cũ còn chờ flush
+            with self._pending_lock:
+                self._pending_access.pop(image_hash, None)
+            
+            # Write-through L1
+            self._l1.put(image_hash, analysis_result, current_time, len(analysis_json))
+            if perceptual_hash is not None:
+                self._phash_index.add(image_hash, perceptual_hash)
         
         print(f"💾 Cached result for hash: {image_hash[:16]}...")
     
     def cleanup_old_entries(self, days_to_keep: int = 30):
         """
-        Xóa các entries cũ hơn X days
+        Xóa các entries cũ hơn X days (theo batch, không lock DB lâu)
         
         Args:
             days_to_keep: Số ngày giữ lại
         """
         cutoff_time = int(time.time()) - (days_to_keep * 24 * 3600)
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            DELETE FROM analysis_cache
-            WHERE created_at < ?
-        """, (cutoff_time,))
-        
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
+        self._l1.discard_older_than(cutoff_time)
+        deleted_count = self._delete_in_batches(_SELECT_EXPIRED_BATCH_SQL, (cutoff_time,))
         
         print(f"🗑️ Cleaned up {deleted_count} old cache entries")
         return deleted_count
     
-    def get_stats(self) -> Dict:
-        """Lấy thống kê cache"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _delete_batch(self, image_hashes: list):
+        """Xóa một batch entry theo key trong một transaction ngắn"""
+        conn = self._connect()
+        conn.executemany(_DELETE_ENTRY_SQL, [(image_hash,) for image_hash in image_hashes])
+        conn.commit()
+        with self._pending_lock:
+            for image_hash in image_hashes:
+                self._pending_access.pop(image_hash, None)
+        for image_hash in image_hashes:
+            self._l1.discard(image_hash)
+            self._phash_index.discard(image_hash)
+    
+    def _delete_in_batches(self, select_sql: str, params: tuple, max_rows: Optional[int] = None) -> int:
+        """
+        Chọn tối đa eviction_batch_size key bằng select_sql (index-backed) rồi xóa,
+        lặp lại tới khi hết hoặc đủ max_rows. Nghỉ ngắn giữa các batch để writer khác chen vào
+        """
+        conn = self._connect()
+        deleted = 0
+        while max_rows is None or deleted < max_rows:
+            limit = self.eviction_batch_size
+            if max_rows is not None:
+                limit = min(limit, max_rows - deleted)
+            image_hashes = [row[0] for row in conn.execute(select_sql, params + (limit,))]
+            if not image_hashes:
+                break
+            self._delete_batch(image_hashes)
+            deleted += len(image_hashes)
+            if len(image_hashes) < limit or self._stop_event.wait(self.eviction_pause):
+                break
         
-        cursor.execute("SELECT COUNT(*) FROM analysis_cache")
-        total_entries = cursor.fetchone()[0]
+        if deleted:
+            conn.execute("DELETE FROM cache_age_buckets WHERE entries <= 0")
+            conn.commit()
+        return deleted
+    
+    def evict_expired(self) -> int:
+        """Xóa các entry quá TTL theo batch"""
+        cutoff_time = int(time.time()) - self.ttl_seconds
+        return self._delete_in_batches(_SELECT_EXPIRED_BATCH_SQL, (cutoff_time,))
+    
+    def enforce_size_cap(self) -> int:
+        """Nếu số entry vượt max_entries → xóa entry ít được truy cập gần đây nhất (LRU)"""
+        if not self.max_entries:
+            return 0
+        conn = self._connect()
+        total_entries = conn.execute(_ENTRY_COUNT_SQL).fetchone()[0]
+        excess = total_entries - self.max_entries
+        if excess <= 0:
+            return 0
+        # accessed_at phải mới nhất trước khi chọn LRU
+        self.flush_access_stats()
+        return self._delete_in_batches(_SELECT_LRU_BATCH_SQL, (), max_rows=excess)
+    
+    def _eviction_loop(self):
+        """Background thread: TTL eviction + size cap định kỳ"""
+        while not self._stop_event.wait(self.eviction_interval):
+            try:
+                expired = self.evict_expired()
+                evicted = self.enforce_size_cap()
+                if expired or evicted:
+                    print(f"🗑️ Cache eviction: {expired} expired, {evicted} over size cap")
+            except Exception as e:
+                print(f"⚠️  Cache eviction failed: {e}")
+    
+    def get_stats(self, top_n: int = 10) -> Dict:
+        """
+        Lấy thống kê cache - O(1) theo kích thước bảng:
+        counters do trigger duy trì, histogram tuổi theo ngày tạo, top-N dùng idx_access_count
+        """
+        self.flush_access_stats()
         
-        cursor.execute("SELECT SUM(access_count) FROM analysis_cache")
-        total_hits = cursor.fetchone()[0] or 0
+        conn = self._connect()
+        total_entries, total_hits, total_bytes = conn.execute(_COUNTERS_SQL).fetchone()
+        avg_hits = total_hits / total_entries if total_entries else 0
         
-        cursor.execute("SELECT AVG(access_count) FROM analysis_cache")
-        avg_hits = cursor.fetchone()[0] or 0
+        # Entry-age histogram từ số entry theo ngày tạo (tối đa ~TTL dòng)
+        today = int(time.time()) // 86400
+        age_histogram = {label: 0 for label, _ in _AGE_HISTOGRAM_BUCKETS}
+        for created_day, entries in conn.execute(_AGE_BUCKETS_SQL):
+            age_days = today - created_day
+            label = _AGE_HISTOGRAM_BUCKETS[0][0]
+            for bucket_label, min_age in _AGE_HISTOGRAM_BUCKETS:
+                if age_days >= min_age:
+                    label = bucket_label
+            age_histogram[label] += entries
         
-        conn.close()
+        top_hashes = [
+            {"image_hash": image_hash, "access_count": access_count}
+            for image_hash, access_count in conn.execute(_TOP_HASHES_SQL, (top_n,))
+        ]
+        
+        with self._counter_lock:
+            l1_hits, l1_misses = self.l1_hits, self.l1_misses
+            l2_hits, l2_misses = self.l2_hits, self.l2_misses
         
         return {
             "total_entries": total_entries,
             "total_cache_hits": total_hits,
-            "average_hits_per_entry": round(avg_hits, 2)
+            "average_hits_per_entry": round(avg_hits, 2),
+            "bytes_stored": total_bytes,
+            "hit_ratio_windows": {
+                label: self._hit_window.ratio(seconds) for label, seconds in _HIT_RATIO_WINDOWS.items()
+            },
+            "entry_age_histogram": age_histogram,
+            "top_hashes": top_hashes,
+            "l1": {
+                "entries": len(self._l1),
+                "bytes": self._l1.total_bytes,
+                "hits": l1_hits,
+                "misses": l1_misses,
+                "hit_rate": round(l1_hits / (l1_hits + l1_misses), 4) if l1_hits + l1_misses else 0.0
+            },
+            "l2": {
+                "hits": l2_hits,
+                "misses": l2_misses,
+                "hit_rate": round(l2_hits / (l2_hits + l2_misses), 4) if l2_hits + l2_misses else 0.0
+            }
         }
     
     def clear_all(self):
         """Xóa toàn bộ cache (dùng cho testing)"""
-        conn = sqlite3.connect(self.db_path)
+        with self._pending_lock:
+            self._pending_access.clear()
+        self._l1.clear()
+        self._phash_index.clear()
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM analysis_cache")
         conn.commit()
-        conn.close()
         print("🗑️ All cache cleared")
+    
+    # ------------------------------------------------------------------
+    # Async façade cho FastAPI handlers
+    # ------------------------------------------------------------------
+    async def _run_io(self, func, *args):
+        """Chạy blocking SQLite/hash work trên executor riêng của cache (mang theo trace context)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, bind_context(func, *args))
+    
+    async def ahash(self, image_bytes: bytes) -> str:
+        """Tính SHA256 trên executor (ảnh lớn không block event loop)"""
+        return await self._run_io(self._compute_hash, image_bytes)
+    
+    async def aget_or_compute_by_hash(self, image_hash: str,
+                                      compute: Callable[[], Awaitable[Dict]]) -> Dict:
+        """
+        Lấy kết quả từ cache, nếu MISS thì chạy compute() và lưu lại.
+        Các request đồng thời cùng hash chỉ chạy compute() một lần (single-flight);
+        compute chạy trong task riêng nên client đầu tiên ngắt kết nối không làm hỏng các request khác
+        """
+        result = await self.aget_by_hash(image_hash)
+        if result is not None:
+            return result
+        return await self.asingle_flight(image_hash, lambda: self._compute_and_store(image_hash, compute))
+    
+    async def asingle_flight(self, image_hash: str, compute: Callable[[], Awaitable[Dict]]) -> Dict:
+        """
+        Chạy compute() một lần cho mỗi hash đang xử lý, các request trùng hash chờ chung kết quả.
+        compute tự lưu kết quả (VD set_by_hash kèm perceptual_hash)
+        """
+        task = self._inflight_computes.get(image_hash)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._inflight_computes[image_hash] = task
+            task.add_done_callback(lambda _: self._inflight_computes.pop(image_hash, None))
+        else:
+            print(f"🔁 Coalesced in-flight analysis for hash: {image_hash[:16]}...")
+        return await asyncio.shield(task)
+    
+    async def _compute_and_store(self, image_hash: str, compute: Callable[[], Awaitable[Dict]]) -> Dict:
+        result = await compute()
+        await self.aset_by_hash(image_hash, result)
+        return result
+    
+    async def aget(self, image_bytes: bytes) -> Optional[Dict]:
+        """
+        Async get: các lookup đồng thời cho cùng một ảnh dùng chung một lần đọc SQLite
+        """
+        image_hash = await self._run_io(self._compute_hash, image_bytes)
+        return await self.aget_by_hash(image_hash)
+    
+    async def aget_by_hash(self, image_hash: str) -> Optional[Dict]:
+        """
+        Async get theo hash, coalesce các request trùng hash đang chạy.
+        Lookup chạy trong task riêng, mọi caller (kể cả caller đầu tiên) chờ qua shield:
+        caller bị huỷ (client ngắt kết nối) không làm các request khác nhận CancelledError
+        """
+        task = self._inflight_gets.get(image_hash)
+        if task is None:
+            task = asyncio.ensure_future(self._run_io(self.get_by_hash, image_hash))
+            self._inflight_gets[image_hash] = task
+            task.add_done_callback(functools.partial(self._inflight_get_done, image_hash))
+        return await asyncio.shield(task)
+    
+    def _inflight_get_done(self, image_hash: str, task: asyncio.Task):
+        self._inflight_gets.pop(image_hash, None)
+        if not task.cancelled():
+            # Mọi caller đã bị huỷ → không ai lấy exception, tránh warning "exception was never retrieved"
+            task.exception()
+    
+    async def aset(self, image_bytes: bytes, analysis_result: Dict):
+        """Async set"""
+        await self._run_io(self.set, image_bytes, analysis_result)
+    
+    async def aget_by_perceptual_hash(self, perceptual_hash: str, max_distance: Optional[int] = None) -> Optional[Dict]:
+        """Async get_by_perceptual_hash"""
+        return await self._run_io(self.get_by_perceptual_hash, perceptual_hash, max_distance)
+    
+    async def aset_by_hash(self, image_hash: str, analysis_result: Dict, perceptual_hash: Optional[str] = None):
+        """Async set theo hash"""
+        await self._run_io(self.set_by_hash, image_hash, analysis_result, perceptual_hash)
+    
+    async def astats(self, top_n: int = 10) -> Dict:
+        """Async get_stats"""
+        return await self._run_io(self.get_stats, top_n)
+    
+    async def acleanup_old_entries(self, days_to_keep: int = 30) -> int:
+        """Async cleanup_old_entries"""
+        return await self._run_io(self.cleanup_old_entries, days_to_keep)
+    
+    async def aclear_all(self):
+        """Async clear_all"""
+        await self._run_io(self.clear_all)
+    
+    def close(self):
+        """Dừng background flush, ghi nốt access stats và đóng mọi connection"""
+        self._io_executor.shutdown(wait=True)
+        self._stop_event.set()
+        self._flush_thread.join(timeout=self.flush_interval + 1)
+        self._eviction_thread.join(timeout=30)
+        self._phash_load_thread.join(timeout=30)
+        self.flush_access_stats()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
 
 
 # Singleton instance
@@ -188,5 +836,17 @@ def get_cache_instance(db_path: str = "ai_analysis_cache.db", ttl_days: int = 30
     """Get or create cache singleton"""
     global _cache_instance
     if _cache_instance is None:
-        _cache_instance = ImageAnalysisCache(db_path, ttl_days)
+        max_entries = int(os.getenv("CACHE_MAX_ENTRIES", "0")) or None
+        _cache_instance = ImageAnalysisCache(
+            db_path, ttl_days,
+            max_entries=max_entries,
+            eviction_interval=float(os.getenv("CACHE_EVICTION_INTERVAL", "60"))
+        )
     return _cache_instance
+
+def close_cache_instance():
+    """Đóng cache singleton (gọi khi server shutdown)"""
+    global _cache_instance
+    if _cache_instance is not None:
+        _cache_instance.close()
+        _cache_instance = None
@@ -0,0 +1,287 @@
+"""
+Circuit breaker cho LLM providers (theo provider và theo từng model)
+
+Trạng thái:
+    closed     gọi bình thường, kết quả được ghi vào cửa sổ trượt (rolling window)
+    open       tỉ lệ lỗi / tỉ lệ gọi chậm vượt ngưỡng → bỏ qua provider/model này
+               trong open_seconds (không tốn thời gian chờ một lỗi chắc chắn xảy ra)
+    half_open  hết open_seconds → cho tối đa half_open_max_calls request thử (probe);
+               probe thành công đủ số lần → closed, lỗi → open lại
+
+Cửa sổ trượt giữ window_size lần gọi gần nhất trong window_seconds giây.
+Độ trễ các lần thành công dùng để tính p95 (làm ngưỡng hedge request).
+
+Cấu hình bằng biến môi trường CIRCUIT_* (xem create_circuit_breaker_registry)
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Provider/model đang open-circuit, không gọi"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker cho một provider hoặc một model
+
+    Args:
+        name: VD "gemini", "gemini:gemini-1.5-flash", "openrouter"
+        failure_rate: Tỉ lệ lỗi trong cửa sổ để chuyển sang open
+        slow_call_seconds: Lần gọi lâu hơn ngưỡng này bị tính là chậm (0 = tắt)
+        slow_call_rate: Tỉ lệ gọi chậm trong cửa sổ để chuyển sang open
+        min_calls: Số lần gọi tối thiểu trong cửa sổ trước khi xét ngưỡng
+        window_size: Số lần gọi gần nhất được giữ lại
+        window_seconds: Bỏ các lần gọi cũ hơn khoảng này
+        open_seconds: Thời gian giữ trạng thái open trước khi half-open
+        half_open_max_calls: Số probe đồng thời / số lần thành công cần để đóng lại
+    """
+
+    def __init__(self, name: str, failure_rate: float = 0.5, slow_call_seconds: float = 30.0,
+                 slow_call_rate: float = 0.8, min_calls: int = 5, window_size: int = 100,
+                 window_seconds: float = 60.0, open_seconds: float = 30.0,
+                 half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_until = 0.0
+        # (timestamp, ok, slow, latency) — latency None khi không đo (VD streaming)
+        self._calls = deque(maxlen=window_size)
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh_state(time.monotonic())
+            return self._state
+
+    def _refresh_state(self, now: float):
+        """open → half_open khi hết open_seconds (gọi khi đang giữ lock)"""
+        if self._state == OPEN and now >= self._opened_until:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+    def _prune(self, now: float):
+        cutoff = now - self.window_seconds
+        calls = self._calls
+        while calls and calls[0][0] < cutoff:
+            calls.popleft()
+
+    def _trip(self, now: float):
+        self._state = OPEN
+        self._opened_until = now + self.open_seconds
+        self.times_opened += 1
+        print(f"🔌 Circuit OPEN: {self.name} (skip {self.open_seconds:g}s)")
+
+    def is_available(self) -> bool:
+        """Có thể gọi không (không giữ chỗ probe)"""
+        with self._lock:
+            self._refresh_state(time.monotonic())
+            if self._state == CLOSED:
+                return True
+            return self._state == HALF_OPEN and self._probes_in_flight < self.half_open_max_calls
+
+    def acquire(self) -> Optional[bool]:
+        """
+        Xin phép gọi
+
+        Returns:
+            None nếu đang open (không được gọi), False nếu gọi bình thường,
+            True nếu đây là probe của trạng thái half-open
+        """
+        with self._lock:
+            self._refresh_state(time.monotonic())
+            if self._state == CLOSED:
+                return False
+            if self._state == HALF_OPEN and self._probes_in_flight < self.half_open_max_calls:
+                self._probes_in_flight += 1
+                return True
+            return None
+
+    def record(self, ok: bool, latency: Optional[float] = None, probe: bool = False):
+        """Ghi kết quả một lần gọi đã acquire"""
+        now = time.monotonic()
+        slow = bool(latency is not None and self.slow_call_seconds and latency >= self.slow_call_seconds)
+        with self._lock:
+            self._refresh_state(now)
+            self._calls.append((now, ok, slow, latency if ok else None))
+
+            if self._state == HALF_OPEN:
+                # Chỉ probe mới quyết định đóng/mở lại
+                if not probe:
+                    return
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if not ok or slow:
+                    self._trip(now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_max_calls:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    print(f"🔌 Circuit CLOSED: {self.name}")
+                return
+
+            if self._state == CLOSED:
+                self._prune(now)
+                total = len(self._calls)
+                if total < self.min_calls:
+                    return
+                failures = sum(1 for call in self._calls if not call[1])
+                slow_calls = sum(1 for call in self._calls if call[2])
+                if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+                    self._trip(now)
+
+    def release(self, probe: bool = False):
+        """Trả lại quyền gọi mà không ghi kết quả (request bị huỷ, lỗi không do provider)"""
+        if not probe:
+            return
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def latency_percentile(self, percentile: float, min_samples: int = 1) -> Optional[float]:
+        """Percentile độ trễ các lần thành công trong cửa sổ (None nếu chưa đủ mẫu)"""
+        with self._lock:
+            self._prune(time.monotonic())
+            latencies = sorted(call[3] for call in self._calls if call[3] is not None)
+        if len(latencies) < max(1, min_samples):
+            return None
+        rank = max(0, math.ceil(percentile / 100 * len(latencies)) - 1)
+        return latencies[rank]
+
+    def snapshot(self) -> dict:
+        """Trạng thái hiện tại (cho /health và debug)"""
+        p95 = self.latency_percentile(95)
+        with self._lock:
+            now = time.monotonic()
+            self._refresh_state(now)
+            self._prune(now)
+            total = len(self._calls)
+            failures = sum(1 for call in self._calls if not call[1])
+            return {
+                "state": self._state,
+                "calls": total,
+                "error_rate": round(failures / total, 3) if total else 0.0,
+                "p95_seconds": round(p95, 3) if p95 is not None else None,
+                "open_remaining_seconds": round(max(0.0, self._opened_until - now), 1) if self._state == OPEN else 0.0,
+                "times_opened": self.times_opened
+            }
+
+
+class CircuitPermit:
+    """Quyền gọi trên nhiều breaker cùng lúc (provider + model)"""
+
+    __slots__ = ("breakers", "probes", "started", "_done")
+
+    def __init__(self, breakers: List[CircuitBreaker], probes: List[bool]):
+        self.breakers = breakers
+        self.probes = probes
+        self.started = time.monotonic()
+        self._done = False
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def success(self, latency: Optional[float] = None, measure: bool = True):
+        """Ghi thành công; latency mặc định là thời gian từ lúc acquire"""
+        if self._done:
+            return
+        self._done = True
+        if latency is None and measure:
+            latency = self.elapsed()
+        for breaker, probe in zip(self.breakers, self.probes):
+            breaker.record(True, latency, probe)
+
+    def failure(self):
+        if self._done:
+            return
+        self._done = True
+        latency = self.elapsed()
+        for breaker, probe in zip(self.breakers, self.probes):
+            breaker.record(False, latency, probe)
+
+    def release(self):
+        if self._done:
+            return
+        self._done = True
+        for breaker, probe in zip(self.breakers, self.probes):
+            breaker.release(probe)
+
+
+class CircuitBreakerRegistry:
+    """Tạo lazy một CircuitBreaker cho mỗi tên, cùng cấu hình"""
+
+    def __init__(self, **breaker_options):
+        self.breaker_options = breaker_options
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    breaker = CircuitBreaker(name, **self.breaker_options)
+                    self._breakers[name] = breaker
+        return breaker
+
+    def is_available(self, *names: str) -> bool:
+        return all(self.get(name).is_available() for name in names)
+
+    def acquire(self, *names: str) -> Optional[CircuitPermit]:
+        """
+        Xin phép gọi trên tất cả breaker (VD "gemini" và "gemini:<model>")
+
+        Returns:
+            None nếu có breaker đang open (các breaker đã giữ chỗ được trả lại)
+        """
+        breakers, probes = [], []
+        for name in names:
+            breaker = self.get(name)
+            probe = breaker.acquire()
+            if probe is None:
+                for acquired, acquired_probe in zip(breakers, probes):
+                    acquired.release(acquired_probe)
+                return None
+            breakers.append(breaker)
+            probes.append(probe)
+        return CircuitPermit(breakers, probes)
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+
+def create_circuit_breaker_registry() -> CircuitBreakerRegistry:
+    """Tạo registry với cấu hình từ biến môi trường"""
+    return CircuitBreakerRegistry(
+        failure_rate=float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5")),
+        slow_call_seconds=float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "30")),
+        slow_call_rate=float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8")),
+        min_calls=int(os.getenv("CIRCUIT_MIN_CALLS", "5")),
+        window_size=int(os.getenv("CIRCUIT_WINDOW_SIZE", "100")),
+        window_seconds=float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60")),
+        open_seconds=float(os.getenv("CIRCUIT_OPEN_SECONDS", "30")),
+        half_open_max_calls=int(os.getenv("CIRCUIT_HALF_OPEN_MAX_CALLS", "1"))
+    )
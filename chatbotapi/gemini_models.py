@@ -0,0 +1,396 @@
+"""
+Gemini model discovery với TTL cache
+- Chỉ gọi genai.list_models() một lần (startup hoặc request đầu tiên), không gọi lại mỗi /chat
+- Khi danh sách hết hạn (TTL) → vẫn dùng danh sách cũ, refresh ở background thread
+- Model trả về 404 (NotFound của SDK) được negative-cache trong not_found_ttl_seconds,
+  các request trong khoảng đó không thử lại
+- Model chạy thành công gần nhất luôn được thử đầu tiên
+- System prompt gửi qua system_instruction (hoặc context cache phía Gemini nếu đủ dài)
+  thay vì chèn vào đầu text prompt mỗi request
+"""
+import datetime
+import inspect
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import google.generativeai as genai
+
+try:
+    # Exception theo HTTP status của google-api-core (dependency của google-generativeai)
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+
+try:
+    # Context caching cần google-generativeai >= 0.7
+    from google.generativeai import caching as genai_caching
+except ImportError:
+    genai_caching = None
+
+from tracing import span
+
+# system_instruction có từ google-generativeai 0.5
+SUPPORTS_SYSTEM_INSTRUCTION = "system_instruction" in inspect.signature(genai.GenerativeModel.__init__).parameters
+
+# Số token tối thiểu của một CachedContent (tuỳ model, 1024–4096); prompt ngắn hơn → tạo cache chắc chắn lỗi
+CONTEXT_CACHE_MIN_TOKENS = 4096
+
+# Dùng khi list_models() lỗi và chưa có danh sách nào trong cache
+FALLBACK_GEMINI_MODELS = [
+    "gemini-pro",
+    "gemini-1.5-pro",
+    "gemini-1.5-flash",
+    "models/gemini-pro",
+    "models/gemini-1.5-pro"
+]
+
+
+class GeminiContextCache:
+    """
+    System prompt lưu sẵn phía Gemini (CachedContent), mỗi model một cache
+    - Tạo và gia hạn ở background thread, request không phải chờ
+    - Gia hạn TTL khi còn dưới refresh_margin_seconds
+    - Chỉ tạo khi system prompt (đếm bằng count_tokens của model) đạt min_tokens,
+      prompt ngắn hơn → luôn dùng system_instruction, không gọi API tạo cache
+    - Tạo lỗi (VD model không hỗ trợ) → dùng system_instruction, thử lại sau retry_seconds
+
+    Args:
+        system_instruction: System prompt cố định
+        ttl_seconds: TTL của cached content
+        refresh_margin_seconds: Gia hạn khi thời gian còn lại dưới ngưỡng này
+        retry_seconds: Sau khi tạo cache lỗi, chờ bao lâu mới thử lại
+        min_tokens: Số token tối thiểu provider cho phép cache
+    """
+
+    def __init__(self, system_instruction: str, ttl_seconds: int = 3600,
+                 refresh_margin_seconds: int = 300, retry_seconds: int = 3600,
+                 min_tokens: int = CONTEXT_CACHE_MIN_TOKENS):
+        self.system_instruction = system_instruction
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.retry_seconds = retry_seconds
+        self.min_tokens = min_tokens
+
+        self._lock = threading.Lock()
+        # model_name → (CachedContent, GenerativeModel, expires_at)
+        self._entries: Dict[str, tuple] = {}
+        self._failed_until: Dict[str, float] = {}
+        self._pending = set()
+        # model_name → số token của system prompt theo tokenizer của model
+        self._prompt_tokens: Dict[str, int] = {}
+
+    def get_model(self, model_name: str) -> Optional[genai.GenerativeModel]:
+        """Model dùng cached content (None nếu chưa có → caller dùng system_instruction)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry is not None and entry[2] <= now:
+                # Đã hết hạn phía server
+                del self._entries[model_name]
+                entry = None
+            if entry is None:
+                if now < self._failed_until.get(model_name, 0):
+                    return None
+                task = self._create
+            elif entry[2] - now < self.refresh_margin_seconds:
+                task = self._refresh
+            else:
+                return entry[1]
+            if model_name not in self._pending:
+                self._pending.add(model_name)
+                threading.Thread(target=task, args=(model_name,), name="gemini-context-cache", daemon=True).start()
+        return entry[1] if entry is not None else None
+
+    def _count_tokens(self, model_name: str) -> int:
+        """Số token của system prompt (gọi countTokens, không tính phí)"""
+        return genai.GenerativeModel(model_name).count_tokens(self.system_instruction).total_tokens
+
+    def _give_up(self, model_name: str, until: float):
+        with self._lock:
+            self._failed_until[model_name] = until
+            self._pending.discard(model_name)
+
+    def _create(self, model_name: str):
+        try:
+            tokens = self._prompt_tokens.get(model_name)
+            if tokens is None:
+                tokens = self._prompt_tokens[model_name] = self._count_tokens(model_name)
+        except Exception as e:
+            self._give_up(model_name, time.time() + self.retry_seconds)
+            print(f"⚠️  Could not count system prompt tokens for {model_name}: {str(e)[:150]}")
+            return
+        if tokens < self.min_tokens:
+            # Prompt không đổi → không bao giờ đủ, không thử lại
+            self._give_up(model_name, float("inf"))
+            print(f"ℹ️  System prompt ({tokens} tokens) below context cache minimum ({self.min_tokens}) "
+                  f"for {model_name}, using system_instruction")
+            return
+        try:
+            content = genai_caching.CachedContent.create(
+                model=f"models/{model_name}",
+                display_name="my-diary-system-prompt",
+                system_instruction=self.system_instruction,
+                ttl=datetime.timedelta(seconds=self.ttl_seconds)
+            )
+            model = genai.GenerativeModel.from_cached_content(content)
+        except Exception as e:
+            self._give_up(model_name, time.time() + self.retry_seconds)
+            print(f"⚠️  Context cache unavailable for {model_name}, using system_instruction: {str(e)[:150]}")
+            return
+        with self._lock:
+            self._entries[model_name] = (content, model, time.time() + self.ttl_seconds)
+            self._pending.discard(model_name)
+        print(f"🗄️  System prompt cached on Gemini for {model_name} (ttl {self.ttl_seconds}s)")
+
+    def _refresh(self, model_name: str):
+        with self._lock:
+            entry = self._entries.get(model_name)
+        try:
+            if entry is None:
+                raise ValueError("cache entry removed")
+            entry[0].update(ttl=datetime.timedelta(seconds=self.ttl_seconds))
+        except Exception as e:
+            # Gia hạn lỗi → bỏ entry, lần sau tạo lại
+            print(f"⚠️  Could not refresh context cache for {model_name}: {str(e)[:150]}")
+            with self._lock:
+                self._entries.pop(model_name, None)
+                self._pending.discard(model_name)
+            return
+        with self._lock:
+            if model_name in self._entries:
+                self._entries[model_name] = (entry[0], entry[1], time.time() + self.ttl_seconds)
+            self._pending.discard(model_name)
+
+    def warm(self, model_name: str) -> bool:
+        """Tạo cache cho model ngay (blocking), True nếu dùng được"""
+        with self._lock:
+            if model_name in self._entries:
+                return True
+            self._pending.add(model_name)
+        self._create(model_name)
+        with self._lock:
+            return model_name in self._entries
+
+    def invalidate(self, model_name: str) -> bool:
+        """Bỏ cache của model (VD server báo cached content không còn); True nếu có entry"""
+        with self._lock:
+            return self._entries.pop(model_name, None) is not None
+
+    def close(self):
+        """Xoá các cached content đã tạo (tính phí lưu trữ theo giờ)"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for content, _, _ in entries:
+            try:
+                content.delete()
+            except Exception as e:
+                print(f"⚠️  Could not delete context cache: {e}")
+
+
+class GeminiModelRegistry:
+    """
+    Registry các Gemini model hỗ trợ generateContent
+
+    Args:
+        ttl_seconds: Thời gian danh sách model được coi là còn mới
+        retry_seconds: Sau khi list_models() lỗi, chờ bao lâu mới thử lại
+        not_found_ttl_seconds: Model trả về 404 bị bỏ qua trong bao lâu
+        system_instruction: System prompt gắn vào model (None = caller tự chèn vào prompt)
+        context_cache: Nếu có, ưu tiên model dùng cached content của system prompt
+    """
+
+    def __init__(self, ttl_seconds: int = 3600, retry_seconds: int = 60,
+                 not_found_ttl_seconds: int = 3600,
+                 system_instruction: Optional[str] = None,
+                 context_cache: Optional[GeminiContextCache] = None):
+        self.ttl_seconds = ttl_seconds
+        self.retry_seconds = retry_seconds
+        self.not_found_ttl_seconds = not_found_ttl_seconds
+        self.system_instruction = system_instruction
+        self.context_cache = context_cache
+
+        self._lock = threading.Lock()
+        # Chỉ một list_models() chạy tại một thời điểm (request đầu tiên / refresh nền)
+        self._refresh_lock = threading.Lock()
+        self._models: List[str] = []
+        self._expires_at = 0.0
+        self._resolved = False
+        self._refreshing = False
+        # model → thời điểm hết negative-cache
+        self._not_found: Dict[str, float] = {}
+        self._instances: Dict[str, genai.GenerativeModel] = {}
+        self.preferred_model: Optional[str] = None
+
+    def _fetch_models(self) -> List[str]:
+        """Gọi genai.list_models() và lọc các model hỗ trợ generateContent"""
+        with span("gemini.list_models") as s:
+            models = []
+            for model in genai.list_models():
+                if 'generateContent' in model.supported_generation_methods:
+                    models.append(model.name.replace('models/', ''))
+            s.set_attribute("gemini.models", len(models))
+            return models
+
+    def refresh(self) -> List[str]:
+        """Resolve lại danh sách model (blocking)"""
+        with self._refresh_lock:
+            return self._refresh_locked()
+
+    def _resolve_once(self):
+        """Lần dùng đầu tiên: các request đồng thời chờ chung một lần list_models()"""
+        with self._refresh_lock:
+            with self._lock:
+                if self._resolved:
+                    return
+            self._refresh_locked()
+
+    def _refresh_locked(self) -> List[str]:
+        try:
+            models = self._fetch_models()
+            error = None
+        except Exception as e:
+            models = []
+            error = e
+
+        with self._lock:
+            now = time.time()
+            if models:
+                self._models = models
+                self._expires_at = now + self.ttl_seconds
+            else:
+                # Giữ danh sách cũ (nếu có), thử lại sớm hơn TTL
+                self._expires_at = now + self.retry_seconds
+            self._resolved = True
+            self._refreshing = False
+            current = list(self._models)
+
+        if error is not None:
+            print(f"⚠️  Could not list Gemini models: {error}")
+        else:
+            print(f"📋 Resolved {len(models)} Gemini models (cached for {self.ttl_seconds}s)")
+        return current
+
+    def refresh_in_background(self):
+        """Refresh danh sách ở background thread (bỏ qua nếu đang refresh)"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self.refresh, name="gemini-model-refresh", daemon=True)
+        thread.start()
+
+    def candidates(self) -> List[str]:
+        """
+        Danh sách model theo thứ tự thử: model thành công gần nhất trước,
+        bỏ qua các model đã 404 (trong not_found_ttl_seconds)
+        """
+        with self._lock:
+            resolved = self._resolved
+            stale = time.time() >= self._expires_at
+
+        if not resolved:
+            # Lần dùng đầu tiên: resolve đồng bộ
+            self._resolve_once()
+        elif stale:
+            # Stale-while-revalidate: dùng danh sách cũ, refresh nền
+            self.refresh_in_background()
+
+        with self._lock:
+            models = list(self._models) or list(FALLBACK_GEMINI_MODELS)
+            preferred = self.preferred_model
+            now = time.time()
+            for model_name in [m for m, until in self._not_found.items() if until <= now]:
+                # Hết negative-cache: thử lại (model có thể đã được bật cho project/region)
+                del self._not_found[model_name]
+            not_found = set(self._not_found)
+
+        if preferred and preferred not in not_found:
+            models = [preferred] + [m for m in models if m != preferred]
+        return [m for m in models if m not in not_found]
+
+    @property
+    def carries_system_prompt(self) -> bool:
+        """Model đã mang system prompt (system_instruction/cached content) → prompt không cần chèn lại"""
+        return self.system_instruction is not None
+
+    def get_model(self, model_name: str) -> genai.GenerativeModel:
+        """Lấy GenerativeModel đã khởi tạo (tạo một lần cho mỗi model)"""
+        if self.context_cache is not None:
+            cached_model = self.context_cache.get_model(model_name)
+            if cached_model is not None:
+                return cached_model
+        with self._lock:
+            model = self._instances.get(model_name)
+            if model is None:
+                if self.system_instruction is not None:
+                    model = genai.GenerativeModel(model_name, system_instruction=self.system_instruction)
+                else:
+                    model = genai.GenerativeModel(model_name)
+                self._instances[model_name] = model
+            return model
+
+    def mark_success(self, model_name: str):
+        """Ghi nhớ model chạy thành công để lần sau thử đầu tiên"""
+        with self._lock:
+            self.preferred_model = model_name
+
+    def mark_not_found(self, model_name: str):
+        """Negative-cache model trả về 404 trong not_found_ttl_seconds"""
+        # 404 khi đang dùng cached content: cache hết hạn/bị xoá phía server, không phải model không tồn tại
+        if self.context_cache is not None and self.context_cache.invalidate(model_name):
+            print(f"⚠️  Context cache for {model_name} is gone, falling back to system_instruction")
+            return
+        with self._lock:
+            self._not_found[model_name] = time.time() + self.not_found_ttl_seconds
+            self._instances.pop(model_name, None)
+            if self.preferred_model == model_name:
+                self.preferred_model = None
+
+
+def is_model_not_found_error(error: BaseException) -> bool:
+    """
+    Model không tồn tại: google.api_core.exceptions.NotFound (hoặc lỗi khác mang HTTP status 404).
+    Không đoán theo nội dung message: "404"/"not found" có thể nằm trong lỗi tạm thời
+    (VD quota, proxy) và làm model bị bỏ qua oan
+    """
+    if google_exceptions is not None and isinstance(error, google_exceptions.NotFound):
+        return True
+    return getattr(error, "code", None) == 404 or getattr(error, "status_code", None) == 404
+
+
+def create_model_registry(system_prompt: Optional[str] = None) -> GeminiModelRegistry:
+    """
+    Tạo registry với cấu hình từ biến môi trường
+
+    GEMINI_PROMPT_CACHE (cách gửi system_prompt):
+        system_instruction  gửi riêng qua system_instruction (prefix cố định → implicit caching) (mặc định)
+        cached              context cache phía Gemini khi system prompt đạt GEMINI_CONTEXT_CACHE_MIN_TOKENS,
+                            còn lại dùng system_instruction
+        inline              chèn vào đầu text prompt như trước
+    SDK cũ không hỗ trợ thì tự lùi về mức thấp hơn (google-generativeai 0.3.x: inline)
+    """
+    mode = os.getenv("GEMINI_PROMPT_CACHE", "system_instruction").lower()
+    system_instruction = None
+    context_cache = None
+    if system_prompt and mode != "inline" and SUPPORTS_SYSTEM_INSTRUCTION:
+        system_instruction = system_prompt
+        if mode == "cached" and genai_caching is not None:
+            context_cache = GeminiContextCache(
+                system_prompt,
+                ttl_seconds=int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600")),
+                refresh_margin_seconds=int(os.getenv("GEMINI_CONTEXT_CACHE_REFRESH_SECONDS", "300")),
+                retry_seconds=int(os.getenv("GEMINI_CONTEXT_CACHE_RETRY_SECONDS", "3600")),
+                min_tokens=int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", str(CONTEXT_CACHE_MIN_TOKENS)))
+            )
+    elif system_prompt and mode != "inline":
+        print("⚠️  google-generativeai too old for system_instruction, system prompt is inlined")
+    return GeminiModelRegistry(
+        ttl_seconds=int(os.getenv("GEMINI_MODELS_TTL_SECONDS", "3600")),
+        retry_seconds=int(os.getenv("GEMINI_MODELS_RETRY_SECONDS", "60")),
+        not_found_ttl_seconds=int(os.getenv("GEMINI_NOT_FOUND_TTL_SECONDS", "3600")),
+        system_instruction=system_instruction,
+        context_cache=context_cache
+    )
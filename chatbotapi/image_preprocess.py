@@ -0,0 +1,84 @@
+"""
+Tiền xử lý ảnh món ăn trước khi phân tích
+- JPEG: Image.draft() decode thẳng ở tỉ lệ nhỏ (1/2, 1/4, 1/8) thay vì full resolution
+- Xoay ảnh theo EXIF Orientation rồi bỏ toàn bộ EXIF (GPS, thông tin máy...)
+- Thu nhỏ về IMAGE_MAX_DIMENSION và re-encode JPEG với IMAGE_JPEG_QUALITY
+  → ít bytes/token hơn khi gửi lên Gemini Vision
+- Tính dHash 64-bit của ảnh đã chuẩn hóa để ảnh gần giống nhau (re-save, re-compress,
+  bản "scaled" của Android) dùng chung cache entry
+"""
+import io
+import os
+from typing import BinaryIO, Union
+
+from PIL import Image, ImageOps
+
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+DHASH_SIZE = 8
+
+
+class PreprocessedImage:
+    """Ảnh đã chuẩn hóa: PIL image, JPEG bytes, kích thước và dHash"""
+
+    __slots__ = ("image", "jpeg_bytes", "width", "height", "original_width", "original_height", "dhash")
+
+    def __init__(self, image, jpeg_bytes, original_size, dhash):
+        self.image = image
+        self.jpeg_bytes = jpeg_bytes
+        self.width, self.height = image.size
+        self.original_width, self.original_height = original_size
+        self.dhash = dhash
+
+
+def compute_dhash(image: Image.Image, hash_size: int = DHASH_SIZE) -> str:
+    """
+    Difference hash: so sánh độ sáng các pixel kề nhau trên ảnh xám (hash_size+1) x hash_size
+
+    Ảnh phẳng màu / ít texture cho hash 0000000000000000 bất kể màu, không dùng để so khớp được
+    (xem perceptual_index.is_degenerate_phash)
+
+    Returns:
+        Chuỗi hex 16 ký tự (64 bit)
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+
+def preprocess_image(source: Union[bytes, BinaryIO], max_dimension: int = IMAGE_MAX_DIMENSION,
+                     quality: int = IMAGE_JPEG_QUALITY) -> PreprocessedImage:
+    """
+    Decode ở tỉ lệ giảm, chuẩn hóa hướng, bỏ EXIF, thu nhỏ và re-encode JPEG
+
+    Args:
+        source: Bytes hoặc file object (VD SpooledUpload.file)
+        max_dimension: Cạnh dài tối đa sau khi thu nhỏ
+        quality: Chất lượng JPEG khi re-encode
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    source.seek(0)
+
+    image = Image.open(source)
+    original_size = image.size
+
+    # JPEG: decoder scale trực tiếp (no-op với định dạng khác)
+    image.draft("RGB", (max_dimension, max_dimension))
+
+    # Xoay theo EXIF Orientation; ảnh trả về không còn tag Orientation
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    # Không truyền exif=... khi save → EXIF bị loại bỏ
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+
+    return PreprocessedImage(image, output.getvalue(), original_size, compute_dhash(image))
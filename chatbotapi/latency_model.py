@@ -0,0 +1,228 @@
+"""
+Độ trễ giả lập cho phân tích ảnh mock (thay cho asyncio.sleep(random.uniform(...)) cố định)
+
+Cấu hình bằng biến môi trường, theo từng endpoint:
+    SIMULATED_LATENCY                     mặc định cho mọi endpoint
+    SIMULATED_LATENCY_<ENDPOINT>          VD SIMULATED_LATENCY_ANALYZE_IMAGE
+
+Giá trị:
+    off                       không delay (đo overhead/capacity thật của server)
+    fixed:2.5                 luôn 2.5 giây
+    uniform:10:15             ngẫu nhiên đều trong [10, 15] giây
+    replay:latencies.txt      lấy mẫu từ độ trễ thật đã ghi (mỗi dòng một số giây)
+    replay:latencies.txt:0.5  như trên, nhân hệ số 0.5
+
+Mọi cấu hình được parse và kiểm tra một lần khi server khởi động (load_latency_models):
+cấu hình sai làm server không khởi động được thay vì lỗi ở request đầu tiên.
+
+Ghi độ trễ thật của provider: đặt LATENCY_RECORD_PATH, mỗi lần gọi thật
+(record_latency) được append một dòng số giây vào file đó → dùng lại với replay:
+"""
+import asyncio
+import os
+import random
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+# Mặc định theo endpoint (giữ nguyên delay cũ khi không cấu hình)
+DEFAULT_LATENCY_SPECS = {
+    "analyze_image": "uniform:10:15",
+    "analyze_nutrition": "uniform:10:15",
+    "analyze_batch": "uniform:10:15",
+    "assistant_image": "uniform:1:2",
+}
+
+
+class LatencyModel(ABC):
+    """Trả về số giây delay cho mỗi lần phân tích giả lập"""
+
+    name = "base"
+
+    @abstractmethod
+    def sample(self) -> float:
+        """Số giây delay cho một lần gọi"""
+
+    async def wait(self) -> float:
+        """Sleep theo mẫu vừa lấy, trả về số giây đã delay"""
+        delay = self.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def describe(self) -> str:
+        return self.name
+
+
+class NoLatency(LatencyModel):
+    name = "off"
+
+    def sample(self) -> float:
+        return 0.0
+
+
+class FixedLatency(LatencyModel):
+    name = "fixed"
+
+    def __init__(self, seconds: float):
+        if seconds < 0:
+            raise ValueError("fixed: số giây phải >= 0")
+        self.seconds = seconds
+
+    def sample(self) -> float:
+        return self.seconds
+
+    def describe(self) -> str:
+        return f"fixed:{self.seconds:g}"
+
+
+class UniformLatency(LatencyModel):
+    name = "uniform"
+
+    def __init__(self, low: float, high: float):
+        if low < 0 or high < low:
+            raise ValueError("uniform: cần 0 <= low <= high")
+        self.low = low
+        self.high = high
+
+    def sample(self) -> float:
+        return random.uniform(self.low, self.high)
+
+    def describe(self) -> str:
+        return f"uniform:{self.low:g}:{self.high:g}"
+
+
+class ReplayLatency(LatencyModel):
+    """Lấy mẫu ngẫu nhiên từ phân phối độ trễ thật đã ghi lại (empirical distribution)"""
+
+    name = "replay"
+
+    def __init__(self, samples: List[float], scale: float = 1.0, source: str = ""):
+        if not samples:
+            raise ValueError("replay: không có mẫu độ trễ nào")
+        if scale < 0 or min(samples) < 0:
+            raise ValueError("replay: mẫu độ trễ và hệ số phải >= 0")
+        self.samples = samples
+        self.scale = scale
+        self.source = source
+
+    @classmethod
+    def from_file(cls, path: str, scale: float = 1.0) -> "ReplayLatency":
+        with open(path, "r", encoding="utf-8") as f:
+            samples = [float(line) for line in (line.strip() for line in f) if line and not line.startswith("#")]
+        return cls(samples, scale, path)
+
+    def sample(self) -> float:
+        return random.choice(self.samples) * self.scale
+
+    def describe(self) -> str:
+        return f"replay:{self.source} ({len(self.samples)} samples, x{self.scale:g})"
+
+
+def parse_latency_spec(spec: str) -> LatencyModel:
+    """
+    Parse chuỗi cấu hình ("off", "fixed:2", "uniform:10:15", "replay:file[:scale]")
+
+    Raises:
+        ValueError: Chuỗi không hợp lệ (kể cả file replay không đọc được)
+    """
+    try:
+        return _parse_latency_spec(spec)
+    except (ValueError, OSError) as e:
+        raise ValueError(f"Latency model không hợp lệ: {spec!r} ({e})") from e
+
+
+def _parse_latency_spec(spec: str) -> LatencyModel:
+    kind, _, args = spec.strip().partition(":")
+    kind = kind.lower()
+    if kind in ("off", "none", "0"):
+        return NoLatency()
+    if kind == "fixed":
+        return FixedLatency(float(args))
+    if kind == "uniform":
+        low, sep, high = args.partition(":")
+        if not sep:
+            raise ValueError("uniform cần dạng uniform:low:high")
+        return UniformLatency(float(low), float(high))
+    if kind == "replay":
+        path, scale = args, 1.0
+        head, sep, tail = args.rpartition(":")
+        if sep and head:
+            try:
+                path, scale = head, float(tail)
+            except ValueError:
+                pass
+        return ReplayLatency.from_file(path, scale)
+    raise ValueError("loại không hỗ trợ (off | fixed | uniform | replay)")
+
+
+_models: Dict[str, LatencyModel] = {}
+_models_lock = threading.Lock()
+
+
+def _load_locked(endpoint: str, default_spec: Optional[str]) -> LatencyModel:
+    env_name = f"SIMULATED_LATENCY_{endpoint.upper()}"
+    if os.getenv(env_name):
+        source, spec = env_name, os.getenv(env_name)
+    elif os.getenv("SIMULATED_LATENCY"):
+        source, spec = "SIMULATED_LATENCY", os.getenv("SIMULATED_LATENCY")
+    else:
+        source, spec = "default", default_spec or DEFAULT_LATENCY_SPECS[endpoint]
+    try:
+        model = parse_latency_spec(spec)
+    except ValueError as e:
+        raise ValueError(f"{source} ({endpoint}): {e}") from e
+    _models[endpoint] = model
+    print(f"⏳ Simulated latency for {endpoint}: {model.describe()}")
+    return model
+
+
+def load_latency_models(endpoints=None) -> Dict[str, LatencyModel]:
+    """
+    Parse + kiểm tra cấu hình của mọi endpoint (gọi khi server khởi động)
+
+    Raises:
+        ValueError: Có cấu hình không hợp lệ (thông báo nêu tên biến môi trường)
+    """
+    with _models_lock:
+        return {endpoint: _load_locked(endpoint, None) for endpoint in (endpoints or DEFAULT_LATENCY_SPECS)}
+
+
+def get_latency_model(endpoint: str, default_spec: Optional[str] = None) -> LatencyModel:
+    """
+    Latency model cho một endpoint (đọc env một lần rồi giữ lại)
+
+    Args:
+        endpoint: Tên endpoint, VD "analyze_image" → SIMULATED_LATENCY_ANALYZE_IMAGE
+        default_spec: Dùng khi không cấu hình (None = DEFAULT_LATENCY_SPECS)
+    """
+    model = _models.get(endpoint)
+    if model is not None:
+        return model
+    with _models_lock:
+        model = _models.get(endpoint)
+        if model is None:
+            model = _load_locked(endpoint, default_spec)
+        return model
+
+
+def set_latency_model(endpoint: str, model: Optional[LatencyModel]):
+    """Thay latency model lúc chạy (VD trong load test); None → đọc lại từ env"""
+    with _models_lock:
+        if model is None:
+            _models.pop(endpoint, None)
+        else:
+            _models[endpoint] = model
+
+
+_record_lock = threading.Lock()
+
+
+def record_latency(seconds: float, path: Optional[str] = None):
+    """Ghi một mẫu độ trễ thật của provider (nếu LATENCY_RECORD_PATH được đặt)"""
+    path = path or os.getenv("LATENCY_RECORD_PATH")
+    if not path:
+        return
+    with _record_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(f"{seconds:.4f}\n")
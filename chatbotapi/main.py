@@ -1,11 +1,11 @@
 import os
-from fastapi import FastAPI, HTTPException, Request, File, UploadFile
+from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import uvicorn
-from PIL import Image
-import io
+import time
 import json as json_module
 import google.generativeai as genai  
 
@@ -29,6 +29,35 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# Giới hạn kích thước upload: từ chối sớm (Content-Length / khi nhận body), trước khi parse/decode
+from upload_handler import (
+    UploadSizeLimitMiddleware, UploadTooLargeError, body_limit_for_upload,
+    iter_ndjson, read_json_body, spool_base64, spool_upload_file
+)
+UPLOAD_BODY_LIMIT = body_limit_for_upload()
+# Batch: giới hạn số ảnh mỗi request và số ảnh MISS phân tích đồng thời
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "20"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    limits={
+        "/analyze-image": UPLOAD_BODY_LIMIT,
+        "/analyze-nutrition": UPLOAD_BODY_LIMIT,
+        "/analyze-batch": UPLOAD_BODY_LIMIT * BATCH_MAX_ITEMS
+    }
+)
+
+# Metrics (Prometheus) cho /metrics: bọc ngoài các middleware xử lý request
+from metrics import (
+    CONTENT_TYPE_LATEST, REGISTRY as METRICS_REGISTRY, MetricsMiddleware,
+    monitor_event_loop_lag, stage_timer
+)
+app.add_middleware(MetricsMiddleware, route_paths=lambda: [route.path for route in app.routes])
+# Tracing: ngoài cùng, để mọi response (kể cả 413 từ UploadSizeLimitMiddleware) có X-Request-ID
+from tracing import TracingMiddleware, get_tracer, shutdown_tracer
+app.add_middleware(TracingMiddleware, route_paths=lambda: [route.path for route in app.routes])
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+
 # Lấy API Key từ biến môi trường - Fallback chain: Gemini → OpenRouter
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
@@ -74,6 +103,35 @@ class ChatRequest(BaseModel):
             }
         }
 
+@app.on_event("startup")
+async def validate_latency_models():
+    """Parse cấu hình SIMULATED_LATENCY_* ngay khi khởi động: cấu hình sai → server không start"""
+    from latency_model import load_latency_models
+    load_latency_models()
+
+@app.on_event("startup")
+async def warm_up_assistant():
+    """Resolve danh sách Gemini model ở background và mở OpenRouter client khi server khởi động"""
+    import asyncio
+    app.state.loop_lag_task = asyncio.create_task(monitor_event_loop_lag(EVENT_LOOP_LAG_INTERVAL))
+    if chatbot_assistant is None:
+        return
+    if chatbot_assistant.gemini_api_key:
+        chatbot_assistant.model_registry.refresh_in_background()
+    await chatbot_assistant.astart()
+
+@app.on_event("shutdown")
+async def shutdown_assistant():
+    """Đóng thread pool / connection của assistant và cache khi server tắt"""
+    from cache_manager import close_cache_instance
+    loop_lag_task = getattr(app.state, "loop_lag_task", None)
+    if loop_lag_task is not None:
+        loop_lag_task.cancel()
+    if chatbot_assistant is not None:
+        await chatbot_assistant.aclose()
+    close_cache_instance()
+    shutdown_tracer()
+
 @app.post("/chat")
 async def chat_endpoint(chat_request: ChatRequest):
     try:
@@ -95,30 +153,161 @@ async def chat_endpoint(chat_request: ChatRequest):
             detail="Xin lỗi, có lỗi xảy ra khi xử lý yêu cầu của bạn. Vui lòng thử lại sau."
         )
 
+def _sse_event(data: dict, event: str = None) -> str:
+    """Format một Server-Sent Event"""
+    payload = json_module.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(chat_request: ChatRequest):
+    """
+    Stream câu trả lời qua Server-Sent Events, mỗi event là phần tiếp theo của câu trả lời đã prettify
+    (nối các delta lại được đúng câu trả lời của /chat)
+    
+    Events:
+        data: {"delta": "Đoạn văn..."}
+        event: done  data: {"ttfb_ms": 850.2, "total_ms": 4200.7}
+        event: error data: {"detail": "..."}
+    """
+    if not chat_request.question.strip():
+        raise HTTPException(
+            status_code=400,
+            detail="Câu hỏi không được để trống"
+        )
+    
+    async def event_stream():
+        start_time = time.perf_counter()
+        ttfb_ms = None
+        try:
+            async for paragraph in chatbot_assistant.stream_response(chat_request.question, chat_request.history):
+                if ttfb_ms is None:
+                    ttfb_ms = (time.perf_counter() - start_time) * 1000
+                yield _sse_event({"delta": paragraph})
+            
+            total_ms = (time.perf_counter() - start_time) * 1000
+            print(f"⏱️  /chat/stream TTFB: {ttfb_ms or total_ms:.0f}ms, total: {total_ms:.0f}ms")
+            yield _sse_event({"ttfb_ms": round(ttfb_ms or total_ms, 1), "total_ms": round(total_ms, 1)}, event="done")
+        except Exception as e:
+            print(f"Lỗi trong chat_stream_endpoint khi gọi assistant.stream_response: {e}")
+            yield _sse_event(
+                {"detail": "Xin lỗi, có lỗi xảy ra khi xử lý yêu cầu của bạn. Vui lòng thử lại sau."},
+                event="error"
+            )
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/provider-health")
+async def provider_health():
+    """
+    Trạng thái circuit breaker của các LLM provider/model dùng cho /chat
+
+    Returns:
+        {
+            "circuits": {
+                "gemini": {"state": "closed", "calls": 12, "error_rate": 0.0, "p95_seconds": 3.2, ...},
+                "gemini:gemini-1.5-flash": {...},
+                "openrouter": {"state": "open", "open_remaining_seconds": 18.5, ...}
+            }
+        }
+    """
+    if chatbot_assistant is None:
+        raise HTTPException(status_code=503, detail="Chatbot assistant chưa được khởi tạo")
+    return {"circuits": chatbot_assistant.circuit_breakers.snapshot()}
+
+def _collect_runtime_metrics():
+    """Số liệu đã được đếm sẵn ở cache / circuit breaker, đọc lúc scrape (không đếm hai lần)"""
+    from cache_manager import get_cache_instance
+    from response_cache import get_response_cache_instance
+    from circuit_breaker import CLOSED, HALF_OPEN, OPEN
+
+    cache = get_cache_instance()
+    chat_cache = get_response_cache_instance()
+    lookups = {
+        "image_l1": (cache.l1_hits, cache.l1_misses),
+        "image_l2": (cache.l2_hits, cache.l2_misses),
+        "chat_response": (chat_cache.exact_hits + chat_cache.near_hits, chat_cache.misses)
+    }
+    if chatbot_assistant is not None:
+        assembler = chatbot_assistant.prompt_assembler
+        lookups["chat_summary"] = (assembler.summary_hits, assembler.summary_misses)
+
+    requests = []
+    ratios = []
+    for name, (hits, misses) in lookups.items():
+        requests.append(({"cache": name, "result": "hit"}, hits))
+        requests.append(({"cache": name, "result": "miss"}, misses))
+        ratios.append(({"cache": name}, hits / (hits + misses) if hits + misses else 0.0))
+    yield "cache_requests_total", "counter", "Số lần tra cache theo kết quả", requests
+    yield "cache_hit_ratio", "gauge", "Tỉ lệ cache hit từ lúc khởi động", ratios
+
+    if chatbot_assistant is not None:
+        state_values = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+        states = [({"name": name}, state_values[snapshot["state"]])
+                  for name, snapshot in chatbot_assistant.circuit_breakers.snapshot().items()]
+        yield "circuit_breaker_state", "gauge", "Trạng thái circuit breaker (0 closed, 1 half-open, 2 open)", states
+
+    tracer = get_tracer()
+    if tracer.enabled:
+        yield "trace_spans_total", "counter", "Số span theo kết quả export", [
+            ({"result": "exported"}, tracer.exported),
+            ({"result": "dropped"}, tracer.dropped)
+        ]
+
+METRICS_REGISTRY.add_collector(_collect_runtime_metrics)
+
+@app.get("/metrics")
+async def metrics():
+    """Metrics dạng Prometheus text (request rate/latency theo endpoint, provider, model; cache; event loop...)"""
+    return PlainTextResponse(METRICS_REGISTRY.render(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/cache-stats")
-async def cache_stats():
+async def cache_stats(top_n: int = 10):
     """
-    Lấy thống kê cache để monitor hiệu quả
+    Lấy thống kê cache để monitor hiệu quả (O(1), không quét toàn bảng)
+    
+    Args:
+        top_n: Số image hash được truy cập nhiều nhất trả về
     
     Returns:
         {
             "total_entries": 150,
             "total_cache_hits": 1250,
             "average_hits_per_entry": 8.33,
-            "estimated_api_calls_saved": 1100
+            "bytes_stored": 1843200,
+            "hit_ratio_windows": {"1m": {"hits": 12, "misses": 3, "hit_ratio": 0.8}, "5m": {...}, "15m": {...}},
+            "entry_age_histogram": {"<1d": 20, "1-7d": 60, "7-30d": 70, ">=30d": 0},
+            "top_hashes": [{"image_hash": "9f86d08...", "access_count": 42}],
+            "estimated_api_calls_saved": 1100,
+            "l1": {"entries": 120, "bytes": 524288, "hits": 900, "misses": 350, "hit_rate": 0.72},
+            "l2": {"hits": 350, "misses": 150, "hit_rate": 0.7},
+            "chat_response_cache": {
+                "entries": 40,
+                "exact_hits": 120,
+                "near_hits": 35,
+                "misses": 60,
+                "hit_ratio": 0.7209
+            }
         }
     """
     from cache_manager import get_cache_instance
+    from response_cache import get_response_cache_instance
     cache = get_cache_instance()
-    stats = cache.get_stats()
+    stats = await cache.astats(top_n)
     
     # Calculate API calls saved (hits - entries = số lần không cần gọi API)
     api_calls_saved = stats["total_cache_hits"] - stats["total_entries"]
     stats["estimated_api_calls_saved"] = max(0, api_calls_saved)
+    stats["chat_response_cache"] = get_response_cache_instance().get_stats()
     
     return stats
 
@@ -132,7 +321,7 @@ async def cache_cleanup(days_to_keep: int = 30):
     """
     from cache_manager import get_cache_instance
     cache = get_cache_instance()
-    deleted = cache.cleanup_old_entries(days_to_keep)
+    deleted = await cache.acleanup_old_entries(days_to_keep)
     
     return {
         "status": "success",
@@ -140,6 +329,132 @@ async def cache_cleanup(days_to_keep: int = 30):
         "message": f"Cleaned up entries older than {days_to_keep} days"
     }
 
+async def _analyze_with_cache(upload, filename: str, endpoint: str) -> dict:
+    """
+    Phân tích ảnh (mock) có cache theo SHA256 nội dung ảnh (hash đã tính khi spool upload)
+    - Cache HIT → trả ngay từ ImageAnalysisCache
+    - Cache MISS → _analyze_uncached
+    
+    Args:
+        endpoint: Tên endpoint để chọn latency model giả lập (latency_model.get_latency_model)
+    
+    Returns:
+        Kết quả dạng /analyze-nutrition (is_food, food_name, confidence, nutrients[])
+    """
+    from cache_manager import get_cache_instance
+    
+    with stage_timer("image_cache_lookup"):
+        result = await get_cache_instance().aget_by_hash(upload.sha256)
+    if result is not None:
+        return result
+    return await _analyze_uncached(upload, filename, endpoint)
+
+async def _preprocess_upload(upload):
+    """
+    preprocess_image trên thread pool (decode + chuẩn hóa, cũng là bước validate ảnh)
+    Thread đang chạy không hủy được: caller bị hủy vẫn chờ thread đọc xong file tạm
+    rồi mới raise CancelledError, để upload chỉ bị đóng khi không còn ai đọc
+    """
+    import asyncio
+    from image_preprocess import preprocess_image
+    
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, preprocess_image, upload.file)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait({future})
+        raise
+
+async def _analyze_uncached(upload, filename: str, endpoint: str) -> dict:
+    """
+    Phân tích ảnh chưa có trong cache theo SHA256
+    - Chuẩn hóa ảnh (decode nhỏ, xoay theo EXIF, bỏ EXIF, re-encode) và tính dHash;
+      ảnh gần giống đã có trong cache (dHash cách <= PHASH_MAX_DISTANCE bit) → dùng lại kết quả
+    - Còn lại → simulate AI delay (SIMULATED_LATENCY_<ENDPOINT>, mặc định 10-15s) rồi lưu kết quả kèm dHash
+    - Nhiều upload giống hệt nhau cùng lúc chỉ phân tích một lần (single-flight, tính cả bước
+      preprocess: các upload trùng hash không decode lại ảnh)
+    """
+    import asyncio
+    from cache_manager import get_cache_instance
+    from latency_model import get_latency_model
+    from mock_nutrition_data import get_mock_nutrition_by_filename
+    
+    cache = get_cache_instance()
+    latency = get_latency_model(endpoint)
+    image_hash = upload.sha256
+    # Xong khi analyze() của request này không còn đọc upload.file
+    preprocessed = asyncio.get_running_loop().create_future()
+    owns_analysis = False
+    
+    async def analyze():
+        try:
+            with stage_timer("preprocess"):
+                image = await _preprocess_upload(upload)
+        finally:
+            preprocessed.set_result(None)
+        print(f"🖼️  Preprocessed {upload.size} → {len(image.jpeg_bytes)} bytes "
+              f"({image.original_width}x{image.original_height} → {image.width}x{image.height})")
+        
+        with stage_timer("perceptual_lookup"):
+            result = await cache.aget_by_perceptual_hash(image.dhash)
+        if result is None:
+            with stage_timer("analysis"):
+                # Simulate AI processing delay (cấu hình theo endpoint, "off" khi load test)
+                await latency.wait()
+                result = get_mock_nutrition_by_filename(filename)
+        with stage_timer("image_cache_store"):
+            await cache.aset_by_hash(image_hash, result, image.dhash)
+        return result
+    
+    def start_analysis():
+        # asingle_flight chỉ gọi hàm này khi chưa có phân tích nào cùng hash đang chạy
+        nonlocal owns_analysis
+        owns_analysis = True
+        return analyze()
+    
+    try:
+        return await cache.asingle_flight(image_hash, start_analysis)
+    except asyncio.CancelledError:
+        # Task single-flight chạy tiếp khi caller bị hủy: chờ nó đọc xong file tạm
+        # rồi mới để caller đóng upload
+        if owns_analysis:
+            await asyncio.wait({preprocessed})
+        raise
+
+def _to_items_response(mock_result: dict) -> dict:
+    """
+    Chuyển kết quả dạng /analyze-nutrition sang format /analyze-image (items array)
+    
+    Backend expects lowercase keys with specific formatting:
+    - Minerals: WITHOUT MIN_ prefix (ca, fe, zn)
+    - Amino acids: WITH amino_ prefix (amino_his, amino_ile)
+    - Fiber: lowercase as-is (fibtg, fib_sol)
+    - Fatty acids: lowercase as-is (fams, fapu)
+    - Vitamins: lowercase as-is (vita, vitd, vitb1)
+    """
+    import random
+    from mock_nutrition_data import nutrient_payload
+    
+    # Dựng sẵn một lần cho mỗi món / entry cache, request chỉ gắn confidence
+    payload = nutrient_payload(mock_result.get("nutrients", ()))
+    
+    # Random confidence between 90-95%
+    random_confidence = random.uniform(0.90, 0.95)
+    
+    return {
+        "items": [{
+            "item_name": mock_result.get("food_name", "Món ăn"),
+            "item_type": "food",
+            "confidence_score": random_confidence,
+            "estimated_volume_ml": 250,
+            "estimated_weight_g": 200,
+            "water_ml": payload.water_ml,
+            # Copy: payload dùng chung giữa các request (read-only)
+            "nutrients": dict(payload.nutrients_obj)
+        }]
+    }
+
 @app.post("/analyze-image")
 async def analyze_image_endpoint(file: UploadFile = File(...)):
     """
@@ -149,66 +464,28 @@ async def analyze_image_endpoint(file: UploadFile = File(...)):
     Returns: JSON với danh sách món ăn/đồ uống và nutrients
     """
     try:
-        from mock_nutrition_data import get_mock_nutrition_by_filename
-        
         # Get filename
         filename = file.filename if file.filename else "default"
         
-        # Đọc file ảnh (chỉ để validate, không phân tích thực)
-        image_bytes = await file.read()
-        
-        if len(image_bytes) == 0:
-            raise HTTPException(status_code=400, detail="File ảnh rỗng")
-        
-        # ALWAYS USE MOCK DATA BASED ON FILENAME
-        # Simulate AI processing delay (10-15 seconds)
-        import random
-        import asyncio
-        delay = random.uniform(10, 15)
-        await asyncio.sleep(delay)
-        
-        mock_result = get_mock_nutrition_by_filename(filename)
+        # Đọc file ảnh theo chunk vào file tạm, tính SHA256 trong lúc đọc
+        with await spool_upload_file(file) as upload:
+            if upload.size == 0:
+                raise HTTPException(status_code=400, detail="File ảnh rỗng")
+            
+            # Cache theo SHA256 nội dung ảnh: ảnh đã phân tích → trả ngay, không delay
+            mock_result = await _analyze_with_cache(upload, filename, "analyze_image")
         
         # Convert nutrients array to object format that backend expects
-        # Backend expects lowercase keys with specific formatting:
-        # - Minerals: WITHOUT MIN_ prefix (ca, fe, zn)
-        # - Amino acids: WITH amino_ prefix (amino_his, amino_ile)  
-        # - Fiber: lowercase as-is (fibtg, fib_sol)
-        # - Fatty acids: lowercase as-is (fams, fapu)
-        # - Vitamins: lowercase as-is (vita, vitd, vitb1)
-        nutrients_obj = {}
-        for nutrient in mock_result.get("nutrients", []):
-            code = nutrient["nutrient_code"]
-            # Remove MIN_ prefix from minerals
-            if code.startswith("MIN_"):
-                code = code.replace("MIN_", "")
-            # Convert to lowercase
-            code = code.lower()
-            nutrients_obj[code] = nutrient["amount"]
-        
-        # Random confidence between 90-95%
-        random_confidence = random.uniform(0.90, 0.95)
-        
-        # Convert to analyze-image format (items array)
-        result = {
-            "items": [{
-                "item_name": mock_result.get("food_name", "Món ăn"),
-                "item_type": "food",
-                "confidence_score": random_confidence,
-                "estimated_volume_ml": 250,
-                "estimated_weight_g": 200,
-                "water_ml": nutrients_obj.get("water", 0),
-                "nutrients": nutrients_obj
-            }]
-        }
-        
-        return result
+        return _to_items_response(mock_result)
         
+    except (HTTPException, UploadTooLargeError):
+        raise
     except Exception as e:
+        # Chi tiết lỗi chỉ ghi log, không trả về client
         print(f"[analyze_image_endpoint] Error: {e}")
         raise HTTPException(
             status_code=500,
-            detail=f"Lỗi khi phân tích ảnh: {str(e)}"
+            detail="Lỗi khi phân tích ảnh. Vui lòng thử lại sau."
         )
 
 @app.post("/analyze-nutrition")
@@ -219,32 +496,26 @@ async def analyze_nutrition(request: Request):
     Returns detailed nutrition breakdown based on filename pattern
     """
     try:
-        from mock_nutrition_data import get_mock_nutrition_by_filename
-        
         # Check if request is JSON (base64) or multipart
         content_type = request.headers.get('content-type', '')
         filename = "default"  # Default fallback
         
         if 'application/json' in content_type:
-            # Handle base64 image from JSON
-            body = await request.json()
+            # Handle base64 image from JSON (đọc body theo stream, dừng nếu vượt giới hạn)
+            body = await read_json_body(request, UPLOAD_BODY_LIMIT)
             # Developer simulation: if caller supplies a simulated_result, return it directly
             if isinstance(body, dict) and body.get('simulate') and body.get('simulated_result'):
                 return body.get('simulated_result')
             
             # Get filename if provided
             filename = body.get('filename', 'default')
-            base64_image = body.get('image')
-            # Get filename if provided
-            filename = body.get('filename', 'default')
-            base64_image = body.get('image')
+            base64_image = body.pop('image', None)
             if not base64_image:
                 raise HTTPException(status_code=400, detail="No image data provided")
             
-            # Decode base64 (just to validate, we don't actually analyze)
-            import base64
-            image_data = base64.b64decode(base64_image)
-            image = Image.open(io.BytesIO(image_data))
+            # Decode base64 theo khối vào file tạm (kiểm tra kích thước trước khi decode)
+            upload = await spool_base64(base64_image)
+            del base64_image, body
         else:
             # Handle multipart file upload
             form = await request.form()
@@ -256,20 +527,18 @@ async def analyze_nutrition(request: Request):
             if hasattr(file, 'filename'):
                 filename = file.filename
             
-            image_data = await file.read()
-            image = Image.open(io.BytesIO(image_data))
+            upload = await spool_upload_file(file)
         
-        # USE MOCK DATA BASED ON FILENAME - NO MORE REAL API CALLS
-        # Simulate AI processing delay (10-15 seconds)
-        import random
-        import asyncio
-        delay = random.uniform(10, 15)
-        await asyncio.sleep(delay)
-        
-        result = get_mock_nutrition_by_filename(filename)
+        with upload:
+            # USE MOCK DATA BASED ON FILENAME - NO MORE REAL API CALLS
+            # Cache theo SHA256 nội dung ảnh (dùng chung với /analyze-image);
+            # ảnh được decode/validate khi cache MISS
+            result = await _analyze_with_cache(upload, filename, "analyze_nutrition")
         
         return result
         
+    except UploadTooLargeError:
+        raise
     except Exception as je:
         print(f"Error analyzing nutrition: {je}")
         return {
@@ -280,6 +549,155 @@ async def analyze_nutrition(request: Request):
             "error": str(je)
         }
 
+async def _read_batch_uploads(request: Request) -> list:
+    """
+    Spool mọi ảnh trong batch (tính SHA256 khi đọc), trả về [(filename, SpooledUpload)]
+    - multipart/form-data: nhiều field "files" (hoặc "file")
+    - application/x-ndjson: mỗi dòng {"filename": "...", "image": "<base64>"}
+    Toàn bộ body được đọc trước khi stream kết quả (StreamingResponse chiếm receive channel)
+    """
+    content_type = request.headers.get('content-type', '')
+    uploads = []
+    try:
+        if 'multipart/form-data' in content_type:
+            form = await request.form()
+            try:
+                files = [f for f in form.getlist('files') + form.getlist('file') if hasattr(f, 'filename')]
+                if len(files) > BATCH_MAX_ITEMS:
+                    raise HTTPException(status_code=400, detail=f"Tối đa {BATCH_MAX_ITEMS} ảnh mỗi batch")
+                for file in files:
+                    uploads.append((file.filename or "default", await spool_upload_file(file)))
+            finally:
+                await form.close()
+        elif 'ndjson' in content_type:
+            async for line in iter_ndjson(request, UPLOAD_BODY_LIMIT):
+                if len(uploads) >= BATCH_MAX_ITEMS:
+                    raise HTTPException(status_code=400, detail=f"Tối đa {BATCH_MAX_ITEMS} ảnh mỗi batch")
+                base64_image = line.get('image') if isinstance(line, dict) else None
+                if not base64_image:
+                    raise HTTPException(status_code=400, detail=f"Dòng {len(uploads) + 1}: No image data provided")
+                uploads.append((line.get('filename', 'default'), await spool_base64(base64_image)))
+        else:
+            raise HTTPException(
+                status_code=415,
+                detail="Content-Type phải là multipart/form-data hoặc application/x-ndjson"
+            )
+    except BaseException:
+        for _, upload in uploads:
+            upload.close()
+        raise
+    
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No image data provided")
+    return uploads
+
+@app.post("/analyze-batch")
+async def analyze_batch(request: Request, response_format: str = Query("nutrition", alias="format")):
+    """
+    Phân tích nhiều ảnh trong một request, stream kết quả từng ảnh ngay khi xong (NDJSON)
+    - Ảnh trùng nội dung trong batch chỉ phân tích một lần
+    - Ảnh đã có trong cache trả về ngay; ảnh MISS chạy song song tối đa BATCH_MAX_CONCURRENCY
+    
+    Accepts: multipart/form-data (nhiều field "files") hoặc application/x-ndjson
+             (mỗi dòng {"filename": "pho-bo.jpg", "image": "<base64>"})
+    Query: format=nutrition (mặc định, như /analyze-nutrition) | items (như /analyze-image)
+    
+    Returns (application/x-ndjson, theo thứ tự hoàn thành):
+        {"index": 0, "filename": "pho-bo.jpg", "image_hash": "9f86d08...", "cached": true, "result": {...}}
+        {"index": 2, "filename": "x.png", "image_hash": "...", "error": "..."}
+        {"done": true, "total": 3, "unique": 2, "cached": 1, "analyzed": 1, "errors": 0, "total_ms": 10234.5}
+    """
+    import asyncio
+    from cache_manager import get_cache_instance, json_default
+    
+    if response_format not in ("nutrition", "items"):
+        raise HTTPException(status_code=400, detail="format phải là 'nutrition' hoặc 'items'")
+    
+    uploads = await _read_batch_uploads(request)
+    cache = get_cache_instance()
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    
+    # Gom theo SHA256: mỗi nội dung ảnh một task, các index trùng dùng chung kết quả
+    groups = {}
+    for index, (filename, upload) in enumerate(uploads):
+        group = groups.get(upload.sha256)
+        if group is None:
+            groups[upload.sha256] = (filename, upload, [index])
+        else:
+            group[2].append(index)
+            upload.close()
+    
+    async def analyze_unique(filename: str, upload) -> tuple:
+        """Trả về (result, cached)"""
+        result = await cache.aget_by_hash(upload.sha256)
+        if result is not None:
+            return result, True
+        async with semaphore:
+            return await _analyze_uncached(upload, filename, "analyze_batch"), False
+    
+    def start_analysis(filename: str, upload) -> asyncio.Task:
+        # Upload chỉ đóng khi task đã kết thúc hẳn (kể cả khi bị hủy giữa lúc preprocess đang đọc file)
+        task = asyncio.ensure_future(analyze_unique(filename, upload))
+        task.add_done_callback(lambda _: upload.close())
+        return task
+    
+    def item_line(data: dict) -> bytes:
+        return (json_module.dumps(data, ensure_ascii=False, default=json_default) + "\n").encode("utf-8")
+    
+    async def result_stream():
+        start_time = time.perf_counter()
+        tasks = {
+            start_analysis(filename, upload): image_hash
+            for image_hash, (filename, upload, _) in groups.items()
+        }
+        stats = {"cached": 0, "analyzed": 0, "errors": 0}
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    image_hash = tasks[task]
+                    indexes = groups[image_hash][2]
+                    try:
+                        result, cached = task.result()
+                        if response_format == "items":
+                            result = _to_items_response(result)
+                        stats["cached" if cached else "analyzed"] += 1
+                        outcome = {"cached": cached, "result": result}
+                    except Exception as e:
+                        print(f"[analyze_batch] Error for hash {image_hash[:16]}...: {e}")
+                        stats["errors"] += 1
+                        outcome = {"error": str(e) or type(e).__name__}
+                    for index in indexes:
+                        yield item_line({
+                            "index": index,
+                            "filename": uploads[index][0],
+                            "image_hash": image_hash,
+                            **outcome
+                        })
+            
+            total_ms = (time.perf_counter() - start_time) * 1000
+            print(f"⏱️  /analyze-batch: {len(uploads)} images ({len(groups)} unique), "
+                  f"{stats['cached']} cached, {stats['analyzed']} analyzed, {total_ms:.0f}ms")
+            yield item_line({
+                "done": True,
+                "total": len(uploads),
+                "unique": len(groups),
+                **stats,
+                "total_ms": round(total_ms, 1)
+            })
+        finally:
+            # Client ngắt kết nối → hủy các ảnh chưa xong (single-flight trong cache vẫn chạy tiếp);
+            # file tạm được đóng bởi done callback của từng task
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(
+        result_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 if __name__ == "__main__":
     print("Khởi động server với uvicorn...")
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
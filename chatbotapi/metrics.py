@@ -0,0 +1,335 @@
+"""
+Metrics cho /metrics (Prometheus text exposition format 0.0.4)
+- Counter / Gauge / Histogram có label; Histogram dùng bucket định sẵn (không lưu mẫu,
+  observe = bisect + 3 phép cộng)
+- Không lock trên hot path: mọi cập nhật chạy trên thread của event loop
+  (kết quả từ thread pool được ghi trong done-callback / sau await, vốn chạy trên loop)
+- Số liệu đã có sẵn ở nơi khác (cache hit, circuit breaker) không đếm lại mà đọc lúc scrape
+  qua collector callback
+"""
+import asyncio
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import tracing
+
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket (giây) cho request HTTP / từng bước xử lý
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0)
+# LLM chậm hơn nhiều: dồn bucket vào vùng 0.5–60s
+LLM_BUCKETS = (0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0)
+# Event-loop lag: vài ms là bình thường, trên 100ms là đang bị block
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # counts[i] = số mẫu rơi vào bucket i (không cộng dồn); phần tử cuối là +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Series theo giá trị label (nên giữ lại child ở nơi gọi nhiều để khỏi tra dict)"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: cần {len(self.labelnames)} label, nhận {len(values)}")
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            counts = list(child.counts)
+            for bound, count in zip(self.bounds + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+# Collector: trả về các family (name, type, help, [(labels dict, value)]) đọc lúc scrape
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Collector] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                print(f"⚠️  Metrics collector failed: {e}")
+                continue
+            for name, type_name, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {type_name}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "Số HTTP request đã xử lý", ("endpoint", "method", "status"))
+HTTP_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Thời gian xử lý HTTP request (tới khi gửi xong response)", ("endpoint",))
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    "http_requests_in_flight", "Số HTTP request đang xử lý", ("endpoint",))
+STAGE_DURATION = REGISTRY.histogram(
+    "stage_duration_seconds", "Thời gian từng bước xử lý (upload, preprocess, cache, prompt, prettify...)", ("stage",))
+LLM_REQUESTS = REGISTRY.counter(
+    "llm_requests_total", "Số lần gọi LLM provider theo kết quả", ("provider", "model", "outcome"))
+LLM_DURATION = REGISTRY.histogram(
+    "llm_request_duration_seconds", "Thời gian một lần gọi LLM provider", ("provider", "model"), LLM_BUCKETS)
+LLM_IN_FLIGHT = REGISTRY.gauge(
+    "llm_requests_in_flight", "Số lần gọi LLM provider đang chờ", ("provider",))
+LLM_TOKENS = REGISTRY.counter(
+    "llm_tokens_total", "Token đã dùng (provider báo về; stream là ước lượng)", ("provider", "model", "kind"))
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    "event_loop_lag_seconds", "Độ trễ event loop (thời gian ngủ thực tế trừ thời gian ngủ dự kiến)", (), LAG_BUCKETS)
+EVENT_LOOP_LAG_LAST = REGISTRY.gauge(
+    "event_loop_lag_last_seconds", "Độ trễ event loop ở lần đo gần nhất")
+
+
+class stage_timer:
+    """
+    Đo thời gian một bước vào STAGE_DURATION, đồng thời mở trace span cùng tên
+
+        with stage_timer("preprocess"):
+            ...
+    """
+
+    __slots__ = ("child", "span", "started")
+
+    def __init__(self, stage: str):
+        self.child = STAGE_DURATION.labels(stage)
+        self.span = tracing.span(stage)
+
+    def __enter__(self):
+        self.span.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+        self.span.__exit__(*exc)
+        return False
+
+
+def record_llm_call(provider: str, model: str, outcome: str, seconds: Optional[float] = None):
+    """Ghi một lần gọi LLM (outcome: success / error / cancelled / circuit_open)"""
+    LLM_REQUESTS.labels(provider, model, outcome).inc()
+    if seconds is not None:
+        LLM_DURATION.labels(provider, model).observe(seconds)
+
+
+def record_llm_tokens(provider: str, model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    if prompt_tokens:
+        LLM_TOKENS.labels(provider, model, "prompt").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(provider, model, "completion").inc(completion_tokens)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Chạy nền: đo mỗi interval giây event loop bị trễ bao lâu so với lịch"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: đếm request, đo thời gian, gauge in-flight theo endpoint
+    Endpoint label là path của route (app không có path param), path lạ → "unmatched"
+    để số series không tăng theo URL tuỳ ý
+
+    Args:
+        route_paths: Hàm trả về tập path của các route (gọi một lần ở request đầu tiên,
+            khi mọi route đã được đăng ký)
+    """
+
+    def __init__(self, app, route_paths: Callable[[], Iterable[str]], skip_paths: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.route_paths = route_paths
+        self.skip_paths = frozenset(skip_paths)
+        self._known_paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        if self._known_paths is None:
+            self._known_paths = frozenset(self.route_paths())
+        path = scope.get("path", "")
+        endpoint = path if path in self._known_paths else "unmatched"
+        status = 500
+        in_flight = HTTP_IN_FLIGHT.labels(endpoint)
+        in_flight.inc()
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            HTTP_REQUESTS.labels(endpoint, scope.get("method", ""), str(status)).inc()
+            HTTP_DURATION.labels(endpoint).observe(time.perf_counter() - started)
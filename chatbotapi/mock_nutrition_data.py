@@ -1,6 +1,14 @@
 """
 Mock nutrition data for different Vietnamese foods based on filename
 """
+import hashlib
+import re
+import threading
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from typing import Optional
+
+from nutrient_schema import NUTRIENT_INFO, RESPONSE_NUTRIENT_KEYS, code_to_key, to_vector
 
 MOCK_NUTRITION_DATABASE = {
     "pho-bo": {
@@ -401,55 +409,182 @@ MOCK_NUTRITION_DATABASE = {
     "scaled54": "banhcongcamau"
 }
 
-NUTRIENT_INFO = {
-    "ENERC_KCAL": {"name": "Calories", "unit": "kcal"},
-    "PROCNT": {"name": "Protein", "unit": "g"},
-    "CHOCDF": {"name": "Total Carbohydrate", "unit": "g"},
-    "FAT": {"name": "Total Fat", "unit": "g"},
-    "WATER": {"name": "Water", "unit": "ml"},
-    # All Vitamins
-    "VITD": {"name": "Vitamin D", "unit": "IU"},
-    "VITC": {"name": "Vitamin C", "unit": "mg"},
-    "VITB12": {"name": "Vitamin B12", "unit": "µg"},
-    "VITA": {"name": "Vitamin A", "unit": "µg"},
-    "VITE": {"name": "Vitamin E", "unit": "mg"},
-    "VITK": {"name": "Vitamin K", "unit": "mg"},
-    "VITB1": {"name": "Vitamin B1", "unit": "mg"},
-    "VITB2": {"name": "Vitamin B2", "unit": "mg"},
-    "VITB3": {"name": "Vitamin B3", "unit": "mg"},
-    "VITB5": {"name": "Vitamin B5", "unit": "mg"},
-    "VITB6": {"name": "Vitamin B6", "unit": "mg"},
-    "VITB7": {"name": "Vitamin B7", "unit": "µg"},
-    "VITB9": {"name": "Vitamin B9", "unit": "µg"},
-    # All Minerals (14)
-    "MIN_CA": {"name": "Calcium", "unit": "mg"},
-    "MIN_P": {"name": "Phosphorus", "unit": "mg"},
-    "MIN_MG": {"name": "Magnesium", "unit": "mg"},
-    "MIN_K": {"name": "Potassium", "unit": "mg"},
-    "MIN_NA": {"name": "Sodium", "unit": "mg"},
-    "MIN_FE": {"name": "Iron", "unit": "mg"},
-    "MIN_ZN": {"name": "Zinc", "unit": "mg"},
-    "MIN_CU": {"name": "Copper", "unit": "mg"},
-    "MIN_MN": {"name": "Manganese", "unit": "mg"},
-    "MIN_I": {"name": "Iodine", "unit": "µg"},
-    "MIN_SE": {"name": "Selenium", "unit": "µg"},
-    "MIN_CR": {"name": "Chromium", "unit": "µg"},
-    "MIN_MO": {"name": "Molybdenum", "unit": "µg"},
-    "MIN_F": {"name": "Fluoride", "unit": "mg"},
-    # All Amino Acids (9)
-    "AMINO_HIS": {"name": "Histidine", "unit": "mg"},
-    "AMINO_ILE": {"name": "Isoleucine", "unit": "mg"},
-    "AMINO_LEU": {"name": "Leucine", "unit": "mg"},
-    "AMINO_LYS": {"name": "Lysine", "unit": "mg"},
-    "AMINO_MET": {"name": "Methionine", "unit": "mg"},
-    "AMINO_PHE": {"name": "Phenylalanine", "unit": "mg"},
-    "AMINO_THR": {"name": "Threonine", "unit": "mg"},
-    "AMINO_TRP": {"name": "Tryptophan", "unit": "mg"},
-    "AMINO_VAL": {"name": "Valine", "unit": "mg"},
-    # Fiber & Fat
-    "TOTAL_FAT": {"name": "Tổng chất béo", "unit": "g"},
-    "FIBTG": {"name": "Total Fiber", "unit": "g"}
+class NutrientPayload:
+    """
+    Nutrients của một món ở các format trả về, dựng sẵn một lần.
+    Các object bên trong dùng chung giữa mọi request: chỉ đọc / serialize, không được sửa
+
+    - nutrients_list: ({nutrient_code, nutrient_name, amount, unit}, ...) (format /analyze-nutrition),
+      tuple các MappingProxyType: trả thẳng cho mọi request / giữ trong cache mà không ai sửa được
+    - nutrients_obj: {code lowercase, bỏ MIN_: amount} (format /analyze-image), read-only
+    - nutrients_obj_full: nutrients_obj + các RESPONSE_NUTRIENT_KEYS còn thiếu = 0, read-only
+      (MappingProxyType: response dùng bản copy dict(...), sửa response không làm hỏng catalogue)
+    - vector: array('d') theo thứ tự nutrient_schema (để cộng/nhân khẩu phần/so RDA)
+    """
+
+    __slots__ = ("nutrients_list", "nutrients_obj", "nutrients_obj_full", "water_ml", "vector")
+
+    def __init__(self, nutrients_list):
+        self.nutrients_list = tuple(MappingProxyType(dict(nutrient)) for nutrient in nutrients_list)
+        # Remove MIN_ prefix from minerals, convert to lowercase
+        nutrients_obj = {
+            code_to_key(nutrient["nutrient_code"]): nutrient["amount"] for nutrient in self.nutrients_list
+        }
+        self.vector = to_vector(nutrients_obj)
+        nutrients_obj_full = dict(nutrients_obj)
+        for key in RESPONSE_NUTRIENT_KEYS:
+            if key not in nutrients_obj_full:
+                nutrients_obj_full[key] = 0
+        self.nutrients_obj = MappingProxyType(nutrients_obj)
+        self.nutrients_obj_full = MappingProxyType(nutrients_obj_full)
+        self.water_ml = nutrients_obj.get("water", 0)
+
+    @classmethod
+    def from_amounts(cls, amounts: dict) -> "NutrientPayload":
+        """Dựng từ {NUTRIENT_CODE: amount} trong MOCK_NUTRITION_DATABASE"""
+        nutrients_list = []
+        for code, amount in amounts.items():
+            info = NUTRIENT_INFO.get(code, {"name": code, "unit": "g"})
+            nutrients_list.append({
+                "nutrient_code": code,
+                "nutrient_name": info["name"],
+                "amount": amount,
+                "unit": info["unit"]
+            })
+        return cls(nutrients_list)
+
+
+# Chuẩn hóa tên file: bỏ đuôi ảnh, bỏ "-" và "_" (một lần regex + translate thay vì 5 lần replace)
+_IMAGE_EXTENSION_RE = re.compile(r"\.(?:jpg|jpeg|png)")
+_SEPARATOR_TABLE = str.maketrans("", "", "-_")
+
+
+def _normalize_filename(filename: str) -> str:
+    return _IMAGE_EXTENSION_RE.sub("", filename.lower()).translate(_SEPARATOR_TABLE)
+
+
+class _FoodIndex:
+    """
+    Index tra món ăn theo tên file, dựng một lần từ MOCK_NUTRITION_DATABASE
+    - aliases: tên file "scaledNN" → key món (tra dict O(1))
+    - Aho-Corasick trên các key (bỏ "-"): tìm mọi key là substring của tên file trong
+      một lượt duyệt O(len(tên file)), không phụ thuộc số món; nhiều key khớp thì chọn
+      key đứng trước trong database (giống thứ tự quét cũ)
+    - fallback_keys: tuple cố định cho trường hợp không khớp (chọn theo MD5 tên file)
+    - payloads: NutrientPayload dựng sẵn cho từng món
+    """
+
+    def __init__(self, database: dict):
+        self.foods = {key: value for key, value in database.items() if isinstance(value, dict)}
+        self.aliases = {
+            key: value for key, value in database.items()
+            if isinstance(value, str) and value in self.foods
+        }
+        self.fallback_keys = tuple(key for key in self.foods if key != "default")
+        self.payloads = {key: NutrientPayload.from_amounts(food["nutrients"]) for key, food in self.foods.items()}
+        self._priority_keys = tuple(self.foods)
+        self._build_automaton([key.replace("-", "") for key in self._priority_keys])
+
+    def _build_automaton(self, patterns):
+        # goto[state]: ký tự → state; best[state]: priority nhỏ nhất kết thúc tại state (kể cả qua fail link)
+        no_match = len(patterns)
+        goto = [{}]
+        best = [no_match]
+        for priority, pattern in enumerate(patterns):
+            state = 0
+            for ch in pattern:
+                next_state = goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][ch] = next_state
+                    goto.append({})
+                    best.append(no_match)
+                state = next_state
+            best[state] = min(best[state], priority)
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in goto[state].items():
+                fallback = fail[state]
+                while fallback and ch not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(ch, 0)
+                best[next_state] = min(best[next_state], best[fail[next_state]])
+                queue.append(next_state)
+
+        self._goto = goto
+        self._fail = fail
+        self._best = best
+        self._no_match = no_match
+
+    def match_substring(self, normalized: str) -> Optional[str]:
+        """Key món (bỏ "-") nằm trong tên file đã chuẩn hóa, ưu tiên key đứng trước"""
+        goto, fail, best = self._goto, self._fail, self._best
+        state = 0
+        found = best[0]
+        for ch in normalized:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best[state] < found:
+                found = best[state]
+                if found == 0:
+                    break
+        if found == self._no_match:
+            return None
+        return self._priority_keys[found]
+
+    def lookup_key(self, filename: str) -> str:
+        normalized = _normalize_filename(filename)
+        key = self.aliases.get(normalized)
+        if key is None:
+            key = self.match_substring(normalized)
+        if key is None:
+            # Use filename hash to consistently select a food (same filename = same food)
+            hash_value = int(hashlib.md5(filename.encode()).hexdigest(), 16)
+            key = self.fallback_keys[hash_value % len(self.fallback_keys)]
+        return key
+
+    def lookup(self, filename: str) -> dict:
+        return self.foods[self.lookup_key(filename)]
+
+
+_FOOD_INDEX = _FoodIndex(MOCK_NUTRITION_DATABASE)
+
+
+# Payload theo identity của nutrients list: món mock (cố định) + kết quả đọc từ cache (LRU)
+_STATIC_PAYLOADS = {
+    id(payload.nutrients_list): payload for payload in _FOOD_INDEX.payloads.values()
 }
+_PAYLOAD_MEMO_MAX = 1024
+_payload_memo: "OrderedDict[int, tuple]" = OrderedDict()
+_payload_memo_lock = threading.Lock()
+
+
+def nutrient_payload(nutrients) -> NutrientPayload:
+    """
+    NutrientPayload cho một nutrients list (format /analyze-nutrition).
+    List của kết quả mock và của entry cache đang nằm trong L1 là object ổn định,
+    nên chỉ chuyển đổi một lần rồi dùng lại theo identity
+    """
+    key = id(nutrients)
+    payload = _STATIC_PAYLOADS.get(key)
+    if payload is not None:
+        return payload
+    with _payload_memo_lock:
+        entry = _payload_memo.get(key)
+        if entry is not None and entry[0] is nutrients:
+            _payload_memo.move_to_end(key)
+            return entry[1]
+    payload = NutrientPayload(nutrients)
+    with _payload_memo_lock:
+        # Giữ tham chiếu tới nutrients để id không bị tái sử dụng khi entry còn trong memo
+        _payload_memo[key] = (nutrients, payload)
+        if len(_payload_memo) > _PAYLOAD_MEMO_MAX:
+            _payload_memo.popitem(last=False)
+    return payload
 
 
 def get_mock_nutrition_by_filename(filename: str) -> dict:
@@ -457,41 +592,10 @@ def get_mock_nutrition_by_filename(filename: str) -> dict:
     Get mock nutrition data based on filename
     Matches filename to food type (case-insensitive, removes extensions and special chars)
     If no match, randomly select a food based on filename hash
+
+    "nutrients" là tuple dựng sẵn, dùng chung giữa các request (entry là MappingProxyType, read-only)
     """
-    # Normalize filename: lowercase, remove extension
-    normalized = filename.lower().replace('.jpg', '').replace('.jpeg', '').replace('.png', '').replace('-', '').replace('_', '')
-    
-    # Check if it's a mapped scaled file
-    if normalized in MOCK_NUTRITION_DATABASE and isinstance(MOCK_NUTRITION_DATABASE[normalized], str):
-        # It's a mapping, get the actual food key
-        actual_key = MOCK_NUTRITION_DATABASE[normalized]
-        food_data = MOCK_NUTRITION_DATABASE[actual_key]
-    else:
-        # Try to match with database keys
-        food_data = None
-        for key in MOCK_NUTRITION_DATABASE.keys():
-            if isinstance(MOCK_NUTRITION_DATABASE[key], dict) and key.replace('-', '') in normalized:
-                food_data = MOCK_NUTRITION_DATABASE[key]
-                break
-        
-        if food_data is None:
-            # Use filename hash to consistently select a food (same filename = same food)
-            import hashlib
-            hash_value = int(hashlib.md5(filename.encode()).hexdigest(), 16)
-            food_keys = [k for k in MOCK_NUTRITION_DATABASE.keys() if isinstance(MOCK_NUTRITION_DATABASE[k], dict) and k != "default"]
-            selected_key = food_keys[hash_value % len(food_keys)]
-            food_data = MOCK_NUTRITION_DATABASE[selected_key]
-    
-    # Format response
-    nutrients_list = []
-    for code, amount in food_data["nutrients"].items():
-        info = NUTRIENT_INFO.get(code, {"name": code, "unit": "g"})
-        nutrients_list.append({
-            "nutrient_code": code,
-            "nutrient_name": info["name"],
-            "amount": amount,
-            "unit": info["unit"]
-        })
+    key = _FOOD_INDEX.lookup_key(filename)
     
     # Random confidence between 90-95%
     import random
@@ -499,7 +603,7 @@ def get_mock_nutrition_by_filename(filename: str) -> dict:
     
     return {
         "is_food": True,
-        "food_name": food_data["food_name"],
+        "food_name": _FOOD_INDEX.foods[key]["food_name"],
         "confidence": random_confidence,
-        "nutrients": nutrients_list
+        "nutrients": _FOOD_INDEX.payloads[key].nutrients_list
     }
@@ -0,0 +1,232 @@
+"""
+Schema nutrient dùng chung cho mock data, assistant và các phép tính dinh dưỡng
+- NUTRIENT_INFO: code (VD "MIN_CA") → tên, đơn vị
+- RESPONSE_NUTRIENT_KEYS: các key lowercase (VD "ca") client luôn mong có trong response
+- Mỗi nutrient có một index cố định → một món/bữa ăn là vector float array('d') độ dài
+  NUM_NUTRIENTS thay vì dict key string; cộng, nhân khẩu phần, so với mục tiêu (RDA)
+  là phép toán trên vector (NumPy nếu có cài, không thì array('d') thuần)
+"""
+from array import array
+from operator import mul
+from typing import Iterable, Mapping, Optional
+
+try:
+    import numpy as np
+except ImportError:  # fallback: array("d") thuần (chậm hơn khi tổng hợp nhiều bữa)
+    np = None
+
+NUTRIENT_INFO = {
+    "ENERC_KCAL": {"name": "Calories", "unit": "kcal"},
+    "PROCNT": {"name": "Protein", "unit": "g"},
+    "CHOCDF": {"name": "Total Carbohydrate", "unit": "g"},
+    "FAT": {"name": "Total Fat", "unit": "g"},
+    "WATER": {"name": "Water", "unit": "ml"},
+    # All Vitamins
+    "VITD": {"name": "Vitamin D", "unit": "IU"},
+    "VITC": {"name": "Vitamin C", "unit": "mg"},
+    "VITB12": {"name": "Vitamin B12", "unit": "µg"},
+    "VITA": {"name": "Vitamin A", "unit": "µg"},
+    "VITE": {"name": "Vitamin E", "unit": "mg"},
+    "VITK": {"name": "Vitamin K", "unit": "mg"},
+    "VITB1": {"name": "Vitamin B1", "unit": "mg"},
+    "VITB2": {"name": "Vitamin B2", "unit": "mg"},
+    "VITB3": {"name": "Vitamin B3", "unit": "mg"},
+    "VITB5": {"name": "Vitamin B5", "unit": "mg"},
+    "VITB6": {"name": "Vitamin B6", "unit": "mg"},
+    "VITB7": {"name": "Vitamin B7", "unit": "µg"},
+    "VITB9": {"name": "Vitamin B9", "unit": "µg"},
+    # All Minerals (14)
+    "MIN_CA": {"name": "Calcium", "unit": "mg"},
+    "MIN_P": {"name": "Phosphorus", "unit": "mg"},
+    "MIN_MG": {"name": "Magnesium", "unit": "mg"},
+    "MIN_K": {"name": "Potassium", "unit": "mg"},
+    "MIN_NA": {"name": "Sodium", "unit": "mg"},
+    "MIN_FE": {"name": "Iron", "unit": "mg"},
+    "MIN_ZN": {"name": "Zinc", "unit": "mg"},
+    "MIN_CU": {"name": "Copper", "unit": "mg"},
+    "MIN_MN": {"name": "Manganese", "unit": "mg"},
+    "MIN_I": {"name": "Iodine", "unit": "µg"},
+    "MIN_SE": {"name": "Selenium", "unit": "µg"},
+    "MIN_CR": {"name": "Chromium", "unit": "µg"},
+    "MIN_MO": {"name": "Molybdenum", "unit": "µg"},
+    "MIN_F": {"name": "Fluoride", "unit": "mg"},
+    # All Amino Acids (9)
+    "AMINO_HIS": {"name": "Histidine", "unit": "mg"},
+    "AMINO_ILE": {"name": "Isoleucine", "unit": "mg"},
+    "AMINO_LEU": {"name": "Leucine", "unit": "mg"},
+    "AMINO_LYS": {"name": "Lysine", "unit": "mg"},
+    "AMINO_MET": {"name": "Methionine", "unit": "mg"},
+    "AMINO_PHE": {"name": "Phenylalanine", "unit": "mg"},
+    "AMINO_THR": {"name": "Threonine", "unit": "mg"},
+    "AMINO_TRP": {"name": "Tryptophan", "unit": "mg"},
+    "AMINO_VAL": {"name": "Valine", "unit": "mg"},
+    # Fiber & Fat
+    "TOTAL_FAT": {"name": "Tổng chất béo", "unit": "g"},
+    "FIBTG": {"name": "Total Fiber", "unit": "g"}
+}
+
+
+# Các key nutrient (dạng lowercase) mà client/backend luôn mong có, thiếu thì điền 0
+RESPONSE_NUTRIENT_KEYS = (
+    "enerc_kcal", "procnt", "fat", "chocdf",
+    "fibtg", "fib_sol", "fib_insol", "fib_rs", "fib_bglu",
+    "cholesterol",
+    "vita", "vitd", "vite", "vitk", "vitc",
+    "vitb1", "vitb2", "vitb3", "vitb5", "vitb6", "vitb7", "vitb9", "vitb12",
+    "ca", "p", "mg", "k", "na", "fe", "zn", "cu", "mn", "i", "se", "cr", "mo", "f",
+    "fams", "fapu", "fasat", "fatrn", "faepa", "fadha", "faepa_dha", "fa18_2n6c", "fa18_3n3",
+    "amino_his", "amino_ile", "amino_leu", "amino_lys", "amino_met",
+    "amino_phe", "amino_thr", "amino_trp", "amino_val",
+    "ala", "epa_dha", "la"
+)
+
+
+def code_to_key(code: str) -> str:
+    """Code dạng database → key trong response: bỏ MIN_, lowercase ("MIN_CA" → "ca")"""
+    if code.startswith("MIN_"):
+        code = code[4:]
+    return code.lower()
+
+
+class NutrientField:
+    """Một nutrient trong schema: vị trí trong vector, code, key response, tên, đơn vị"""
+
+    __slots__ = ("index", "code", "key", "name", "unit")
+
+    def __init__(self, index: int, code: str, key: str, name: str, unit: str):
+        self.index = index
+        self.code = code
+        self.key = key
+        self.name = name
+        self.unit = unit
+
+    def __repr__(self):
+        return f"NutrientField({self.index}, {self.code!r}, {self.unit!r})"
+
+
+def _build_fields() -> tuple:
+    # Thứ tự: các code trong NUTRIENT_INFO, rồi các key response chưa có code riêng
+    # (chưa có tên/đơn vị → dùng mặc định giống mock data: tên = code, đơn vị "g")
+    fields = []
+    seen_keys = set()
+    for code, info in NUTRIENT_INFO.items():
+        key = code_to_key(code)
+        fields.append(NutrientField(len(fields), code, key, info["name"], info["unit"]))
+        seen_keys.add(key)
+    for key in RESPONSE_NUTRIENT_KEYS:
+        if key not in seen_keys:
+            code = key.upper()
+            fields.append(NutrientField(len(fields), code, key, code, "g"))
+            seen_keys.add(key)
+    return tuple(fields)
+
+
+FIELDS = _build_fields()
+NUM_NUTRIENTS = len(FIELDS)
+UNITS = tuple(field.unit for field in FIELDS)
+# Tra index theo cả code ("MIN_CA") lẫn key response ("ca")
+INDEX = {field.code: field.index for field in FIELDS}
+INDEX.update({field.key: field.index for field in FIELDS})
+_ZEROS = array("d", bytes(8 * NUM_NUTRIENTS))
+
+
+def zeros() -> array:
+    return array("d", _ZEROS)
+
+
+def to_vector(amounts: Mapping[str, float]) -> array:
+    """
+    {code hoặc key: amount} → vector. Nutrient không có trong schema bị bỏ qua
+    """
+    vector = zeros()
+    for name, amount in amounts.items():
+        index = INDEX.get(name)
+        if index is not None:
+            vector[index] = amount
+    return vector
+
+
+def to_dict(vector, by_code: bool = False, skip_zero: bool = False) -> dict:
+    """Vector → {key: amount} (hoặc {code: amount} nếu by_code) theo thứ tự schema"""
+    names = [field.code if by_code else field.key for field in FIELDS]
+    if skip_zero:
+        return {name: amount for name, amount in zip(names, vector) if amount}
+    return dict(zip(names, vector))
+
+
+def scale(vector, factor: float) -> array:
+    """Nhân khẩu phần (VD 1.5 suất)"""
+    if np is not None:
+        return array("d", (np.frombuffer(vector, dtype=np.float64) * factor).tobytes())
+    return array("d", [amount * factor for amount in vector])
+
+
+def targets_vector(targets: Mapping[str, float]) -> array:
+    """Mục tiêu hàng ngày (RDA) {code hoặc key: amount} → vector"""
+    return to_vector(targets)
+
+
+def compare_to_targets(total, targets) -> array:
+    """
+    Tỉ lệ đạt mục tiêu cho từng nutrient (1.0 = đủ 100%).
+    Nutrient không đặt mục tiêu (0) trả về 0
+    """
+    if np is not None:
+        total_np = np.frombuffer(total, dtype=np.float64)
+        targets_np = np.frombuffer(targets, dtype=np.float64)
+        ratios = np.divide(total_np, targets_np, out=np.zeros(NUM_NUTRIENTS), where=targets_np != 0)
+        return array("d", ratios.tobytes())
+    return array("d", [amount / target if target else 0.0 for amount, target in zip(total, targets)])
+
+
+class MealLog:
+    """
+    Nhật ký bữa ăn dạng ma trận phẳng: mỗi bữa là một hàng NUM_NUTRIENTS số float
+    (array('d') liền mạch) kèm hệ số khẩu phần. total() là một phép nhân vector-ma trận
+    với NumPy, hoặc cộng theo cột bằng zip/map (C-level) khi không có NumPy
+    """
+
+    def __init__(self):
+        self._rows = array("d")
+        self._portions = array("d")
+
+    def __len__(self):
+        return len(self._portions)
+
+    def add(self, vector, portion: float = 1.0):
+        """Ghi một bữa ăn (vector dinh dưỡng của một suất + số suất)"""
+        if len(vector) != NUM_NUTRIENTS:
+            raise ValueError(f"Vector phải có {NUM_NUTRIENTS} phần tử")
+        self._rows.extend(vector)
+        self._portions.append(portion)
+
+    def extend(self, entries: Iterable[tuple]):
+        """Ghi nhiều bữa ăn (vector, portion)"""
+        for vector, portion in entries:
+            self.add(vector, portion)
+
+    def total(self) -> array:
+        """Tổng dinh dưỡng của mọi bữa đã nhân khẩu phần"""
+        if not self._portions:
+            return zeros()
+        if np is not None:
+            matrix = np.frombuffer(self._rows, dtype=np.float64).reshape(-1, NUM_NUTRIENTS)
+            portions = np.frombuffer(self._portions, dtype=np.float64)
+            return array("d", (portions @ matrix).tobytes())
+        portions = self._portions
+        columns = [self._rows[index::NUM_NUTRIENTS] for index in range(NUM_NUTRIENTS)]
+        return array("d", [sum(map(mul, column, portions)) for column in columns])
+
+    def compare_to_targets(self, targets) -> array:
+        return compare_to_targets(self.total(), targets)
+
+
+def sum_vectors(vectors: Iterable, portions: Optional[Iterable[float]] = None) -> array:
+    """Tổng nhiều vector (kèm khẩu phần nếu có)"""
+    log = MealLog()
+    if portions is None:
+        for vector in vectors:
+            log.add(vector)
+    else:
+        log.extend(zip(vectors, portions))
+    return log.total()
@@ -0,0 +1,178 @@
+"""
+Index tìm ảnh gần giống theo perceptual hash (dHash 64-bit) trong khoảng cách Hamming cho trước
+- Multi-index hashing: chia hash thành NUM_CHUNKS đoạn 16 bit, mỗi đoạn một bảng băm
+- Theo nguyên lý Dirichlet: hai hash cách nhau <= d bit thì có ít nhất một đoạn
+  cách nhau <= d // NUM_CHUNKS bit → chỉ cần tra các biến thể lân cận của từng đoạn
+- Ứng viên được kiểm tra lại bằng popcount(a ^ b), nên kết quả chính xác (không xấp xỉ)
+- Hash suy biến (ảnh phẳng / ít texture: gần như toàn bit 0 hoặc toàn bit 1) không mang thông tin
+  về nội dung ảnh → không được thêm vào index và không bao giờ khớp
+"""
+import os
+import threading
+from functools import lru_cache
+from itertools import combinations, islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PHASH_BITS = 64
+NUM_CHUNKS = 4
+CHUNK_BITS = PHASH_BITS // NUM_CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "4"))
+# Hash có ít hơn PHASH_MIN_BITS bit 1 (hoặc bit 0) bị coi là suy biến
+PHASH_MIN_BITS = int(os.getenv("PHASH_MIN_BITS", "8"))
+
+
+if hasattr(int, "bit_count"):
+    def hamming_distance(a: int, b: int) -> int:
+        return (a ^ b).bit_count()
+else:  # Python < 3.10
+    def hamming_distance(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
+
+
+def is_degenerate_phash(perceptual_hash: str, min_bits: int = PHASH_MIN_BITS) -> bool:
+    """
+    dHash của ảnh phẳng màu / ít texture là 0000000000000000 (hoặc gần như vậy) bất kể màu gì,
+    nên mọi ảnh như vậy cách nhau 0 bit dù khác hẳn nhau
+    """
+    ones = bin(int(perceptual_hash, 16)).count("1")
+    return ones < min_bits or ones > PHASH_BITS - min_bits
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(radius: int) -> Tuple[int, ...]:
+    """Các mask 16 bit có <= radius bit 1 (tính một lần cho mỗi radius)"""
+    masks = [0]
+    for flips in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), flips):
+            masks.append(sum(1 << bit for bit in bits))
+    return tuple(masks)
+
+
+class PerceptualHashIndex:
+    """
+    Index image_hash (SHA256) theo perceptual hash, hỗ trợ tìm trong bán kính Hamming
+
+    Args:
+        max_distance: Khoảng cách Hamming tối đa mặc định khi tìm
+    """
+
+    def __init__(self, max_distance: int = PHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        # chunk_tables[i][giá trị đoạn i] -> set perceptual hash (int)
+        self._chunk_tables: List[Dict[int, set]] = [{} for _ in range(NUM_CHUNKS)]
+        # perceptual hash -> set image_hash; image_hash -> perceptual hash
+        self._members: Dict[int, set] = {}
+        self._by_image: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self._by_image)
+
+    @staticmethod
+    def _chunks(value: int):
+        for i in range(NUM_CHUNKS):
+            yield i, (value >> (i * CHUNK_BITS)) & CHUNK_MASK
+
+    def add(self, image_hash: str, perceptual_hash: str):
+        with self._lock:
+            self._discard_locked(image_hash)
+            if not is_degenerate_phash(perceptual_hash):
+                self._add_locked(image_hash, int(perceptual_hash, 16))
+
+    def bulk_load(self, rows: Iterable[Tuple[str, str]], batch_size: int = 10000) -> int:
+        """
+        Nạp (image_hash, perceptual_hash) từ SQLite khi khởi động.
+        Giữ lock theo từng batch để add/nearest chạy xen kẽ được trong lúc nạp
+
+        Returns:
+            Số dòng đã nạp
+        """
+        loaded = 0
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return loaded
+            with self._lock:
+                for image_hash, perceptual_hash in batch:
+                    if image_hash in self._by_image:
+                        self._discard_locked(image_hash)
+                    # Entry cũ lưu trước khi có kiểm tra hash suy biến
+                    if not is_degenerate_phash(perceptual_hash):
+                        self._add_locked(image_hash, int(perceptual_hash, 16))
+            loaded += len(batch)
+
+    def _add_locked(self, image_hash: str, value: int):
+        members = self._members.get(value)
+        if members is None:
+            members = self._members[value] = set()
+            for i, table in enumerate(self._chunk_tables):
+                chunk = (value >> (i * CHUNK_BITS)) & CHUNK_MASK
+                bucket = table.get(chunk)
+                if bucket is None:
+                    table[chunk] = {value}
+                else:
+                    bucket.add(value)
+        members.add(image_hash)
+        self._by_image[image_hash] = value
+
+    def discard(self, image_hash: str):
+        with self._lock:
+            self._discard_locked(image_hash)
+
+    def _discard_locked(self, image_hash: str):
+        value = self._by_image.pop(image_hash, None)
+        if value is None:
+            return
+        members = self._members[value]
+        members.discard(image_hash)
+        if members:
+            return
+        del self._members[value]
+        for i, chunk in self._chunks(value):
+            bucket = self._chunk_tables[i][chunk]
+            bucket.discard(value)
+            if not bucket:
+                del self._chunk_tables[i][chunk]
+
+    def clear(self):
+        with self._lock:
+            for table in self._chunk_tables:
+                table.clear()
+            self._members.clear()
+            self._by_image.clear()
+
+    def nearest(self, perceptual_hash: str, max_distance: Optional[int] = None) -> Optional[Tuple[str, int]]:
+        """
+        Tìm image_hash có perceptual hash gần nhất trong bán kính max_distance
+
+        Returns:
+            (image_hash, distance) hoặc None nếu không có (hoặc hash suy biến)
+        """
+        if is_degenerate_phash(perceptual_hash):
+            return None
+        if max_distance is None:
+            max_distance = self.max_distance
+        value = int(perceptual_hash, 16)
+        radius = max_distance // NUM_CHUNKS
+
+        best_value, best_distance = None, max_distance + 1
+        with self._lock:
+            if value in self._members:
+                best_value, best_distance = value, 0
+            else:
+                seen = set()
+                for i, chunk in self._chunks(value):
+                    table = self._chunk_tables[i]
+                    for mask in _flip_masks(radius):
+                        for candidate in table.get(chunk ^ mask, ()):
+                            if candidate in seen:
+                                continue
+                            seen.add(candidate)
+                            distance = hamming_distance(value, candidate)
+                            if distance < best_distance:
+                                best_value, best_distance = candidate, distance
+            if best_value is None:
+                return None
+            return next(iter(self._members[best_value])), best_distance
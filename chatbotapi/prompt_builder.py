@@ -0,0 +1,284 @@
+"""
+Dựng prompt cho /chat theo ngân sách token
+- Ước lượng token không cần tokenizer (ký tự ASCII / ký tự có dấu có tỉ lệ khác nhau),
+  hệ số hiệu chỉnh theo số prompt token thật mà provider trả về (usage)
+- History được chọn từ mới → cũ cho tới khi hết ngân sách; message quá dài bị cắt bớt
+- Các lượt cũ không vừa ngân sách được nén thành bản tóm tắt cuốn chiếu (rolling summary),
+  cache theo prefix history nên lượt sau chỉ tóm tắt thêm phần mới bị đẩy ra
+- Prompt được dựng MỘT lần mỗi request (messages cho OpenRouter + text cho Gemini),
+  dùng lại cho mọi provider/model được thử
+- System prompt là prefix cố định: Gemini nhận qua system_instruction/context cache (chỉ gửi
+  phần dialogue), OpenRouter được đánh dấu cache_control để provider cache prefix
+"""
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Token cố định cho mỗi message (role, dấu phân cách) theo kiểu chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_HEADER = "Tóm tắt hội thoại trước đó:"
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+class TokenEstimator:
+    """
+    Ước lượng số token của một đoạn text
+
+    Args:
+        ascii_chars_per_token: Số ký tự ASCII trung bình mỗi token (tiếng Anh/số ~4)
+        other_chars_per_token: Số ký tự non-ASCII mỗi token (chữ có dấu tiếng Việt bị tách nhỏ hơn)
+        smoothing: Trọng số EMA khi hiệu chỉnh theo usage thật
+    """
+
+    def __init__(self, ascii_chars_per_token: float = 4.0, other_chars_per_token: float = 1.6,
+                 smoothing: float = 0.1):
+        self.ascii_chars_per_token = ascii_chars_per_token
+        self.other_chars_per_token = other_chars_per_token
+        self.smoothing = smoothing
+        self.scale = 1.0
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def raw(self, text: str) -> float:
+        """Ước lượng chưa hiệu chỉnh"""
+        if not text:
+            return 0.0
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        return ascii_chars / self.ascii_chars_per_token + (len(text) - ascii_chars) / self.other_chars_per_token
+
+    def count(self, text: str) -> int:
+        return math.ceil(self.raw(text) * self.scale)
+
+    def count_message(self, content: str) -> int:
+        return self.count(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def observe(self, raw_estimate: float, actual_tokens: int):
+        """Hiệu chỉnh hệ số theo số prompt token provider báo về"""
+        if raw_estimate <= 0 or not actual_tokens or actual_tokens <= 0:
+            return
+        ratio = min(4.0, max(0.25, actual_tokens / raw_estimate))
+        with self._lock:
+            if self.samples == 0:
+                self.scale = ratio
+            else:
+                self.scale += self.smoothing * (ratio - self.scale)
+            self.samples += 1
+
+    def observe_messages(self, messages: List[Dict], actual_tokens: int):
+        raw = MESSAGE_OVERHEAD_TOKENS * len(messages)
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                raw += self.raw(content)
+            else:
+                # Dạng content parts (system message có cache_control)
+                raw += sum(self.raw(part.get("text", "")) for part in content)
+        self.observe(raw, actual_tokens)
+
+
+class AssembledPrompt:
+    """Prompt đã dựng cho một request, dùng chung cho mọi provider/model attempt"""
+
+    __slots__ = ("messages", "text", "dialogue", "tokens", "kept", "compacted", "summary")
+
+    def __init__(self, messages: List[Dict], text: str, dialogue: str, tokens: int,
+                 kept: int, compacted: int, summary: str):
+        self.messages = messages    # Định dạng OpenAI chat (OpenRouter)
+        self.text = text            # Text prompt cho Gemini (system prompt chèn ở đầu)
+        self.dialogue = dialogue    # Như text nhưng không có system prompt (model đã mang system_instruction)
+        self.tokens = tokens        # Ước lượng tổng prompt token
+        self.kept = kept            # Số message history giữ nguyên văn
+        self.compacted = compacted  # Số message cũ được nén vào summary
+        self.summary = summary
+
+
+class PromptAssembler:
+    """
+    Chọn history theo ngân sách token và dựng prompt
+
+    Args:
+        system_prompt: System prompt cố định
+        estimator: TokenEstimator dùng chung
+        history_token_budget: Ngân sách token cho history nguyên văn
+        message_token_limit: Message history dài hơn ngưỡng này bị cắt bớt (VD đoạn paste dài)
+        summary_token_budget: Ngân sách token cho bản tóm tắt các lượt cũ (0 = bỏ hẳn lượt cũ)
+        summary_line_tokens: Mỗi lượt cũ được rút gọn còn tối đa chừng này token
+        summary_cache_size: Số rolling summary giữ trong cache (LRU)
+        cache_control: Đánh dấu system message là prefix cache được (OpenRouter prompt caching)
+    """
+
+    def __init__(self, system_prompt: str, estimator: TokenEstimator, history_token_budget: int = 1500,
+                 message_token_limit: int = 500, summary_token_budget: int = 250,
+                 summary_line_tokens: int = 40, summary_cache_size: int = 512,
+                 cache_control: bool = False):
+        self.system_prompt = system_prompt
+        # System message dựng một lần, dùng chung cho mọi request (không được sửa)
+        if cache_control:
+            self._system_message = {"role": "system", "content": [
+                {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
+            ]}
+        else:
+            self._system_message = {"role": "system", "content": system_prompt}
+        self.estimator = estimator
+        self.history_token_budget = history_token_budget
+        self.message_token_limit = message_token_limit
+        self.summary_token_budget = summary_token_budget
+        self.summary_line_tokens = summary_line_tokens
+        self.summary_cache_size = summary_cache_size
+
+        self._summary_cache: "OrderedDict[bytes, Tuple[Tuple[str, int], ...]]" = OrderedDict()
+        self._summary_lock = threading.Lock()
+        self.summary_hits = 0
+        self.summary_misses = 0
+
+    def _clip(self, text: str, max_tokens: int) -> Tuple[str, int]:
+        """Cắt text cho vừa max_tokens (ước lượng theo tỉ lệ ký tự), trả về (text, số token)"""
+        tokens = self.estimator.count(text)
+        if tokens <= max_tokens:
+            return text, tokens
+        # Chừa chỗ cho dấu "…"; text trộn ASCII/có dấu không đều nên cắt thêm tới khi vừa
+        budget = max(0, max_tokens - self.estimator.count("…"))
+        keep_chars = max(1, int(len(text) * budget / tokens))
+        while True:
+            clipped = text[:keep_chars].rstrip() + "…"
+            clipped_tokens = self.estimator.count(clipped)
+            if clipped_tokens <= max_tokens or keep_chars <= 1:
+                return clipped, clipped_tokens
+            keep_chars = max(1, keep_chars - max(1, keep_chars // 20))
+
+    def _summary_line(self, role: str, content: str) -> Tuple[str, int]:
+        """Rút gọn một lượt cũ: câu đầu tiên, tối đa summary_line_tokens"""
+        content = _WHITESPACE_RE.sub(" ", content).strip()
+        first_sentence = _SENTENCE_END_RE.split(content, 1)[0]
+        speaker = "Người dùng" if role == "user" else "Trợ lý"
+        line, _ = self._clip(first_sentence, self.summary_line_tokens)
+        line = f"- {speaker}: {line}"
+        return line, self.estimator.count(line)
+
+    def _rolling_summary(self, older: List[Tuple[str, str]]) -> str:
+        """
+        Tóm tắt các lượt cũ. Key cache là hash chuỗi (hash chain) của prefix history,
+        nên lượt sau tìm lại summary của prefix dài nhất đã có và chỉ nối thêm phần mới
+        """
+        if not older or self.summary_token_budget <= 0:
+            return ""
+
+        digests = []
+        digest = b""
+        for role, content in older:
+            digest = hashlib.blake2b(digest + role.encode() + b"\0" + content.encode("utf-8"),
+                                     digest_size=16).digest()
+            digests.append(digest)
+
+        with self._summary_lock:
+            lines: Tuple[Tuple[str, int], ...] = ()
+            start = 0
+            for i in range(len(digests) - 1, -1, -1):
+                cached = self._summary_cache.get(digests[i])
+                if cached is not None:
+                    self._summary_cache.move_to_end(digests[i])
+                    lines, start = cached, i + 1
+                    break
+            if start == len(older):
+                self.summary_hits += 1
+                return "\n".join(line for line, _ in lines)
+            self.summary_misses += 1
+
+        new_lines = list(lines) + [self._summary_line(role, content) for role, content in older[start:]]
+        # Rolling: vượt ngân sách thì bỏ các dòng cũ nhất
+        total = sum(tokens for _, tokens in new_lines)
+        drop = 0
+        while total > self.summary_token_budget and drop < len(new_lines):
+            total -= new_lines[drop][1]
+            drop += 1
+        lines = tuple(new_lines[drop:])
+
+        with self._summary_lock:
+            self._summary_cache[digests[-1]] = lines
+            self._summary_cache.move_to_end(digests[-1])
+            while len(self._summary_cache) > self.summary_cache_size:
+                self._summary_cache.popitem(last=False)
+        return "\n".join(line for line, _ in lines)
+
+    def assemble(self, question: str, history: Optional[List[Dict[str, str]]] = None) -> AssembledPrompt:
+        """Dựng prompt cho một request: system + (summary) + history vừa ngân sách + câu hỏi"""
+        turns = []
+        for msg in history or ():
+            role = msg.get("role", "")
+            content = msg.get("content", "")
+            if role in ("user", "assistant") and content:
+                turns.append((role, content))
+
+        # Chọn từ mới → cũ, dừng ở message đầu tiên không vừa (giữ history liên tục)
+        kept = []
+        used = 0
+        split = len(turns)
+        for i in range(len(turns) - 1, -1, -1):
+            role, content = turns[i]
+            content, tokens = self._clip(content, self.message_token_limit)
+            tokens += MESSAGE_OVERHEAD_TOKENS
+            if used + tokens > self.history_token_budget:
+                break
+            kept.append((role, content))
+            used += tokens
+            split = i
+        kept.reverse()
+
+        summary = self._rolling_summary(turns[:split])
+
+        messages = [self._system_message]
+        parts = []
+        if summary:
+            summary_block = f"{SUMMARY_HEADER}\n{summary}"
+            messages.append({"role": "system", "content": summary_block})
+            parts += [summary_block, "\n\n"]
+        for role, content in kept:
+            messages.append({"role": role, "content": content})
+            parts += ["User: " if role == "user" else "Assistant: ", content, "\n"]
+        messages.append({"role": "user", "content": question})
+        parts += ["User: ", question, "\nAssistant:"]
+
+        dialogue = "".join(parts)
+        return AssembledPrompt(
+            messages=messages,
+            text=f"{self.system_prompt}\n\n{dialogue}",
+            dialogue=dialogue,
+            tokens=self.estimator.count(self.system_prompt) + self.estimator.count(dialogue),
+            kept=len(kept),
+            compacted=split,
+            summary=summary
+        )
+
+    def get_stats(self) -> Dict:
+        with self._summary_lock:
+            entries = len(self._summary_cache)
+        return {
+            "token_scale": round(self.estimator.scale, 3),
+            "calibration_samples": self.estimator.samples,
+            "summary_cache_entries": entries,
+            "summary_hits": self.summary_hits,
+            "summary_misses": self.summary_misses
+        }
+
+
+def create_prompt_assembler(system_prompt: str) -> PromptAssembler:
+    """Tạo PromptAssembler với cấu hình từ biến môi trường"""
+    estimator = TokenEstimator(
+        ascii_chars_per_token=float(os.getenv("TOKEN_ASCII_CHARS_PER_TOKEN", "4.0")),
+        other_chars_per_token=float(os.getenv("TOKEN_OTHER_CHARS_PER_TOKEN", "1.6"))
+    )
+    return PromptAssembler(
+        system_prompt,
+        estimator,
+        history_token_budget=int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500")),
+        message_token_limit=int(os.getenv("CHAT_MESSAGE_TOKEN_LIMIT", "500")),
+        summary_token_budget=int(os.getenv("CHAT_SUMMARY_TOKEN_BUDGET", "250")),
+        summary_line_tokens=int(os.getenv("CHAT_SUMMARY_LINE_TOKENS", "40")),
+        summary_cache_size=int(os.getenv("CHAT_SUMMARY_CACHE_SIZE", "512")),
+        cache_control=os.getenv("OPENROUTER_PROMPT_CACHE", "1") == "1"
+    )
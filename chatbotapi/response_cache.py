@@ -0,0 +1,286 @@
+"""
+Cache câu trả lời /chat theo câu hỏi đã chuẩn hóa
+- Key = câu hỏi chuẩn hóa (NFC, chữ thường, bỏ dấu câu, GIỮ dấu tiếng Việt) + vài message history gần nhất
+  ("bơ", "bò", "bố" là các từ khác nhau, không được trùng key)
+- Tra exact-match trước, sau đó near-duplicate: MinHash/LSH trên character 3-gram của câu đã bỏ dấu
+  chỉ dùng để tìm ứng viên, ứng viên phải qua bước xác nhận có dấu:
+    + Jaccard trên 3-gram của câu có dấu >= ngưỡng
+    + Các từ có ở câu này mà không có ở câu kia đều là từ đệm / hư từ ("ạ", "bị", "vậy"...).
+      Khác nhau ở số/đơn vị ("60kg" ↔ "80kg"), từ nội dung ("sáng" ↔ "tối"), từ chỉ khác dấu
+      ("bơ" ↔ "bò") hay từ phủ định ("nên ăn gì" ↔ "không nên ăn gì") đều là câu hỏi khác
+- TTL + LRU eviction, giữ trong memory của process
+"""
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_WHITESPACE_RE = re.compile(r"\s+")
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# Từ đệm / hư từ không đổi nghĩa câu hỏi: hai câu gần trùng chỉ được khác nhau ở các từ này
+# (không có từ phủ định "không", "chưa"... hay từ chỉ lượng "ít", "nhiều")
+_FILLER_WORDS = frozenset({
+    "ạ", "à", "ơi", "nhé", "nha", "nhỉ", "hả", "hở", "vậy", "thế", "đi", "chứ", "ấy",
+    "bị", "là", "thì", "mà", "có", "được", "cho", "của", "với", "và", "những", "các", "cái",
+    "tôi", "mình", "em", "anh", "chị", "bạn", "cháu", "con", "xin", "hỏi", "biết",
+    "ơn", "giúp", "làm", "sao", "nào", "người", "nên",
+})
+
+
+def normalize_question(text: str) -> str:
+    """
+    Chuẩn hóa câu hỏi nhưng giữ dấu tiếng Việt (NFC để cùng một chữ có dấu luôn ra cùng một chuỗi):
+    "Béo phì nên ăn gì?" → "béo phì nên ăn gì"
+    """
+    text = unicodedata.normalize("NFC", text).lower()
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def normalize_vietnamese(text: str) -> str:
+    """
+    Chuẩn hóa câu tiếng Việt không phân biệt dấu:
+    "Béo phì nên ăn gì?" → "beo phi nen an gi"
+    """
+    text = text.lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def _shingles(text: str, n: int = 3) -> set:
+    """Character n-gram của câu đã chuẩn hóa"""
+    padded = f" {text} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class _Question:
+    """Các dạng của một câu hỏi dùng để so khớp"""
+    __slots__ = ("text", "words", "shingles", "folded_shingles")
+
+    def __init__(self, question: str):
+        self.text = normalize_question(question)
+        self.words = frozenset(self.text.split())
+        self.shingles = _shingles(self.text)
+        self.folded_shingles = _shingles(normalize_vietnamese(self.text))
+
+    def similarity(self, other: "_Question") -> Optional[float]:
+        """Jaccard trên 3-gram có dấu, None nếu hai câu khác nhau ở từ có nghĩa"""
+        # Số/đơn vị ("60kg"), từ nội dung, từ phủ định không bao giờ là từ đệm
+        if not (self.words ^ other.words) <= _FILLER_WORDS:
+            return None
+        union = len(self.shingles | other.shingles)
+        return len(self.shingles & other.shingles) / union if union else 0.0
+
+
+class _CacheEntry:
+    __slots__ = ("answer", "question", "signature", "context_key", "expires_at")
+
+    def __init__(self, answer, question, signature, context_key, expires_at):
+        self.answer = answer
+        self.question = question
+        self.signature = signature
+        self.context_key = context_key
+        self.expires_at = expires_at
+
+
+class ChatResponseCache:
+    """
+    Cache câu trả lời chat (exact + near-duplicate)
+
+    Args:
+        max_entries: Số entry tối đa (LRU eviction khi vượt)
+        ttl_seconds: Thời gian sống của mỗi câu trả lời
+        history_window: Số message history gần nhất đưa vào key
+        similarity_threshold: Ngưỡng Jaccard (3-gram có dấu) để coi là câu hỏi trùng
+        num_perm: Số hàm hash MinHash (chia đều cho các band LSH)
+        bands: Số band LSH
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: int = 6 * 3600,
+                 history_window: int = 2, similarity_threshold: float = 0.8,
+                 num_perm: int = 64, bands: int = 16):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm phải chia hết cho bands")
+
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.history_window = history_window
+        self.similarity_threshold = similarity_threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+
+        rng = random.Random(1234)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = {}
+
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    # ------------------------------------------------------------------
+    # Key / signature
+    # ------------------------------------------------------------------
+    def _context_key(self, history: Optional[List[Dict[str, str]]]) -> str:
+        """Phần history gần nhất (đã chuẩn hóa, giữ dấu) tham gia vào key"""
+        if not history or self.history_window <= 0:
+            return ""
+        parts = []
+        for msg in history[-self.history_window:]:
+            role = msg.get("role", "")
+            content = msg.get("content", "")
+            if role in ("user", "assistant") and content:
+                parts.append(f"{role}:{normalize_question(content)}")
+        return "|".join(parts)
+
+    @staticmethod
+    def _exact_key(normalized_question: str, context_key: str) -> str:
+        raw = f"{context_key}\x00{normalized_question}".encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def _signature(self, shingles: set) -> tuple:
+        """MinHash signature"""
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+                  for s in shingles]
+        return tuple(min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._perms)
+
+    def _band_keys(self, signature: tuple, context_key: str):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield (context_key, band, signature[start:start + self.rows])
+
+    # ------------------------------------------------------------------
+    # Index maintenance (gọi khi đang giữ lock)
+    # ------------------------------------------------------------------
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band_key in self._band_keys(entry.signature, entry.context_key):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    def get(self, question: str, history: Optional[List[Dict[str, str]]] = None) -> Optional[str]:
+        """
+        Lấy câu trả lời đã cache
+
+        Returns:
+            Câu trả lời hoặc None nếu cache miss
+        """
+        normalized = _Question(question)
+        context_key = self._context_key(history)
+        key = self._exact_key(normalized.text, context_key)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.exact_hits += 1
+                    return entry.answer
+                self._remove(key)
+
+        # Near-duplicate: tính signature (câu bỏ dấu) ngoài lock
+        signature = self._signature(normalized.folded_shingles)
+
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(signature, context_key):
+                candidates.update(self._buckets.get(band_key, ()))
+
+            best_key, best_score = None, 0.0
+            for candidate_key in candidates:
+                candidate = self._entries.get(candidate_key)
+                if candidate is None:
+                    continue
+                if candidate.expires_at <= now:
+                    self._remove(candidate_key)
+                    continue
+                score = normalized.similarity(candidate.question)
+                if score is not None and score > best_score:
+                    best_key, best_score = candidate_key, score
+
+            if best_key is not None and best_score >= self.similarity_threshold:
+                self._entries.move_to_end(best_key)
+                self.near_hits += 1
+                print(f"✅ Chat cache NEAR HIT (similarity {best_score:.2f})")
+                return self._entries[best_key].answer
+
+            self.misses += 1
+            return None
+
+    def set(self, question: str, history: Optional[List[Dict[str, str]]], answer: str):
+        """Lưu câu trả lời vào cache"""
+        normalized = _Question(question)
+        context_key = self._context_key(history)
+        key = self._exact_key(normalized.text, context_key)
+        signature = self._signature(normalized.folded_shingles)
+        entry = _CacheEntry(answer, normalized, signature, context_key, time.time() + self.ttl_seconds)
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            for band_key in self._band_keys(signature, context_key):
+                self._buckets.setdefault(band_key, set()).add(key)
+            self._evict()
+
+    def clear(self):
+        """Xóa toàn bộ cache"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def get_stats(self) -> Dict:
+        """Thống kê hit/miss"""
+        with self._lock:
+            hits = self.exact_hits + self.near_hits
+            total = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / total, 4) if total else 0.0
+            }
+
+
+# Singleton instance
+_response_cache_instance = None
+
+def get_response_cache_instance() -> ChatResponseCache:
+    """Get or create response cache singleton (cấu hình từ biến môi trường)"""
+    global _response_cache_instance
+    if _response_cache_instance is None:
+        _response_cache_instance = ChatResponseCache(
+            max_entries=int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1000")),
+            ttl_seconds=int(os.getenv("CHAT_CACHE_TTL_SECONDS", str(6 * 3600))),
+            history_window=int(os.getenv("CHAT_CACHE_HISTORY_WINDOW", "2")),
+            similarity_threshold=float(os.getenv("CHAT_CACHE_SIMILARITY", "0.8"))
+        )
+    return _response_cache_instance
@@ -0,0 +1,236 @@
+"""
+Định dạng câu trả lời của model thành văn bản hiển thị (dùng chung cho assistant.py và assistant_openrouter.py)
+Kết quả giống hệt _process_response/_prettify_text cũ (từng byte), chỉ nhanh hơn:
+- JSON (title/summary/bullets/meals/notes) → các dòng text; chỉ gọi json.loads khi text có thể là
+  JSON object ("{...}"), câu trả lời thường không tốn lần parse thất bại nào
+- Text/markdown → bỏ ký hiệu markdown/icon, mỗi dòng không rỗng một đoạn; dòng header ("...:" hoặc
+  "Nên/Ưu/Hạn chế/Gợi ý/Bạn nên...") gom MỌI dòng sau nó (kể cả qua dòng trống) tới dòng kết thúc
+  bằng ":" thành câu liệt kê; cuối cùng khoảng trắng liên tiếp (kể cả giữa các đoạn) gộp thành một dấu cách
+- Một lượt duyệt theo dòng (state machine), regex biên dịch sẵn, bỏ ký tự bằng str.replace
+- StreamFormatter nhận từng chunk khi stream và trả về phần câu trả lời ngay khi phần đó chắc chắn
+  không đổi; nối các phần lại được đúng format_response trên toàn bộ text
+"""
+import json
+import re
+from typing import Dict, List, Optional
+
+# Markdown/icon bị bỏ khỏi text (** và ` được bỏ cùng lượt). str.replace nhanh hơn translate/regex
+# với text có dấu (chuỗi non-ASCII)
+_DELETE_CHARS = "`•*+-✅❌"
+# Chỉ \r và \n tách dòng (\v, \f, \u2028... là khoảng trắng trong dòng)
+_NEWLINE_RE = re.compile(r"[\r\n]+")
+_HEADER_PREFIX_RE = re.compile(r"(?:Nên|Ưu|Hạn chế|Gợi ý|Gợi ý bữa|Bạn nên|Nên hạn chế)", re.I)
+_MULTI_SPACE_RE = re.compile(r"\s{2,}")
+# Khoảng trắng json.loads bỏ qua ở hai đầu
+_JSON_WHITESPACE = " \t\n\r"
+# Ngăn cách giữa các đoạn sau khi gộp khoảng trắng ("\n\n" cũ → " ")
+PARAGRAPH_SEPARATOR = " "
+
+
+def _strip_markup(text: str) -> str:
+    """Bỏ ký hiệu markdown/icon"""
+    for char in _DELETE_CHARS:
+        if char in text:
+            text = text.replace(char, "")
+    return text
+
+
+def render_json(parsed: Dict) -> str:
+    """
+    JSON object theo schema của system prompt → text ("" nếu không có field nào)
+
+    Raises:
+        AttributeError, TypeError: Field sai kiểu (VD title là số)
+    """
+    parts = []
+    if parsed.get("title"):
+        parts.append(parsed["title"].strip())
+    if parsed.get("summary"):
+        parts.append(parsed["summary"].strip())
+    bullets = parsed.get("bullets")
+    if bullets and isinstance(bullets, list):
+        bullets = [b.strip().rstrip(".") for b in bullets if b]
+        if bullets:
+            parts.append("Bạn nên: " + ", ".join(bullets) + ".")
+    meals = parsed.get("meals")
+    if meals and isinstance(meals, list):
+        parts.append("\n".join([m.strip() for m in meals if m]))
+    if parsed.get("notes"):
+        parts.append("Ghi chú: " + parsed["notes"].strip())
+    return "\n".join([p for p in parts if p])
+
+
+def _parse_json_object(text: str) -> Optional[Dict]:
+    """json.loads(text) nếu kết quả là dict, None nếu không (không parse khi chắc chắn không phải object)"""
+    body = text.strip(_JSON_WHITESPACE)
+    if not (body.startswith("{") and body.endswith("}")):
+        return None
+    try:
+        parsed = json.loads(text)
+    except Exception:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+class _ParagraphBuilder:
+    """
+    State machine theo dòng (dòng đã bỏ ký hiệu, strip và không rỗng), ghi đoạn văn hoàn chỉnh vào out
+
+    - Dòng thường → một đoạn
+    - Dòng header → các dòng tiếp theo là item, tới dòng kết thúc bằng ":" hoặc hết text
+      → "Header: item1, item2."
+    - Header không có item nào → giữ nguyên dòng
+    """
+
+    __slots__ = ("out", "header", "items")
+
+    def __init__(self, out: List[str]):
+        self.out = out
+        self.header: Optional[str] = None
+        self.items: List[str] = []
+
+    def lines(self, lines: List[str]):
+        out = self.out
+        is_header = _HEADER_PREFIX_RE.match
+        for line in lines:
+            if self.header is not None:
+                if not line.endswith(":"):
+                    self.items.append(line.rstrip("."))
+                    continue
+                self._close_block()
+            if line.endswith(":") or is_header(line):
+                self.header = line
+            else:
+                out.append(line)
+
+    def finish(self):
+        if self.header is not None:
+            self._close_block()
+
+    def _close_block(self):
+        header, items = self.header, self.items
+        self.header = None
+        self.items = []
+        if items:
+            self.out.append(header.rstrip(":").strip() + ": " + ", ".join(items) + ".")
+        else:
+            self.out.append(header)
+
+
+def _split_lines(text: str) -> List[str]:
+    """Tách theo \r/\n, strip từng dòng, bỏ dòng rỗng"""
+    return [line for line in (ln.strip() for ln in _NEWLINE_RE.split(text)) if line]
+
+
+def prettify_paragraphs(raw: str) -> List[str]:
+    """Text/markdown → danh sách đoạn văn (chưa gộp khoảng trắng)"""
+    paragraphs: List[str] = []
+    builder = _ParagraphBuilder(paragraphs)
+    builder.lines(_split_lines(_strip_markup(raw)))
+    builder.finish()
+    return paragraphs
+
+
+def prettify_text(raw: str) -> str:
+    """Cố gắng chuyển các bullet/markdown thành đoạn văn tiếng Việt đẹp hơn"""
+    if not raw or not raw.strip():
+        return raw
+    paragraphs = prettify_paragraphs(raw)
+    if not paragraphs:
+        # Chỉ có ký hiệu markdown/icon
+        return ""
+    # Đoạn văn không có khoảng trắng ở hai đầu → gộp trên từng đoạn hay trên cả text như nhau
+    return _MULTI_SPACE_RE.sub(" ", PARAGRAPH_SEPARATOR.join(paragraphs))
+
+
+def format_response(text: str) -> str:
+    """Câu trả lời của model → text hiển thị: JSON object theo schema nếu render được, còn lại prettify_text"""
+    parsed = _parse_json_object(text)
+    if parsed is not None:
+        try:
+            pretty = render_json(parsed)
+        except (AttributeError, TypeError):
+            pretty = ""
+        if pretty:
+            return pretty
+    return prettify_text(text)
+
+
+class StreamFormatter:
+    """
+    format_response tăng dần cho stream (kết quả ứng với format_response của toàn bộ text đã strip):
+
+        formatter = StreamFormatter()
+        for chunk in chunks:
+            for delta in formatter.feed(chunk):
+                ...
+        for delta in formatter.close():
+            ...
+
+    "".join(mọi delta) == format_response("".join(chunks).strip())
+
+    Text thường: mỗi dòng hoàn chỉnh được xử lý ngay; đoạn văn thường được trả về ngay, khối liệt kê sau
+    header chỉ trả về khi gặp header kế tiếp hoặc hết stream (dòng trống không kết thúc khối).
+    Câu trả lời bắt đầu bằng "{" (có thể là JSON object) được gom lại và format một lần ở close()
+    """
+
+    __slots__ = ("_paragraphs", "_builder", "_pending", "_buffer_all", "_emitted")
+
+    def __init__(self):
+        self._paragraphs: List[str] = []
+        self._builder = _ParagraphBuilder(self._paragraphs)
+        # Dòng chưa hoàn chỉnh (text) hoặc toàn bộ câu trả lời (JSON), giữ dạng list để nối một lần
+        self._pending: List[str] = []
+        self._buffer_all: Optional[bool] = None
+        self._emitted = False
+
+    def feed(self, chunk: str) -> List[str]:
+        """Thêm một chunk, trả về các delta vừa chắc chắn"""
+        if not chunk:
+            return []
+        if self._buffer_all is None:
+            head = chunk.lstrip()
+            if not head:
+                self._pending.append(chunk)
+                return []
+            self._buffer_all = head[0] == "{"
+            if not self._buffer_all:
+                # Khoảng trắng đầu text không ảnh hưởng kết quả
+                self._pending = []
+                chunk = head
+        if self._buffer_all:
+            self._pending.append(chunk)
+            return []
+
+        chunk = _strip_markup(chunk)
+        self._pending.append(chunk)
+        if "\n" not in chunk and "\r" not in chunk:
+            return []
+        text = "".join(self._pending)
+        cut = max(text.rfind("\n"), text.rfind("\r")) + 1
+        self._pending = [text[cut:]]
+        self._builder.lines(_split_lines(text[:cut]))
+        return self._take()
+
+    def close(self) -> List[str]:
+        """Kết thúc stream, trả về các delta còn lại"""
+        text = "".join(self._pending)
+        self._pending = []
+        if self._buffer_all:
+            pretty = format_response(text.strip())
+            return [pretty] if pretty else []
+        if self._buffer_all is None:
+            # Stream rỗng / chỉ có khoảng trắng
+            return []
+        self._builder.lines(_split_lines(text))
+        self._builder.finish()
+        return self._take()
+
+    def _take(self) -> List[str]:
+        deltas = []
+        for paragraph in self._paragraphs:
+            paragraph = _MULTI_SPACE_RE.sub(" ", paragraph)
+            deltas.append(PARAGRAPH_SEPARATOR + paragraph if self._emitted else paragraph)
+            self._emitted = True
+        self._paragraphs.clear()
+        return deltas
@@ -1,105 +1,151 @@
 """
-Test script để demo cache system
+Benchmark tự động cho cache phân tích ảnh (chạy với server local đang bật)
+
+    python test_cache.py [đường_dẫn_ảnh]
+
+- Không truyền ảnh → tự tạo ảnh PNG ngẫu nhiên (mỗi lần chạy là ảnh mới → lần đầu chắc chắn MISS)
+- Kiểm tra: cache HIT < 100ms cho cả /analyze-image và /analyze-nutrition,
+  upload đồng thời cùng một ảnh chỉ phân tích một lần (single-flight)
+- Exit code 0 nếu pass, 1 nếu fail
 """
-import requests
+import base64
+import os
+import struct
+import sys
+import threading
 import time
+import zlib
+import requests
 
-API_URL = "http://localhost:8000"
+API_URL = os.getenv("CHATBOT_API_URL", "http://localhost:8000")
+HIT_THRESHOLD_SECONDS = 0.1
+CONCURRENT_UPLOADS = 5
 
-def test_cache_stats():
+def make_test_png(width: int = 64, height: int = 64) -> bytes:
+    """Tạo ảnh PNG RGB ngẫu nhiên chỉ bằng stdlib"""
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+def get_cache_stats() -> dict:
     """Xem stats cache"""
+    response = requests.get(f"{API_URL}/cache-stats")
+    response.raise_for_status()
+    return response.json()
+
+def print_cache_stats(stats: dict):
     print("\n📊 CACHE STATS:")
     print("=" * 50)
-    response = requests.get(f"{API_URL}/cache-stats")
-    stats = response.json()
-    
     print(f"Total entries: {stats['total_entries']}")
     print(f"Total cache hits: {stats['total_cache_hits']}")
     print(f"Average hits/entry: {stats['average_hits_per_entry']}")
     print(f"API calls SAVED: {stats['estimated_api_calls_saved']} 🚀")
     print("=" * 50)
 
-def test_analyze_image(image_path: str, run_number: int):
-    """Test phân tích ảnh"""
-    print(f"\n🔍 RUN #{run_number}: Analyzing {image_path}...")
-    
-    with open(image_path, 'rb') as f:
-        start_time = time.time()
-        
-        response = requests.post(
-            f"{API_URL}/analyze-image",
-            files={"file": f}
-        )
-        
-        elapsed = time.time() - start_time
-        
-        if response.status_code == 200:
-            result = response.json()
-            print(f"✅ Success in {elapsed:.2f}s")
-            
-            if "items" in result and len(result["items"]) > 0:
-                item = result["items"][0]
-                print(f"   Item: {item.get('item_name', 'Unknown')}")
-                print(f"   Calories: {item.get('nutrients', {}).get('enerc_kcal', 0)} kcal")
-        else:
-            print(f"❌ Error {response.status_code}: {response.text[:200]}")
-        
-        return elapsed
+def analyze_image(image_bytes: bytes, filename: str) -> tuple:
+    """POST /analyze-image, trả về (elapsed, result)"""
+    start_time = time.time()
+    response = requests.post(
+        f"{API_URL}/analyze-image",
+        files={"file": (filename, image_bytes, "image/png")}
+    )
+    elapsed = time.time() - start_time
+    response.raise_for_status()
+    return elapsed, response.json()
+
+def analyze_nutrition(image_bytes: bytes, filename: str) -> tuple:
+    """POST /analyze-nutrition (base64 JSON), trả về (elapsed, result)"""
+    start_time = time.time()
+    response = requests.post(
+        f"{API_URL}/analyze-nutrition",
+        json={"filename": filename, "image": base64.b64encode(image_bytes).decode()}
+    )
+    elapsed = time.time() - start_time
+    response.raise_for_status()
+    return elapsed, response.json()
+
+def run_benchmark(image_bytes: bytes, filename: str) -> list:
+    """Chạy các bước benchmark, trả về danh sách lỗi (rỗng = pass)"""
+    failures = []
+
+    # Test 1: First call (cache MISS)
+    print("\nTEST 1: First analysis (Cache MISS)")
+    miss_time, miss_result = analyze_image(image_bytes, filename)
+    item = miss_result["items"][0]
+    print(f"   {miss_time:.2f}s - {item['item_name']}, {item['nutrients'].get('enerc_kcal', 0)} kcal")
+
+    # Test 2-3: Same image again (cache HIT)
+    for run_number in (2, 3):
+        print(f"\nTEST {run_number}: Same image again (Cache HIT, expected < {HIT_THRESHOLD_SECONDS * 1000:.0f}ms)")
+        hit_time, hit_result = analyze_image(image_bytes, filename)
+        print(f"   {hit_time * 1000:.1f}ms")
+        if hit_time >= HIT_THRESHOLD_SECONDS:
+            failures.append(f"/analyze-image HIT #{run_number} took {hit_time * 1000:.1f}ms")
+        if hit_result["items"][0]["item_name"] != item["item_name"]:
+            failures.append("/analyze-image HIT returned a different item")
+
+    # Test 4: /analyze-nutrition dùng chung cache (cùng nội dung ảnh)
+    print("\nTEST 4: /analyze-nutrition with same image (Cache HIT)")
+    nutrition_time, nutrition_result = analyze_nutrition(image_bytes, filename)
+    print(f"   {nutrition_time * 1000:.1f}ms - {nutrition_result.get('food_name')}")
+    if nutrition_time >= HIT_THRESHOLD_SECONDS:
+        failures.append(f"/analyze-nutrition HIT took {nutrition_time * 1000:.1f}ms")
+
+    # Test 5: Upload đồng thời một ảnh MỚI → chỉ phân tích một lần
+    print(f"\nTEST 5: {CONCURRENT_UPLOADS} concurrent uploads of a new image (single-flight)")
+    entries_before = get_cache_stats()["total_entries"]
+    new_image = make_test_png()
+    timings = [None] * CONCURRENT_UPLOADS
+
+    def upload(index: int):
+        timings[index] = analyze_image(new_image, filename)[0]
+
+    threads = [threading.Thread(target=upload, args=(i,)) for i in range(CONCURRENT_UPLOADS)]
+    wall_start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.time() - wall_start
+    entries_added = get_cache_stats()["total_entries"] - entries_before
+
+    print(f"   Wall time: {wall_time:.2f}s (single MISS: {miss_time:.2f}s), entries added: {entries_added}")
+    if entries_added != 1:
+        failures.append(f"concurrent uploads created {entries_added} cache entries instead of 1")
+    if None in timings or wall_time > miss_time * 1.5 + 1:
+        failures.append("concurrent uploads were not coalesced into one analysis")
+
+    return failures
 
 if __name__ == "__main__":
     print("🧪 TESTING AI IMAGE ANALYSIS CACHE SYSTEM")
     print("=" * 50)
-    
-    # Test image path - update this to your test image
-    test_image = "D:\\App\\new\\test_food.jpg"
-    
-    print("\n⚠️  NOTE: Cần có file ảnh test tại:", test_image)
-    print("    Nếu không có, tạo file ảnh bất kỳ hoặc update path\n")
-    
-    # Initial stats
-    test_cache_stats()
-    
-    # Test 1: First call (cache MISS - will call API)
-    print("\n" + "=" * 50)
-    print("TEST 1: First analysis (Cache MISS)")
-    print("Expected: Slow (~5-10s) - API call")
-    print("=" * 50)
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            test_image = f.read()
+        test_filename = os.path.basename(sys.argv[1])
+    else:
+        test_image = make_test_png()
+        test_filename = "pho-bo.png"
+
     try:
-        time1 = test_analyze_image(test_image, 1)
-    except Exception as e:
+        print_cache_stats(get_cache_stats())
+        failures = run_benchmark(test_image, test_filename)
+        print_cache_stats(get_cache_stats())
+    except requests.RequestException as e:
         print(f"❌ Error: {e}")
-        print("\n💡 Tip: Đảm bảo có file ảnh test hoặc chờ API quota reset!")
-        exit(1)
-    
-    # Test 2: Second call (cache HIT - instant)
-    print("\n" + "=" * 50)
-    print("TEST 2: Same image again (Cache HIT)")
-    print("Expected: INSTANT (<0.1s) - from cache")
-    print("=" * 50)
-    time.sleep(1)
-    time2 = test_analyze_image(test_image, 2)
-    
-    # Test 3: Third call (cache HIT again)
-    print("\n" + "=" * 50)
-    print("TEST 3: Third time (Cache HIT)")
-    print("Expected: INSTANT (<0.1s) - from cache")
-    print("=" * 50)
-    time.sleep(1)
-    time3 = test_analyze_image(test_image, 3)
-    
-    # Final stats
-    test_cache_stats()
-    
-    # Summary
-    print("\n" + "=" * 50)
-    print("📈 PERFORMANCE SUMMARY:")
-    print("=" * 50)
-    print(f"Run 1 (API call):  {time1:.2f}s")
-    print(f"Run 2 (Cache hit): {time2:.2f}s - {((time1-time2)/time1*100):.0f}% faster! 🚀")
-    print(f"Run 3 (Cache hit): {time3:.2f}s - {((time1-time3)/time1*100):.0f}% faster! 🚀")
-    
-    if time2 < 0.5 and time3 < 0.5:
-        print("\n✅ CACHE WORKING PERFECTLY!")
-        print("💡 Estimated API cost saved: 66% (2 out of 3 calls)")
-    else:
-        print("\n⚠️  Cache might not be working. Check logs.")
+        print(f"\n💡 Tip: Đảm bảo server đang chạy tại {API_URL}")
+        sys.exit(1)
+
+    if failures:
+        print("\n⚠️  Cache benchmark FAILED:")
+        for failure in failures:
+            print(f"   - {failure}")
+        sys.exit(1)
+
+    print("\n✅ CACHE WORKING PERFECTLY!")
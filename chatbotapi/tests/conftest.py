@@ -0,0 +1,153 @@
+"""
+Fixture dùng chung cho test in-process (không cần server chạy ở localhost:8000)
+
+    cd chatbotapi && python -m pytest -q
+
+- Gemini SDK / OpenRouter được thay bằng FakeProviders (không gọi mạng, không tốn token)
+- Cache ảnh dùng SQLite trong tmp_path, không đụng ai_analysis_cache.db
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if CHATBOT_DIR not in sys.path:
+    sys.path.insert(0, CHATBOT_DIR)
+
+# main.py cần ít nhất một API key khi import; không export trace, không giả lập delay khi test
+os.environ.setdefault("GEMINI_API_KEY", "test-gemini-key")
+os.environ.setdefault("OPENROUTER_API_KEY", "test-openrouter-key")
+os.environ.setdefault("TRACING_EXPORTER", "none")
+os.environ.setdefault("SIMULATED_LATENCY", "off")
+
+
+class FakeProviders:
+    """
+    Gemini (generate_content blocking, chạy trên executor) và OpenRouter (httpx.MockTransport) giả
+
+    Attributes:
+        models: Danh sách Gemini model mà registry trả về
+        gemini_delay: Thời gian mỗi Gemini call (giây, blocking như SDK thật)
+        failing: Model (hoặc "openrouter") trả lỗi
+    """
+
+    def __init__(self):
+        self.models = ["model-a", "model-b"]
+        self.gemini_delay = 0.0
+        self.gemini_answer = "Gemini trả lời"
+        self.openrouter_answer = "OpenRouter trả lời"
+        self.failing = set()
+        self.gemini_calls = []
+        self.gemini_prompts = []
+        self.openrouter_calls = 0
+        self.openrouter_messages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def generate(self, model_name: str, prompt: str):
+        with self._lock:
+            self.gemini_calls.append(model_name)
+            self.gemini_prompts.append(prompt)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.gemini_delay)
+            if model_name in self.failing:
+                raise RuntimeError(f"429 quota exceeded for {model_name}")
+            return self.gemini_answer, 10, 5
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    async def openrouter_handler(self, request: httpx.Request) -> httpx.Response:
+        self.openrouter_calls += 1
+        self.openrouter_messages.append(json.loads(request.content)["messages"])
+        if "openrouter" in self.failing:
+            return httpx.Response(503, text="upstream unavailable")
+        return httpx.Response(200, json={
+            "choices": [{"message": {"content": self.openrouter_answer}}],
+            "usage": {"prompt_tokens": 20, "completion_tokens": 5}
+        })
+
+
+@pytest.fixture
+def providers() -> FakeProviders:
+    return FakeProviders()
+
+
+@pytest.fixture
+def make_assistant(providers, monkeypatch):
+    """
+    Tạo ChatbotAssistant nối với FakeProviders; biến môi trường truyền qua kwargs:
+
+        assistant = make_assistant(GEMINI_MAX_CONCURRENCY=2)
+    """
+    from assistant_openrouter import ChatbotAssistant
+    from response_cache import ChatResponseCache
+
+    created = []
+
+    def factory(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        assistant = ChatbotAssistant(gemini_api_key="test-gemini-key", openrouter_api_key="test-openrouter-key")
+        assistant.response_cache = ChatResponseCache()
+        assistant.model_registry.candidates = lambda: list(providers.models)
+        assistant.model_registry.get_model = lambda name: name
+        assistant._generate_gemini_text = providers.generate
+        assistant.openrouter_client = httpx.AsyncClient(
+            base_url=assistant.base_url, transport=httpx.MockTransport(providers.openrouter_handler)
+        )
+        created.append(assistant)
+        return assistant
+
+    yield factory
+    for assistant in created:
+        assistant.gemini_executor.shutdown(wait=True)
+
+
+@pytest.fixture
+def image_cache(tmp_path):
+    """ImageAnalysisCache trên SQLite tạm (flush/eviction không chạy nền trong lúc test)"""
+    from cache_manager import ImageAnalysisCache
+
+    cache = ImageAnalysisCache(str(tmp_path / "cache.db"), flush_interval=3600, eviction_interval=3600)
+    yield cache
+    cache.close()
+
+
+def make_jpeg(color=(200, 60, 20), size=(64, 48), pattern: bool = True) -> bytes:
+    """Ảnh JPEG nhỏ; pattern=True vẽ thêm sọc để ảnh có texture (dHash khác 0)"""
+    import io
+
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", size, color)
+    if pattern:
+        draw = ImageDraw.Draw(image)
+        for x in range(0, size[0], 8):
+            draw.rectangle([x, 0, x + 3, size[1]], fill=tuple(255 - c for c in color))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def client(image_cache, monkeypatch):
+    """TestClient của main.app, cache ảnh trỏ vào image_cache, không resolve Gemini model qua mạng"""
+    from fastapi.testclient import TestClient
+
+    import cache_manager
+    import main
+
+    monkeypatch.setattr(cache_manager, "_cache_instance", image_cache)
+    if main.chatbot_assistant is not None:
+        monkeypatch.setattr(main.chatbot_assistant.model_registry, "refresh_in_background", lambda: None)
+    with TestClient(main.app) as test_client:
+        yield test_client
@@ -0,0 +1,177 @@
+"""/analyze-batch: NDJSON stream mỗi ảnh một dòng, lỗi từng ảnh không làm hỏng cả batch"""
+import asyncio
+import base64
+import json
+import threading
+
+import pytest
+
+from conftest import make_jpeg
+
+
+def _ndjson(*items) -> bytes:
+    return b"".join(json.dumps(item).encode("utf-8") + b"\n" for item in items)
+
+
+def _item(filename: str, data: bytes) -> dict:
+    return {"filename": filename, "image": base64.b64encode(data).decode("ascii")}
+
+
+def _post_batch(client, body: bytes, **params):
+    return client.post("/analyze-batch", content=body, params=params,
+                       headers={"Content-Type": "application/x-ndjson"})
+
+
+def _lines(response) -> list:
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_failed_item_gets_an_error_line_and_the_rest_succeed(client):
+    pho, bun = make_jpeg((200, 120, 40)), make_jpeg((30, 160, 60))
+    response = _post_batch(client, _ndjson(
+        _item("pho-bo.jpg", pho),
+        _item("broken.jpg", b"not an image at all"),
+        _item("bun-cha.jpg", bun),
+        _item("pho-copy.jpg", pho),
+    ))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    *items, summary = _lines(response)
+    by_index = {item["index"]: item for item in items}
+    assert sorted(by_index) == [0, 1, 2, 3]
+    assert "error" in by_index[1] and "result" not in by_index[1]
+    assert by_index[0]["result"]["food_name"] == "Phở Bò"
+    # Ảnh trùng nội dung dùng chung một lần phân tích, giữ filename của chính nó
+    assert by_index[3]["result"] == by_index[0]["result"]
+    assert by_index[3]["filename"] == "pho-copy.jpg"
+    assert by_index[3]["image_hash"] == by_index[0]["image_hash"]
+    assert "error" not in by_index[2]
+    assert summary["done"] is True
+    assert {key: summary[key] for key in ("total", "unique", "cached", "analyzed", "errors")} == {
+        "total": 4, "unique": 3, "cached": 0, "analyzed": 2, "errors": 1
+    }
+
+    # Lần hai: ảnh hợp lệ lấy từ cache, ảnh lỗi vẫn lỗi
+    *items, summary = _lines(_post_batch(client, _ndjson(
+        _item("pho-bo.jpg", pho), _item("broken.jpg", b"not an image at all")
+    ), format="items"))
+    by_index = {item["index"]: item for item in items}
+    assert by_index[0]["cached"] is True
+    assert by_index[0]["result"]["items"][0]["item_name"] == "Phở Bò"
+    assert "error" in by_index[1]
+    assert (summary["cached"], summary["analyzed"], summary["errors"]) == (1, 0, 1)
+
+
+def test_multipart_batch_streams_one_line_per_file(client):
+    files = [("files", (f"pho-{index}.jpg", make_jpeg((40 * index, 80, 120)), "image/jpeg")) for index in range(3)]
+    response = client.post("/analyze-batch", files=files)
+    assert response.status_code == 200
+    *items, summary = _lines(response)
+    assert sorted(item["index"] for item in items) == [0, 1, 2]
+    assert summary["analyzed"] == 3
+
+
+def test_oversized_item_rejects_the_batch_with_413(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "UPLOAD_BODY_LIMIT", 64 * 1024 + 4096)
+    response = _post_batch(client, _ndjson(
+        _item("small.jpg", make_jpeg()),
+        _item("huge.jpg", b"\xff" * 200 * 1024),
+    ))
+    assert response.status_code == 413
+
+
+def test_oversized_multipart_file_rejects_the_batch_with_413(client):
+    from upload_handler import MAX_UPLOAD_BYTES
+
+    files = [
+        ("files", ("small.jpg", make_jpeg(), "image/jpeg")),
+        ("files", ("huge.jpg", b"\xff" * (MAX_UPLOAD_BYTES + 1), "image/jpeg")),
+    ]
+    assert client.post("/analyze-batch", files=files).status_code == 413
+
+
+def test_too_many_or_missing_items_are_rejected(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "BATCH_MAX_ITEMS", 2)
+    body = _ndjson(*(_item(f"{index}.jpg", make_jpeg((index, 0, 0))) for index in range(3)))
+    assert _post_batch(client, body).status_code == 400
+    assert _post_batch(client, _ndjson({"filename": "x.jpg"})).status_code == 400
+    assert _post_batch(client, b"").status_code == 400
+    assert _post_batch(client, _ndjson(_item("a.jpg", make_jpeg())), format="xml").status_code == 400
+
+
+def test_disconnect_waits_for_preprocess_before_closing_uploads(image_cache, monkeypatch):
+    """Client ngắt kết nối khi preprocess còn đọc file trên thread pool → file chỉ đóng sau khi thread đọc xong"""
+    from starlette.requests import Request
+
+    import cache_manager
+    import image_preprocess
+    import main
+
+    monkeypatch.setattr(cache_manager, "_cache_instance", image_cache)
+    uploads, reading, read_errors = [], [], []
+    started, release = threading.Event(), threading.Event()
+    preprocess_image = image_preprocess.preprocess_image
+    spool_base64 = main.spool_base64
+
+    def slow_preprocess(file):
+        reading.append(file)
+        started.set()
+        release.wait(5)
+        try:
+            return preprocess_image(file)
+        except ValueError as e:
+            read_errors.append(e)
+            raise
+
+    async def recording_spool_base64(data):
+        upload = await spool_base64(data)
+        uploads.append(upload)
+        return upload
+
+    monkeypatch.setattr(image_preprocess, "preprocess_image", slow_preprocess)
+    monkeypatch.setattr(main, "spool_base64", recording_spool_base64)
+    body = _ndjson(_item("pho-bo.jpg", make_jpeg()), _item("bun-cha.jpg", make_jpeg((30, 160, 60))))
+
+    async def scenario():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                return {"type": "http.disconnect"}
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        request = Request({
+            "type": "http", "method": "POST", "path": "/analyze-batch", "query_string": b"",
+            "headers": [(b"content-type", b"application/x-ndjson")]
+        }, receive)
+        response = await main.analyze_batch(request, "nutrition")
+        stream = response.body_iterator
+        first_line = asyncio.ensure_future(stream.__anext__())
+        loop = asyncio.get_running_loop()
+        assert await loop.run_in_executor(None, started.wait, 5)
+
+        # Client ngắt kết nối: hủy vòng lặp stream trong lúc preprocess đang chạy
+        first_line.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first_line
+        await asyncio.sleep(0.05)
+        assert len(uploads) == 2
+        # Upload bị hủy trước khi preprocess chạy thì đóng ngay; file đang được thread đọc thì chưa
+        assert reading and not any(file.closed for file in reading)
+
+        release.set()
+        for _ in range(200):
+            if all(upload.file.closed for upload in uploads):
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert all(upload.file.closed for upload in uploads)
+    assert read_errors == []
@@ -0,0 +1,89 @@
+"""/analyze-image và /analyze-nutrition: phục vụ từ cache theo SHA256 nội dung ảnh"""
+import base64
+
+from conftest import make_jpeg
+
+
+def _analyze_image(client, data: bytes, filename: str = "pho-bo.jpg"):
+    return client.post("/analyze-image", files={"file": (filename, data, "image/jpeg")})
+
+
+def test_empty_upload_is_rejected_with_400(client):
+    response = _analyze_image(client, b"")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "File ảnh rỗng"
+
+
+def test_invalid_image_does_not_leak_error_details(client):
+    response = _analyze_image(client, b"not an image at all")
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Lỗi khi phân tích ảnh. Vui lòng thử lại sau."
+
+
+def test_second_upload_of_same_image_is_a_cache_hit(client, image_cache):
+    data = make_jpeg()
+    first = _analyze_image(client, data)
+    assert first.status_code == 200
+    assert first.json()["items"][0]["item_name"] == "Phở Bò"
+    assert image_cache.l1_hits + image_cache.l2_hits == 0
+
+    second = _analyze_image(client, data, filename="renamed.jpg")
+    assert second.status_code == 200
+    # Cache theo nội dung ảnh, không theo tên file
+    assert second.json()["items"][0]["item_name"] == "Phở Bò"
+    assert image_cache.l1_hits == 1
+
+
+def test_analyze_nutrition_shares_the_cache_with_analyze_image(client, image_cache):
+    data = make_jpeg()
+    assert _analyze_image(client, data).status_code == 200
+
+    response = client.post("/analyze-nutrition", json={
+        "filename": "something-else.jpg",
+        "image": base64.b64encode(data).decode("ascii")
+    })
+    assert response.status_code == 200
+    assert response.json()["food_name"] == "Phở Bò"
+    assert image_cache.l1_hits == 1
+
+
+def test_concurrent_identical_uploads_preprocess_once(image_cache, monkeypatch):
+    """Single-flight bao cả bước preprocess: upload trùng hash đang chờ không decode lại ảnh"""
+    import asyncio
+    import time
+
+    import cache_manager
+    import image_preprocess
+    import main
+    from upload_handler import SpooledUpload
+
+    monkeypatch.setattr(cache_manager, "_cache_instance", image_cache)
+    preprocess_calls = []
+    preprocess_image = image_preprocess.preprocess_image
+
+    def slow_preprocess(file):
+        preprocess_calls.append(file)
+        time.sleep(0.2)
+        return preprocess_image(file)
+
+    monkeypatch.setattr(image_preprocess, "preprocess_image", slow_preprocess)
+    data = make_jpeg()
+
+    def spooled():
+        upload = SpooledUpload()
+        upload.write(data)
+        return upload.finish()
+
+    async def run():
+        uploads = [spooled() for _ in range(4)]
+        try:
+            return await asyncio.gather(*[
+                main._analyze_with_cache(upload, "pho-bo.jpg", "analyze_image") for upload in uploads
+            ])
+        finally:
+            for upload in uploads:
+                upload.close()
+
+    results = asyncio.run(run())
+    assert len(preprocess_calls) == 1
+    assert [result["food_name"] for result in results] == ["Phở Bò"] * 4
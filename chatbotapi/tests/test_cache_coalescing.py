@@ -0,0 +1,82 @@
+"""Async façade của ImageAnalysisCache: request trùng hash dùng chung một lookup / một lần phân tích"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+RESULT = {"is_food": True, "food_name": "Phở Bò", "confidence": 0.9, "nutrients": []}
+IMAGE_HASH = "d" * 64
+
+
+@pytest.fixture
+def slow_lookups(image_cache):
+    """get_by_hash chậm 0.2s, đếm số lần chạy thật"""
+    calls = []
+    original = image_cache.get_by_hash
+
+    def slow_get_by_hash(image_hash):
+        calls.append(image_hash)
+        time.sleep(0.2)
+        if image_hash.startswith("e"):
+            raise RuntimeError("database is locked")
+        return original(image_hash)
+
+    image_cache.get_by_hash = slow_get_by_hash
+    return calls
+
+
+def test_concurrent_gets_share_one_lookup(image_cache, slow_lookups):
+    image_cache.set_by_hash(IMAGE_HASH, RESULT)
+
+    async def run():
+        return await asyncio.gather(*[image_cache.aget_by_hash(IMAGE_HASH) for _ in range(5)])
+
+    assert asyncio.run(run()) == [RESULT] * 5
+    assert slow_lookups == [IMAGE_HASH]
+
+
+def test_cancelled_first_caller_does_not_cancel_waiters(image_cache, slow_lookups):
+    image_cache.set_by_hash(IMAGE_HASH, RESULT)
+
+    async def run():
+        first = asyncio.ensure_future(image_cache.aget_by_hash(IMAGE_HASH))
+        await asyncio.sleep(0.05)
+        waiters = [asyncio.ensure_future(image_cache.aget_by_hash(IMAGE_HASH)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        first.cancel()
+        results = await asyncio.gather(*waiters)
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return results
+
+    assert asyncio.run(run()) == [RESULT] * 3
+    assert slow_lookups == [IMAGE_HASH]
+
+
+def test_lookup_errors_reach_every_waiter(image_cache, slow_lookups):
+    async def run():
+        return await asyncio.gather(*[image_cache.aget_by_hash("e" * 64) for _ in range(3)], return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert [type(e) for e in errors] == [RuntimeError] * 3
+    assert len(slow_lookups) == 1
+
+
+def test_single_flight_runs_compute_once(image_cache):
+    computes = []
+
+    async def compute():
+        computes.append(threading.get_ident())
+        await asyncio.sleep(0.1)
+        return RESULT
+
+    async def run():
+        first = asyncio.ensure_future(image_cache.asingle_flight(IMAGE_HASH, compute))
+        await asyncio.sleep(0.01)
+        others = [asyncio.ensure_future(image_cache.asingle_flight(IMAGE_HASH, compute)) for _ in range(3)]
+        first.cancel()
+        return await asyncio.gather(*others)
+
+    assert asyncio.run(run()) == [RESULT] * 3
+    assert len(computes) == 1
@@ -0,0 +1,240 @@
+"""ImageAnalysisCache: HIT/MISS theo SHA256, lưu bền trong SQLite, access stats flush theo batch"""
+import sqlite3
+
+from cache_manager import ImageAnalysisCache
+
+RESULT = {"is_food": True, "food_name": "Phở Bò", "confidence": 0.9, "nutrients": []}
+
+
+def test_miss_then_hit(image_cache):
+    assert image_cache.get(b"image-bytes") is None
+    image_cache.set(b"image-bytes", RESULT)
+    assert image_cache.get(b"image-bytes") == RESULT
+    assert image_cache.get(b"other-bytes") is None
+
+
+def test_entries_survive_reopen(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = ImageAnalysisCache(db_path, flush_interval=3600, eviction_interval=3600)
+    cache.set_by_hash("a" * 64, RESULT)
+    cache.close()
+
+    reopened = ImageAnalysisCache(db_path, flush_interval=3600, eviction_interval=3600)
+    try:
+        assert reopened.get_by_hash("a" * 64) == RESULT
+    finally:
+        reopened.close()
+
+
+def test_access_stats_are_batched(image_cache):
+    def stored_access_count():
+        with sqlite3.connect(image_cache.db_path) as conn:
+            return conn.execute("SELECT access_count FROM analysis_cache WHERE image_hash = ?", ("b" * 64,)).fetchone()[0]
+
+    image_cache.set_by_hash("b" * 64, RESULT)
+    for _ in range(3):
+        image_cache.get_by_hash("b" * 64)
+    # HIT chỉ ghi vào buffer, chưa commit
+    assert stored_access_count() == 1
+    assert image_cache.flush_access_stats() == 1
+    assert stored_access_count() == 4
+
+
+def test_expired_entry_is_a_miss(tmp_path):
+    cache = ImageAnalysisCache(str(tmp_path / "cache.db"), ttl_days=0, flush_interval=3600, eviction_interval=3600)
+    try:
+        cache.set_by_hash("c" * 64, RESULT)
+        cache.ttl_seconds = -1
+        assert cache.get_by_hash("c" * 64) is None
+    finally:
+        cache.close()
+
+
+def _recomputed_stats(cache):
+    """Tính lại bằng full scan những gì get_stats đọc từ counters/age buckets do trigger duy trì"""
+    import time
+
+    from cache_manager import _AGE_HISTOGRAM_BUCKETS
+
+    with sqlite3.connect(cache.db_path) as conn:
+        total_entries, total_hits, total_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(access_count), 0),"
+            " COALESCE(SUM(length(CAST(analysis_result AS BLOB))), 0) FROM analysis_cache"
+        ).fetchone()
+        created = [row[0] for row in conn.execute("SELECT created_at FROM analysis_cache")]
+    today = int(time.time()) // 86400
+    histogram = {label: 0 for label, _ in _AGE_HISTOGRAM_BUCKETS}
+    for created_at in created:
+        label = [label for label, min_age in _AGE_HISTOGRAM_BUCKETS if today - created_at // 86400 >= min_age][-1]
+        histogram[label] += 1
+    return {
+        "total_entries": total_entries,
+        "total_cache_hits": total_hits,
+        "bytes_stored": total_bytes,
+        "entry_age_histogram": histogram,
+    }
+
+
+def _assert_stats_consistent(cache):
+    stats = cache.get_stats()
+    assert {key: stats[key] for key in ("total_entries", "total_cache_hits", "bytes_stored",
+                                        "entry_age_histogram")} == _recomputed_stats(cache)
+    return stats
+
+
+def _backdate(cache, image_hash, days):
+    with sqlite3.connect(cache.db_path) as conn:
+        conn.execute("UPDATE analysis_cache SET created_at = created_at - ?, accessed_at = accessed_at - ?"
+                     " WHERE image_hash = ?", (days * 86400, days * 86400, image_hash))
+
+
+def test_stats_counters_match_full_scan_after_set_and_upsert(image_cache):
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["total_entries"] == 0
+
+    image_cache.set_by_hash("a" * 64, RESULT)
+    image_cache.set_by_hash("b" * 64, {**RESULT, "food_name": "Bún Chả Hà Nội"})
+    for _ in range(3):
+        image_cache.get_by_hash("a" * 64)
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["total_entries"] == 2
+    assert stats["total_cache_hits"] == 5
+
+    # UPSERT ghi đè: kích thước kết quả đổi, access_count về 1, không nhân đôi entry
+    image_cache.set_by_hash("a" * 64, {**RESULT, "food_name": "Phở", "nutrients": [{"name": "Protein"}]})
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["total_entries"] == 2
+    assert stats["total_cache_hits"] == 2
+
+
+def test_age_histogram_matches_full_scan(image_cache):
+    for index, days in enumerate((0, 0, 3, 10, 45)):
+        image_hash = f"{index:064x}"
+        image_cache.set_by_hash(image_hash, RESULT)
+        _backdate(image_cache, image_hash, days)
+
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["entry_age_histogram"] == {"<1d": 2, "1-7d": 1, "7-30d": 1, ">=30d": 1}
+
+    # Ghi đè entry cũ → created_at mới, chuyển sang bucket "<1d"
+    image_cache.set_by_hash(f"{4:064x}", RESULT)
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["entry_age_histogram"] == {"<1d": 3, "1-7d": 1, "7-30d": 1, ">=30d": 0}
+
+
+def test_stats_counters_match_full_scan_after_eviction_and_clear(image_cache):
+    for index in range(6):
+        image_cache.set_by_hash(f"{index:064x}", RESULT)
+        image_cache.get_by_hash(f"{index:064x}")
+    _backdate(image_cache, f"{0:064x}", 40)
+    _backdate(image_cache, f"{1:064x}", 40)
+
+    assert image_cache.evict_expired() == 2
+    _assert_stats_consistent(image_cache)
+
+    image_cache.max_entries = 3
+    assert image_cache.enforce_size_cap() == 1
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["total_entries"] == 3
+
+    image_cache.clear_all()
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["total_entries"] == 0
+    assert stats["total_cache_hits"] == 0
+    assert stats["bytes_stored"] == 0
+
+
+def _set_times(cache, image_hash, created_at, accessed_at):
+    with sqlite3.connect(cache.db_path) as conn:
+        conn.execute("UPDATE analysis_cache SET created_at = ?, accessed_at = ? WHERE image_hash = ?",
+                     (created_at, accessed_at, image_hash))
+
+
+def _record_batches(cache, monkeypatch):
+    """Ghi lại từng batch mà _delete_in_batches xóa"""
+    batches = []
+    delete_batch = cache._delete_batch
+
+    def recording_delete_batch(image_hashes):
+        batches.append(list(image_hashes))
+        delete_batch(image_hashes)
+
+    monkeypatch.setattr(cache, "_delete_batch", recording_delete_batch)
+    return batches
+
+
+def _stored_hashes(cache):
+    with sqlite3.connect(cache.db_path) as conn:
+        return {row[0] for row in conn.execute("SELECT image_hash FROM analysis_cache")}
+
+
+def test_evict_expired_deletes_oldest_first_in_small_batches(image_cache, monkeypatch):
+    import time
+
+    image_cache.eviction_batch_size = 2
+    image_cache.eviction_pause = 0
+    now = int(time.time())
+    expired = [f"e{index:063x}" for index in range(5)]
+    fresh = [f"f{index:063x}" for index in range(3)]
+    # Entry ghi trước lại mới hơn: thứ tự xóa (created_at) ngược với thứ tự insert/key
+    for age_days, image_hash in enumerate(expired, start=31):
+        image_cache.set_by_hash(image_hash, RESULT)
+        _set_times(image_cache, image_hash, now - age_days * 86400, now - age_days * 86400)
+    for image_hash in fresh:
+        image_cache.set_by_hash(image_hash, RESULT)
+    batches = _record_batches(image_cache, monkeypatch)
+
+    assert image_cache.evict_expired() == 5
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [image_hash for batch in batches for image_hash in batch] == list(reversed(expired))
+    assert _stored_hashes(image_cache) == set(fresh)
+    # L1 cũng bỏ entry đã xóa, không trả kết quả từ memory
+    assert all(image_cache.get_by_hash(image_hash) is None for image_hash in expired)
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["entry_age_histogram"][">=30d"] == 0
+    with sqlite3.connect(image_cache.db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM cache_age_buckets WHERE entries <= 0").fetchone()[0] == 0
+
+    assert image_cache.evict_expired() == 0
+
+
+def test_delete_in_batches_stops_at_max_rows(image_cache, monkeypatch):
+    from cache_manager import _SELECT_LRU_BATCH_SQL
+
+    image_cache.eviction_batch_size = 2
+    image_cache.eviction_pause = 0
+    hashes = [f"{index:064x}" for index in range(6)]
+    for image_hash in hashes:
+        image_cache.set_by_hash(image_hash, RESULT)
+        _set_times(image_cache, image_hash, 1_000_000, 1_000_000 + int(image_hash, 16))
+    batches = _record_batches(image_cache, monkeypatch)
+
+    assert image_cache._delete_in_batches(_SELECT_LRU_BATCH_SQL, (), max_rows=3) == 3
+    assert batches == [hashes[:2], hashes[2:3]]
+    assert _stored_hashes(image_cache) == set(hashes[3:])
+    _assert_stats_consistent(image_cache)
+
+
+def test_enforce_size_cap_evicts_least_recently_accessed_in_small_batches(image_cache, monkeypatch):
+    import time
+
+    image_cache.eviction_batch_size = 2
+    image_cache.eviction_pause = 0
+    image_cache.max_entries = 3
+    now = int(time.time())
+    hashes = [f"{index:064x}" for index in range(7)]
+    for index, image_hash in enumerate(hashes):
+        image_cache.set_by_hash(image_hash, RESULT)
+        _set_times(image_cache, image_hash, now, now - (len(hashes) - index) * 60)
+    # HIT chưa flush trên entry cũ nhất: phải được flush trước khi chọn LRU nên entry này được giữ
+    image_cache.get_by_hash(hashes[0])
+    batches = _record_batches(image_cache, monkeypatch)
+
+    assert image_cache.enforce_size_cap() == 4
+    assert [len(batch) for batch in batches] == [2, 2]
+    assert [image_hash for batch in batches for image_hash in batch] == hashes[1:5]
+    assert _stored_hashes(image_cache) == {hashes[0], hashes[5], hashes[6]}
+    stats = _assert_stats_consistent(image_cache)
+    assert stats["total_entries"] == 3
+
+    assert image_cache.enforce_size_cap() == 0
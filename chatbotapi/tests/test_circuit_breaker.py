@@ -0,0 +1,103 @@
+"""Circuit breaker: closed → open khi lỗi vượt ngưỡng, open bỏ qua provider, half-open probe → closed"""
+import asyncio
+import time
+
+import pytest
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakerRegistry
+
+# Provider "gemini" gom cả model lỗi lẫn model tốt (tối đa 2/3 lỗi) → chỉ breaker của model bị mở
+BREAKER_ENV = dict(CIRCUIT_MIN_CALLS=2, CIRCUIT_FAILURE_RATE=0.7, CHAT_HEDGE_ENABLED=0)
+
+
+def _ask(assistant, *questions):
+    async def run():
+        return [await assistant.get_response(question) for question in questions]
+    return asyncio.run(run())
+
+
+def test_breaker_state_transitions():
+    breaker = CircuitBreaker("test", min_calls=2, open_seconds=0.05)
+    for _ in range(2):
+        assert breaker.acquire() is False
+        breaker.record(False)
+    assert breaker.state == OPEN
+    assert breaker.acquire() is None
+
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    assert breaker.acquire() is True
+    # Chỉ một probe tại một thời điểm
+    assert breaker.acquire() is None
+    breaker.record(True, probe=True)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["times_opened"] == 1
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker("test", min_calls=1, open_seconds=0.05)
+    breaker.record(False)
+    time.sleep(0.06)
+    assert breaker.acquire() is True
+    breaker.record(False, probe=True)
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 2
+
+
+def test_open_model_is_skipped(make_assistant, providers):
+    assistant = make_assistant(CIRCUIT_OPEN_SECONDS=60, **BREAKER_ENV)
+    providers.failing = {"model-a"}
+
+    assert _ask(assistant, "Câu hỏi 1?", "Câu hỏi 2?") == ["Gemini trả lời"] * 2
+    assert providers.gemini_calls == ["model-a", "model-b"] * 2
+    assert assistant.circuit_breakers.get("gemini:model-a").state == OPEN
+    assert assistant.circuit_breakers.get("gemini").state == CLOSED
+
+    providers.gemini_calls.clear()
+    assert _ask(assistant, "Câu hỏi 3?") == ["Gemini trả lời"]
+    assert providers.gemini_calls == ["model-b"]
+
+
+def test_half_open_probe_closes_model_circuit(make_assistant, providers):
+    assistant = make_assistant(CIRCUIT_OPEN_SECONDS=0.2, **BREAKER_ENV)
+    providers.failing = {"model-a"}
+    _ask(assistant, "Câu hỏi 1?", "Câu hỏi 2?")
+    assert assistant.circuit_breakers.get("gemini:model-a").state == OPEN
+
+    providers.failing.clear()
+    providers.gemini_calls.clear()
+    time.sleep(0.25)
+    assert _ask(assistant, "Câu hỏi 3?") == ["Gemini trả lời"]
+    assert providers.gemini_calls == ["model-a"]
+    assert assistant.circuit_breakers.get("gemini:model-a").state == CLOSED
+
+
+def test_open_openrouter_fails_fast(make_assistant, providers):
+    assistant = make_assistant(CIRCUIT_OPEN_SECONDS=60, **BREAKER_ENV)
+    providers.models = []
+    providers.failing = {"openrouter"}
+    for question in ("Câu hỏi 1?", "Câu hỏi 2?"):
+        with pytest.raises(ValueError):
+            _ask(assistant, question)
+    assert providers.openrouter_calls == 2
+
+    with pytest.raises(ValueError, match="circuit open"):
+        _ask(assistant, "Câu hỏi 3?")
+    assert providers.openrouter_calls == 2
+
+
+def test_provider_health_reports_snapshot(client, monkeypatch):
+    import main
+
+    registry = CircuitBreakerRegistry(min_calls=1, open_seconds=60)
+    registry.acquire("openrouter").failure()
+    registry.acquire("gemini").success(latency=0.5)
+    monkeypatch.setattr(main.chatbot_assistant, "circuit_breakers", registry)
+
+    circuits = client.get("/provider-health").json()["circuits"]
+    assert circuits["openrouter"]["state"] == OPEN
+    assert circuits["openrouter"]["open_remaining_seconds"] > 0
+    assert circuits["gemini"] == {
+        "state": CLOSED, "calls": 1, "error_rate": 0.0, "p95_seconds": 0.5,
+        "open_remaining_seconds": 0.0, "times_opened": 0
+    }
@@ -0,0 +1,30 @@
+"""Tra món mock theo tên file: alias "scaledNN", key nằm trong tên file, MD5 fallback ổn định"""
+import random
+
+import pytest
+
+from benchmarks.bench_food_lookup import legacy_lookup, make_catalogue, make_filenames
+from mock_nutrition_data import MOCK_NUTRITION_DATABASE, _FoodIndex, get_mock_nutrition_by_filename
+
+
+@pytest.mark.parametrize("filename, food_name", [
+    ("scaled33.jpg", "Phở Bò"),
+    ("pho-bo.jpg", "Phở Bò"),
+    ("IMG_1234_Pho_Bo.JPEG", "Phở Bò"),
+])
+def test_lookup_by_alias_and_substring(filename, food_name):
+    assert get_mock_nutrition_by_filename(filename)["food_name"] == food_name
+
+
+def test_unmatched_filename_always_maps_to_the_same_dish():
+    first = get_mock_nutrition_by_filename("IMG_20240101_123456.jpg")["food_name"]
+    assert all(get_mock_nutrition_by_filename("IMG_20240101_123456.jpg")["food_name"] == first for _ in range(5))
+
+
+@pytest.mark.parametrize("size", [0, 500])
+def test_index_matches_the_legacy_scan(size):
+    rng = random.Random(size)
+    database = make_catalogue(size, rng) if size else MOCK_NUTRITION_DATABASE
+    index = _FoodIndex(database)
+    for filename in make_filenames(database, rng):
+        assert index.lookup(filename) is legacy_lookup(database, filename), filename
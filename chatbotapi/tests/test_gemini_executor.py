@@ -0,0 +1,50 @@
+"""Gemini call chạy trên bounded executor: không block event loop, số call song song bị giới hạn"""
+import asyncio
+import time
+
+
+async def _max_loop_gap(stop: asyncio.Event) -> float:
+    """Khoảng lớn nhất giữa hai lần event loop được chạy (giây)"""
+    gap = 0.0
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.01)
+        now = time.perf_counter()
+        gap = max(gap, now - last)
+        last = now
+    return gap
+
+
+def test_concurrent_chats_overlap_and_keep_loop_responsive(make_assistant, providers):
+    assistant = make_assistant(GEMINI_MAX_CONCURRENCY=8)
+    providers.gemini_delay = 0.3
+
+    async def run():
+        stop = asyncio.Event()
+        monitor = asyncio.ensure_future(_max_loop_gap(stop))
+        start = time.perf_counter()
+        answers = await asyncio.gather(*[assistant.get_response(f"Câu hỏi số {i}?") for i in range(5)])
+        elapsed = time.perf_counter() - start
+        stop.set()
+        return answers, elapsed, await monitor
+
+    answers, elapsed, loop_gap = asyncio.run(run())
+    assert answers == ["Gemini trả lời"] * 5
+    # Chạy tuần tự sẽ mất >= 1.5s
+    assert elapsed < 1.0
+    assert loop_gap < 0.2
+    assert providers.max_in_flight == 5
+
+
+def test_gemini_concurrency_is_bounded(make_assistant, providers):
+    assistant = make_assistant(GEMINI_MAX_CONCURRENCY=2)
+    providers.gemini_delay = 0.2
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*[assistant.get_response(f"Câu hỏi số {i}?") for i in range(4)])
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    assert providers.max_in_flight == 2
+    assert elapsed >= 0.4
@@ -0,0 +1,243 @@
+"""Cách gửi system prompt cho Gemini: system_instruction mặc định, context cache chỉ khi prompt đủ dài"""
+import asyncio
+import datetime
+import time
+
+import pytest
+
+import gemini_models
+from gemini_models import GeminiContextCache, create_model_registry
+
+SYSTEM_PROMPT = "Bạn là trợ lý dinh dưỡng."
+
+
+class FakeCaching:
+    """google.generativeai.caching giả: ghi lại các lần tạo CachedContent"""
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.deleted = []
+        fake = self
+
+        class CachedContent:
+            @staticmethod
+            def create(**kwargs):
+                fake.created.append(kwargs)
+                return CachedContent()
+
+            def update(self, ttl=None):
+                fake.updated.append(ttl)
+
+            def delete(self):
+                fake.deleted.append(self)
+
+        self.CachedContent = CachedContent
+
+
+@pytest.fixture
+def new_sdk(monkeypatch):
+    """Giả lập google-generativeai >= 0.7 (có system_instruction và caching)"""
+    caching = FakeCaching()
+    monkeypatch.setattr(gemini_models, "SUPPORTS_SYSTEM_INSTRUCTION", True)
+    monkeypatch.setattr(gemini_models, "genai_caching", caching)
+    monkeypatch.setattr(gemini_models.genai.GenerativeModel, "from_cached_content",
+                        staticmethod(lambda content: ("cached-model", content)), raising=False)
+    return caching
+
+
+def test_default_mode_is_system_instruction(new_sdk, monkeypatch):
+    monkeypatch.delenv("GEMINI_PROMPT_CACHE", raising=False)
+    registry = create_model_registry(SYSTEM_PROMPT)
+    assert registry.system_instruction == SYSTEM_PROMPT
+    assert registry.context_cache is None
+    assert registry.carries_system_prompt
+
+
+def test_old_sdk_falls_back_to_inline(monkeypatch):
+    monkeypatch.setattr(gemini_models, "SUPPORTS_SYSTEM_INSTRUCTION", False)
+    monkeypatch.setenv("GEMINI_PROMPT_CACHE", "cached")
+    registry = create_model_registry(SYSTEM_PROMPT)
+    assert registry.context_cache is None
+    assert not registry.carries_system_prompt
+
+
+@pytest.mark.parametrize("carries", [False, True])
+def test_gemini_prompt_includes_system_prompt_only_when_model_does_not(make_assistant, providers, carries):
+    assistant = make_assistant()
+    assistant.model_registry.system_instruction = assistant.system_prompt if carries else None
+
+    asyncio.run(assistant.get_response("Phở bò bao nhiêu calo?"))
+    prompt = providers.gemini_prompts[0]
+    assert prompt.startswith("User: Phở bò bao nhiêu calo?") is carries
+    assert prompt.startswith(assistant.system_prompt) is not carries
+
+
+def test_short_prompt_never_creates_context_cache(new_sdk):
+    cache = GeminiContextCache(SYSTEM_PROMPT, min_tokens=4096)
+    counted = []
+    cache._count_tokens = lambda model_name: counted.append(model_name) or 12
+
+    assert not cache.warm("gemini-1.5-flash")
+    assert not cache.warm("gemini-1.5-flash")
+    assert new_sdk.created == []
+    assert counted == ["gemini-1.5-flash"]
+    assert cache.get_model("gemini-1.5-flash") is None
+
+
+def test_long_prompt_uses_context_cache(new_sdk):
+    cache = GeminiContextCache(SYSTEM_PROMPT, min_tokens=4096)
+    cache._count_tokens = lambda model_name: 5000
+
+    assert cache.warm("gemini-1.5-flash")
+    assert len(new_sdk.created) == 1
+    assert new_sdk.created[0]["model"] == "models/gemini-1.5-flash"
+    assert cache.get_model("gemini-1.5-flash")[0] == "cached-model"
+
+
+def test_token_count_error_falls_back(new_sdk):
+    cache = GeminiContextCache(SYSTEM_PROMPT)
+
+    def fail(model_name):
+        raise RuntimeError("network down")
+
+    cache._count_tokens = fail
+    assert not cache.warm("gemini-1.5-flash")
+    assert new_sdk.created == []
+
+
+def _wait_background(cache: GeminiContextCache):
+    deadline = time.time() + 2
+    while cache._pending and time.time() < deadline:
+        time.sleep(0.01)
+    assert not cache._pending
+
+
+def test_context_cache_is_created_in_background_refreshed_and_deleted(new_sdk):
+    cache = GeminiContextCache(SYSTEM_PROMPT, ttl_seconds=100, refresh_margin_seconds=10, min_tokens=10)
+    cache._count_tokens = lambda model_name: 5000
+
+    # Lần đầu: chưa có cache → caller dùng system_instruction, cache tạo ở background
+    assert cache.get_model("gemini-1.5-flash") is None
+    _wait_background(cache)
+    assert cache.get_model("gemini-1.5-flash")[0] == "cached-model"
+    assert new_sdk.updated == []
+
+    # Còn dưới refresh_margin_seconds → gia hạn TTL ở background, vẫn dùng cache hiện tại
+    content, model, _ = cache._entries["gemini-1.5-flash"]
+    cache._entries["gemini-1.5-flash"] = (content, model, time.time() + 5)
+    assert cache.get_model("gemini-1.5-flash") is model
+    _wait_background(cache)
+    assert new_sdk.updated == [datetime.timedelta(seconds=100)]
+    assert cache._entries["gemini-1.5-flash"][2] > time.time() + 90
+
+    cache.close()
+    assert new_sdk.deleted == [content]
+    assert len(new_sdk.created) == 1
+
+
+def test_expired_context_cache_is_recreated(new_sdk):
+    cache = GeminiContextCache(SYSTEM_PROMPT, min_tokens=10)
+    cache._count_tokens = lambda model_name: 5000
+    assert cache.warm("gemini-1.5-flash")
+    content, model, _ = cache._entries["gemini-1.5-flash"]
+    cache._entries["gemini-1.5-flash"] = (content, model, time.time() - 1)
+
+    assert cache.get_model("gemini-1.5-flash") is None
+    _wait_background(cache)
+    assert len(new_sdk.created) == 2
+    assert cache.get_model("gemini-1.5-flash") is not None
+
+
+@pytest.mark.skipif(not gemini_models.SUPPORTS_SYSTEM_INSTRUCTION, reason="cần google-generativeai >= 0.5")
+def test_registry_prefers_cached_model_and_survives_cache_404(monkeypatch):
+    monkeypatch.setattr(gemini_models, "genai_caching", FakeCaching())
+    monkeypatch.setattr(gemini_models.genai.GenerativeModel, "from_cached_content",
+                        staticmethod(lambda content: "cached-model"))
+    monkeypatch.setenv("GEMINI_PROMPT_CACHE", "cached")
+    monkeypatch.setenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "10")
+    registry = create_model_registry(SYSTEM_PROMPT)
+    registry.context_cache._count_tokens = lambda model_name: 5000
+    assert registry.context_cache.warm("gemini-1.5-flash")
+    assert registry.get_model("gemini-1.5-flash") == "cached-model"
+
+    # 404 khi dùng cached content: bỏ cache, model vẫn dùng được qua system_instruction
+    registry.mark_not_found("gemini-1.5-flash")
+    registry.context_cache._failed_until["gemini-1.5-flash"] = float("inf")
+    model = registry.get_model("gemini-1.5-flash")
+    assert isinstance(model, gemini_models.genai.GenerativeModel)
+    assert "gemini-1.5-flash" not in registry._not_found
+
+
+def test_only_sdk_not_found_errors_count_as_missing_model():
+    from google.api_core import exceptions as google_exceptions
+
+    assert gemini_models.is_model_not_found_error(google_exceptions.NotFound("models/gemini-x is not found"))
+    assert gemini_models.is_model_not_found_error(google_exceptions.from_http_status(404, "gone"))
+    # Lỗi tạm thời có chữ "404" / "not found" trong message không làm model bị bỏ qua
+    assert not gemini_models.is_model_not_found_error(RuntimeError("proxy: upstream 404 not found"))
+    assert not gemini_models.is_model_not_found_error(
+        google_exceptions.ResourceExhausted("429 quota for model not found in project"))
+    assert not gemini_models.is_model_not_found_error(ValueError("Empty response from Gemini"))
+
+
+def _registry(models=("model-a", "model-b"), delay=0.0, **kwargs):
+    registry = gemini_models.GeminiModelRegistry(**kwargs)
+    registry.fetch_calls = 0
+
+    def fetch_models():
+        registry.fetch_calls += 1
+        time.sleep(delay)
+        return list(models)
+
+    registry._fetch_models = fetch_models
+    return registry
+
+
+def test_not_found_models_are_retried_after_ttl():
+    registry = _registry(not_found_ttl_seconds=0.1)
+    registry.mark_success("model-a")
+    registry.mark_not_found("model-a")
+    assert registry.candidates() == ["model-b"]
+    assert registry.preferred_model is None
+
+    time.sleep(0.15)
+    assert registry.candidates() == ["model-a", "model-b"]
+    assert registry._not_found == {}
+
+
+def test_first_use_resolves_models_once_for_concurrent_callers():
+    from concurrent.futures import ThreadPoolExecutor
+
+    registry = _registry(delay=0.2)
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda _: registry.candidates(), range(5)))
+    assert results == [["model-a", "model-b"]] * 5
+    assert registry.fetch_calls == 1
+
+
+def test_first_use_waits_for_background_refresh():
+    registry = _registry(delay=0.2)
+    registry.refresh_in_background()
+    time.sleep(0.05)
+    assert registry.candidates() == ["model-a", "model-b"]
+    assert registry.fetch_calls == 1
+
+
+def test_assistant_negative_caches_only_sdk_not_found(make_assistant, providers):
+    from google.api_core import exceptions as google_exceptions
+
+    assistant = make_assistant()
+    errors = {
+        "model-a": RuntimeError("503 upstream not found, retry later"),
+        "model-b": google_exceptions.NotFound("models/model-b is not found for API version v1beta"),
+    }
+
+    def generate(model_name, prompt):
+        providers.gemini_calls.append(model_name)
+        raise errors[model_name]
+
+    assistant._generate_gemini_text = generate
+    asyncio.run(assistant.get_response("Phở bò bao nhiêu calo?"))
+    assert providers.gemini_calls == ["model-a", "model-b"]
+    assert set(assistant.model_registry._not_found) == {"model-b"}
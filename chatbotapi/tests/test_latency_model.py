@@ -0,0 +1,86 @@
+"""Cấu hình độ trễ giả lập: parse từng loại, cấu hình sai bị phát hiện khi khởi động"""
+import pytest
+
+import latency_model
+from latency_model import (
+    FixedLatency, LatencyModel, NoLatency, ReplayLatency, UniformLatency, load_latency_models, parse_latency_spec
+)
+
+
+@pytest.fixture(autouse=True)
+def fresh_models(monkeypatch):
+    """Không dùng lại latency model đã cache từ test khác"""
+    monkeypatch.setattr(latency_model, "_models", {})
+
+
+@pytest.mark.parametrize("spec", ["off", "OFF", "none", "0"])
+def test_off(spec):
+    model = parse_latency_spec(spec)
+    assert isinstance(model, NoLatency)
+    assert model.sample() == 0.0
+
+
+def test_fixed():
+    model = parse_latency_spec("fixed:2.5")
+    assert isinstance(model, FixedLatency)
+    assert model.sample() == 2.5
+    assert model.describe() == "fixed:2.5"
+
+
+def test_uniform():
+    model = parse_latency_spec(" uniform:1:2 ")
+    assert isinstance(model, UniformLatency)
+    assert all(1 <= model.sample() <= 2 for _ in range(100))
+
+
+def test_replay(tmp_path):
+    path = tmp_path / "latencies.txt"
+    path.write_text("# giây\n1.0\n\n3.0\n", encoding="utf-8")
+    model = parse_latency_spec(f"replay:{path}")
+    assert isinstance(model, ReplayLatency)
+    assert model.samples == [1.0, 3.0]
+    assert {parse_latency_spec(f"replay:{path}:0.5").sample() for _ in range(50)} <= {0.5, 1.5}
+
+
+@pytest.mark.parametrize("spec", [
+    "", "slow", "fixed", "fixed:abc", "fixed:-1", "uniform:10", "uniform:5:1", "uniform:a:b", "replay:/nonexistent.txt",
+])
+def test_invalid(spec):
+    with pytest.raises(ValueError, match="Latency model không hợp lệ"):
+        parse_latency_spec(spec)
+
+
+def test_replay_file_without_samples(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_text("# chưa có mẫu\n", encoding="utf-8")
+    with pytest.raises(ValueError):
+        parse_latency_spec(f"replay:{path}")
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        LatencyModel()
+
+
+def test_all_endpoints_are_validated_at_startup(monkeypatch):
+    monkeypatch.delenv("SIMULATED_LATENCY", raising=False)
+    monkeypatch.setenv("SIMULATED_LATENCY_ANALYZE_BATCH", "uniform:10")
+    with pytest.raises(ValueError, match="SIMULATED_LATENCY_ANALYZE_BATCH"):
+        load_latency_models()
+
+    monkeypatch.setenv("SIMULATED_LATENCY_ANALYZE_BATCH", "fixed:1")
+    models = load_latency_models()
+    assert models["analyze_batch"].describe() == "fixed:1"
+    assert models["analyze_image"].describe() == "uniform:10:15"
+    assert latency_model.get_latency_model("analyze_batch") is models["analyze_batch"]
+
+
+def test_server_refuses_to_start_with_invalid_latency(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    monkeypatch.setenv("SIMULATED_LATENCY", "uniform:")
+    with pytest.raises(ValueError, match="SIMULATED_LATENCY"):
+        with TestClient(main.app):
+            pass
@@ -0,0 +1,117 @@
+"""/metrics: Prometheus text format (bucket cộng dồn, escape label) và MetricsMiddleware"""
+import re
+
+import pytest
+
+from conftest import make_jpeg
+from metrics import CONTENT_TYPE_LATEST, MetricsRegistry
+
+
+def _sample(text: str, name: str, labels: str = "") -> float:
+    """Giá trị của một series trong output /metrics (0 nếu chưa có series)"""
+    match = re.search(rf"^{re.escape(name + labels)} (\S+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+def test_histogram_buckets_are_cumulative_and_upper_bound_inclusive():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("job_seconds", "Thời gian job", ("queue",), buckets=(1.0, 0.1, 0.5))
+    child = histogram.labels("default")
+    for value in (0.05, 0.1, 0.3, 2.0):
+        child.observe(value)
+
+    lines = [line for line in registry.render().splitlines() if line.startswith("job_seconds")]
+    assert lines == [
+        'job_seconds_bucket{queue="default",le="0.1"} 2',
+        'job_seconds_bucket{queue="default",le="0.5"} 3',
+        'job_seconds_bucket{queue="default",le="1"} 3',
+        'job_seconds_bucket{queue="default",le="+Inf"} 4',
+        'job_seconds_sum{queue="default"} 2.45',
+        'job_seconds_count{queue="default"} 4',
+    ]
+    assert "# TYPE job_seconds histogram" in registry.render()
+
+
+def test_unlabelled_metrics_render_without_braces():
+    registry = MetricsRegistry()
+    registry.counter("events_total", "Số event").inc(3)
+    registry.gauge("queue_depth", "Độ dài queue").set(1.5)
+    registry.histogram("lag_seconds", "Độ trễ", buckets=(0.5,)).observe(0.2)
+
+    text = registry.render()
+    assert "events_total 3\n" in text
+    assert "queue_depth 1.5\n" in text
+    assert 'lag_seconds_bucket{le="0.5"} 1\n' in text
+    assert "lag_seconds_count 1\n" in text
+    assert text.endswith("\n")
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Số request", ("path",)).labels('a"b\\c\nd').inc()
+    registry.add_collector(lambda: [("custom_info", "gauge", "Collector", [({"name": 'x"y\\z\n'}, 1)])])
+
+    text = registry.render()
+    assert 'requests_total{path="a\\"b\\\\c\\nd"} 1\n' in text
+    assert 'custom_info{name="x\\"y\\\\z\\n"} 1\n' in text
+    # Mỗi sample nằm trên đúng một dòng
+    assert all(line.startswith(("#", "requests_total", "custom_info")) for line in text.splitlines() if line)
+
+
+def test_wrong_label_count_is_rejected():
+    registry = MetricsRegistry()
+    counter = registry.counter("calls_total", "Số lần gọi", ("provider", "outcome"))
+    with pytest.raises(ValueError):
+        counter.labels("gemini")
+
+
+def test_failing_collector_is_skipped():
+    registry = MetricsRegistry()
+    registry.counter("ok_total", "Vẫn render").inc()
+
+    def broken():
+        raise RuntimeError("boom")
+
+    registry.add_collector(broken)
+    assert "ok_total 1" in registry.render()
+
+
+def test_metrics_endpoint_counts_requests_by_route(client):
+    before = client.get("/metrics").text
+    assert client.get("/health").status_code == 200
+    assert client.get("/health").status_code == 200
+    assert client.get("/no-such-page").status_code == 404
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == CONTENT_TYPE_LATEST
+    after = response.text
+
+    def delta(name, labels=""):
+        return _sample(after, name, labels) - _sample(before, name, labels)
+
+    assert delta("http_requests_total", '{endpoint="/health",method="GET",status="200"}') == 2
+    # Path lạ gom vào "unmatched" (không tạo series theo URL tuỳ ý), /metrics không tự đếm
+    assert delta("http_requests_total", '{endpoint="unmatched",method="GET",status="404"}') == 1
+    assert "/no-such-page" not in after
+    assert 'endpoint="/metrics"' not in after
+    assert delta("http_request_duration_seconds_count", '{endpoint="/health"}') == 2
+    assert _sample(after, "http_requests_in_flight", '{endpoint="/health"}') == 0
+
+
+def test_metrics_endpoint_reports_stage_timings_and_cache_collectors(client):
+    before = client.get("/metrics").text
+    data = make_jpeg()
+    for _ in range(2):
+        assert client.post("/analyze-image", files={"file": ("pho-bo.jpg", data, "image/jpeg")}).status_code == 200
+    after = client.get("/metrics").text
+
+    assert _sample(after, "stage_duration_seconds_count", '{stage="preprocess"}') \
+        - _sample(before, "stage_duration_seconds_count", '{stage="preprocess"}') == 1
+    assert _sample(after, "stage_duration_seconds_count", '{stage="image_cache_lookup"}') \
+        - _sample(before, "stage_duration_seconds_count", '{stage="image_cache_lookup"}') == 2
+    # Bucket +Inf luôn bằng _count
+    assert _sample(after, "stage_duration_seconds_bucket", '{stage="preprocess",le="+Inf"}') \
+        == _sample(after, "stage_duration_seconds_count", '{stage="preprocess"}')
+    assert _sample(after, "cache_requests_total", '{cache="image_l1",result="hit"}') == 1
+    assert "# TYPE cache_hit_ratio gauge" in after
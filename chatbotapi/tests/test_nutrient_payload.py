@@ -0,0 +1,66 @@
+"""NutrientPayload dựng sẵn dùng chung giữa các request: response là bản copy, catalogue không bị sửa"""
+import asyncio
+import hashlib
+
+import pytest
+
+from conftest import make_jpeg
+from mock_nutrition_data import get_mock_nutrition_by_filename, nutrient_payload
+from nutrient_schema import RESPONSE_NUTRIENT_KEYS
+
+
+def test_shared_payload_is_read_only():
+    payload = nutrient_payload(get_mock_nutrition_by_filename("pho-bo.jpg")["nutrients"])
+    with pytest.raises(TypeError):
+        payload.nutrients_obj["water"] = -1
+    with pytest.raises(TypeError):
+        payload.nutrients_obj_full["water"] = -1
+    assert set(RESPONSE_NUTRIENT_KEYS) <= set(payload.nutrients_obj_full)
+
+
+def test_mutating_an_analyze_image_response_does_not_leak_into_later_requests(client):
+    def analyze(filename):
+        response = client.post("/analyze-image", files={"file": (filename, make_jpeg((10, 200, 30)), "image/jpeg")})
+        return response.json()["items"][0]["nutrients"]
+
+    import main
+
+    mock_result = get_mock_nutrition_by_filename("pho-bo.jpg")
+    items = main._to_items_response(mock_result)
+    expected = dict(items["items"][0]["nutrients"])
+    items["items"][0]["nutrients"]["water"] = -1
+    items["items"][0]["nutrients"]["hacked"] = 1
+    assert main._to_items_response(mock_result)["items"][0]["nutrients"] == expected
+    assert analyze("pho-bo.jpg") == expected
+
+
+def test_mutating_an_assistant_image_result_does_not_leak(make_assistant, monkeypatch):
+    monkeypatch.setenv("SIMULATED_LATENCY_ASSISTANT_IMAGE", "off")
+    assistant = make_assistant()
+    first = asyncio.run(assistant.analyze_food_image(b"", "pho-bo.jpg"))
+    expected = dict(first["items"][0]["nutrients"])
+    first["items"][0]["nutrients"].clear()
+    second = asyncio.run(assistant.analyze_food_image(b"", "pho-bo.jpg"))
+    assert second["items"][0]["nutrients"] == expected
+    assert expected
+
+
+def test_mock_nutrients_cannot_be_mutated_across_calls():
+    result = get_mock_nutrition_by_filename("pho-bo.jpg")
+    expected = [dict(nutrient) for nutrient in result["nutrients"]]
+    with pytest.raises(TypeError):
+        result["nutrients"][0]["amount"] = -999
+    assert [dict(nutrient) for nutrient in get_mock_nutrition_by_filename("pho-bo.jpg")["nutrients"]] == expected
+
+
+def test_analyze_nutrition_serializes_frozen_nutrients(client, image_cache):
+    image = make_jpeg((10, 200, 30))
+    expected = [dict(nutrient) for nutrient in get_mock_nutrition_by_filename("pho-bo.jpg")["nutrients"]]
+    response = client.post("/analyze-nutrition", files={"file": ("pho-bo.jpg", image, "image/jpeg")})
+    assert response.status_code == 200
+    assert response.json()["nutrients"] == expected
+
+    # Entry đã lưu xuống SQLite dạng JSON (L2), đọc lại được khi L1 không còn
+    image_hash = hashlib.sha256(image).hexdigest()
+    image_cache._l1.discard(image_hash)
+    assert image_cache.get_by_hash(image_hash)["nutrients"] == expected
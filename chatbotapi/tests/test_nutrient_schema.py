@@ -0,0 +1,48 @@
+"""nutrient_schema: vector cố định theo schema, cộng bữa ăn theo khẩu phần, so với mục tiêu"""
+import pytest
+
+import nutrient_schema
+from nutrient_schema import INDEX, NUM_NUTRIENTS, RESPONSE_NUTRIENT_KEYS, MealLog, code_to_key, to_dict, to_vector
+
+
+@pytest.fixture(params=["numpy", "pure"])
+def backend(request, monkeypatch):
+    """Chạy cả nhánh NumPy lẫn nhánh array('d') thuần"""
+    if request.param == "pure":
+        monkeypatch.setattr(nutrient_schema, "np", None)
+    elif nutrient_schema.np is None:
+        pytest.skip("NumPy chưa cài")
+    return request.param
+
+
+def test_code_to_key():
+    assert code_to_key("MIN_CA") == "ca"
+    assert code_to_key("VITB12") == "vitb12"
+
+
+def test_every_response_key_has_a_slot():
+    assert all(key in INDEX for key in RESPONSE_NUTRIENT_KEYS)
+
+
+def test_vector_round_trip_accepts_codes_and_keys():
+    vector = to_vector({"MIN_CA": 85, "water": 150, "unknown": 1})
+    assert len(vector) == NUM_NUTRIENTS
+    assert to_dict(vector, skip_zero=True) == {"ca": 85, "water": 150}
+    assert to_dict(vector, by_code=True, skip_zero=True) == {"MIN_CA": 85, "WATER": 150}
+
+
+def test_meal_log_total_and_targets(backend):
+    log = MealLog()
+    log.add(to_vector({"water": 100, "MIN_CA": 10}), portion=1.5)
+    log.add(to_vector({"water": 50}))
+    total = to_dict(log.total(), skip_zero=True)
+    assert total == {"water": pytest.approx(200), "ca": pytest.approx(15)}
+
+    ratios = to_dict(log.compare_to_targets(to_vector({"water": 400})), skip_zero=True)
+    # Nutrient không đặt mục tiêu → 0
+    assert ratios == {"water": pytest.approx(0.5)}
+
+
+def test_meal_log_rejects_wrong_length():
+    with pytest.raises(ValueError):
+        MealLog().add([1.0, 2.0])
@@ -0,0 +1,87 @@
+"""AsyncClient OpenRouter dùng chung: tạo khi startup, dùng lại giữa các request, đóng khi shutdown"""
+import asyncio
+
+import httpx
+
+
+def _track_clients(assistant, providers) -> list:
+    """_create_openrouter_client trả về client MockTransport, ghi lại mọi client đã tạo"""
+    created = []
+
+    def create():
+        client = httpx.AsyncClient(
+            base_url=assistant.base_url, transport=httpx.MockTransport(providers.openrouter_handler)
+        )
+        created.append(client)
+        return client
+
+    assistant.openrouter_client = None
+    assistant._create_openrouter_client = create
+    return created
+
+
+def test_client_is_created_on_startup_and_reused_across_calls(make_assistant, providers):
+    assistant = make_assistant()
+    created = _track_clients(assistant, providers)
+    # Không có Gemini model → mọi câu hỏi đi OpenRouter
+    providers.models = []
+
+    async def scenario():
+        await assistant.astart()
+        assert len(created) == 1
+        client = assistant.openrouter_client
+        answers = [
+            await assistant.get_response("Phở bò bao nhiêu calo?"),
+            await assistant.get_response("Bún chả có nhiều đạm không?"),
+        ]
+        assert assistant.openrouter_client is client
+        await assistant.aclose()
+        return client, answers
+
+    client, answers = asyncio.run(scenario())
+    assert providers.openrouter_calls == 2
+    assert all(providers.openrouter_answer in answer for answer in answers)
+    assert len(created) == 1
+    assert client.is_closed
+    assert assistant.openrouter_client is None
+
+
+def test_client_is_recreated_after_close(make_assistant, providers):
+    assistant = make_assistant()
+    created = _track_clients(assistant, providers)
+    messages = [{"role": "user", "content": "Phở bò bao nhiêu calo?"}]
+
+    async def scenario():
+        # Chạy ngoài FastAPI (chưa astart): tạo lazy ở lần gọi đầu
+        assert await assistant._call_openrouter(messages) == providers.openrouter_answer
+        first = assistant.openrouter_client
+
+        # Client bị đóng từ bên ngoài → lần gọi sau tạo client mới
+        await first.aclose()
+        assert await assistant._call_openrouter(messages) == providers.openrouter_answer
+        second = assistant.openrouter_client
+
+        await assistant.aclose()
+        assert await assistant._call_openrouter(messages) == providers.openrouter_answer
+        third = assistant.openrouter_client
+        await third.aclose()
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert created == [first, second, third]
+    assert len({id(client) for client in created}) == 3
+    assert second.is_closed
+    assert providers.openrouter_calls == 3
+
+
+def test_startup_without_openrouter_key_creates_no_client(make_assistant, providers):
+    assistant = make_assistant()
+    created = _track_clients(assistant, providers)
+    assistant.openrouter_api_key = None
+
+    async def scenario():
+        await assistant.astart()
+        await assistant.aclose()
+
+    asyncio.run(scenario())
+    assert created == []
@@ -0,0 +1,59 @@
+"""Ảnh gần giống dùng chung kết quả theo dHash; ảnh phẳng / ít texture (dHash suy biến) không bao giờ khớp nhau"""
+import io
+
+import pytest
+from PIL import Image
+
+from conftest import make_jpeg
+from mock_nutrition_data import get_mock_nutrition_by_filename
+from perceptual_index import PerceptualHashIndex, is_degenerate_phash
+
+
+@pytest.mark.parametrize("perceptual_hash", ["0000000000000000", "ffffffffffffffff", "0000000000000101", "fffffffffffffeff"])
+def test_flat_hashes_are_degenerate(perceptual_hash):
+    assert is_degenerate_phash(perceptual_hash)
+
+
+def test_textured_hash_is_not_degenerate():
+    assert not is_degenerate_phash("8181818181818181")
+
+
+def test_index_never_matches_degenerate_hashes():
+    index = PerceptualHashIndex(max_distance=4)
+    index.add("flat", "0000000000000000")
+    index.add("textured", "8181818181818181")
+    assert len(index) == 1
+    assert index.nearest("0000000000000000") is None
+    assert index.nearest("8181818181818183") == ("textured", 1)
+
+
+def test_degenerate_rows_are_skipped_on_load():
+    index = PerceptualHashIndex()
+    index.bulk_load([("flat", "0000000000000000"), ("textured", "8181818181818181")])
+    assert len(index) == 1
+
+
+def _analyze(client, data: bytes, filename: str) -> str:
+    response = client.post("/analyze-image", files={"file": (filename, data, "image/jpeg")})
+    assert response.status_code == 200
+    return response.json()["items"][0]["item_name"]
+
+
+def test_different_flat_images_do_not_share_a_result(client):
+    assert _analyze(client, make_jpeg((0, 0, 0), pattern=False), "pho-bo.jpg") == "Phở Bò"
+    for color, filename in [((1, 2, 3), "com-tam.jpg"), ((40, 0, 0), "banh-mi.jpg")]:
+        expected = get_mock_nutrition_by_filename(filename)["food_name"]
+        assert expected != "Phở Bò"
+        assert _analyze(client, make_jpeg(color, pattern=False), filename) == expected
+
+
+def test_recompressed_photo_reuses_the_cached_result(client):
+    original = make_jpeg()
+    buffer = io.BytesIO()
+    Image.open(io.BytesIO(original)).save(buffer, "JPEG", quality=40)
+    recompressed = buffer.getvalue()
+    assert recompressed != original
+
+    assert _analyze(client, original, "pho-bo.jpg") == "Phở Bò"
+    # Khác SHA256, khác tên file nhưng dHash gần như trùng → dùng lại kết quả
+    assert _analyze(client, recompressed, "com-tam.jpg") == "Phở Bò"
@@ -0,0 +1,96 @@
+"""Dựng prompt /chat theo ngân sách token: giữ history mới nhất, cắt message dài, nén lượt cũ thành summary"""
+import asyncio
+
+import pytest
+
+from prompt_builder import MESSAGE_OVERHEAD_TOKENS, SUMMARY_HEADER, PromptAssembler, TokenEstimator
+
+SYSTEM_PROMPT = "You are a nutrition assistant."
+
+
+def _history(count: int, chars: int = 40):
+    """Message ASCII: chars / 4 token mỗi message (chưa tính overhead)"""
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Turn {i:02d}. " + "x" * (chars - 10)}
+            for i in range(count)]
+
+
+def _assembler(**options) -> PromptAssembler:
+    return PromptAssembler(SYSTEM_PROMPT, TokenEstimator(), **options)
+
+
+def test_estimator_rates_and_calibration():
+    estimator = TokenEstimator()
+    assert estimator.count("x" * 40) == 10
+    assert estimator.count("ă" * 16) == 10
+    estimator.observe(10, 20)
+    assert estimator.count("x" * 40) == 20
+
+
+def test_short_history_is_kept_verbatim():
+    prompt = _assembler().assemble("Question?", _history(4))
+    assert (prompt.kept, prompt.compacted, prompt.summary) == (4, 0, "")
+    assert [m["role"] for m in prompt.messages] == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert prompt.text == f"{SYSTEM_PROMPT}\n\n{prompt.dialogue}"
+    assert prompt.dialogue.endswith("User: Question?\nAssistant:")
+
+
+def test_history_is_trimmed_to_budget_newest_first():
+    history = _history(10)
+    per_message = 10 + MESSAGE_OVERHEAD_TOKENS
+    prompt = _assembler(history_token_budget=4 * per_message + 5).assemble("Question?", history)
+
+    assert (prompt.kept, prompt.compacted) == (4, 6)
+    assert [m["content"] for m in prompt.messages[2:-1]] == [m["content"] for m in history[-4:]]
+    # Lượt cũ không mất hẳn mà nằm trong summary (system message thứ hai)
+    assert prompt.messages[1] == {"role": "system", "content": f"{SUMMARY_HEADER}\n{prompt.summary}"}
+    assert prompt.summary.splitlines()[0] == "- Người dùng: Turn 00."
+    assert len(prompt.summary.splitlines()) == 6
+
+
+@pytest.mark.parametrize("content", ["y" * 4000, "Phở bò tái nạm 123 " * 300])
+def test_long_message_is_clipped(content):
+    history = [{"role": "user", "content": content}]
+    prompt = _assembler(message_token_limit=50).assemble("Question?", history)
+    clipped = prompt.messages[1]["content"]
+    assert prompt.kept == 1
+    assert clipped.endswith("…")
+    assert TokenEstimator().count(clipped) <= 50
+
+
+def test_summary_budget_drops_oldest_lines():
+    history = _history(10)
+    prompt = _assembler(history_token_budget=0, summary_token_budget=30).assemble("Question?", history)
+    lines = prompt.summary.splitlines()
+    assert prompt.kept == 0
+    assert lines[-1] == "- Trợ lý: Turn 09."
+    assert sum(TokenEstimator().count(line) for line in lines) <= 30
+
+    no_summary = _assembler(history_token_budget=0, summary_token_budget=0).assemble("Question?", history)
+    assert no_summary.summary == "" and len(no_summary.messages) == 2
+
+
+def test_rolling_summary_is_reused_across_turns():
+    assembler = _assembler(history_token_budget=2 * (10 + MESSAGE_OVERHEAD_TOKENS))
+    history = _history(6)
+    first = assembler.assemble("Question?", history)
+    assert assembler.summary_hits == 0 and assembler.summary_misses == 1
+
+    assert assembler.assemble("Question?", history).summary == first.summary
+    assert assembler.summary_hits == 1
+
+    longer = assembler.assemble("Question?", _history(8))
+    assert longer.summary.startswith(first.summary)
+    assert assembler.get_stats()["summary_cache_entries"] == 2
+
+
+def test_assistant_sends_trimmed_history(make_assistant, providers):
+    per_message = 10 + MESSAGE_OVERHEAD_TOKENS
+    assistant = make_assistant(CHAT_HISTORY_TOKEN_BUDGET=3 * per_message, CHAT_SUMMARY_TOKEN_BUDGET=0)
+    providers.models = []
+
+    answer = asyncio.run(assistant.get_response("Question?", _history(12)))
+    assert answer == "OpenRouter trả lời"
+    messages = providers.openrouter_messages[0]
+    assert len(messages) == 1 + 3 + 1
+    assert messages[-1] == {"role": "user", "content": "Question?"}
+    assert messages[1]["content"].startswith("Turn 09.")
@@ -0,0 +1,81 @@
+"""Cache câu trả lời /chat: chỉ dùng lại câu trả lời cho câu hỏi cùng nghĩa"""
+import unicodedata
+
+import pytest
+
+from response_cache import ChatResponseCache, normalize_question
+
+
+@pytest.fixture
+def cache() -> ChatResponseCache:
+    cache = ChatResponseCache()
+    cache.set("Bò có béo không?", None, "Câu trả lời về thịt bò")
+    cache.set("Người tiểu đường nên ăn gì?", None, "Câu trả lời: nên ăn")
+    return cache
+
+
+def test_normalize_question_keeps_diacritics():
+    assert normalize_question("  Béo phì NÊN ăn gì?? ") == "béo phì nên ăn gì"
+    assert normalize_question(unicodedata.normalize("NFD", "Bơ")) == "bơ"
+
+
+@pytest.mark.parametrize("question", ["bò có béo không", "Bò có béo không ?", unicodedata.normalize("NFD", "Bò có béo không?")])
+def test_exact_hit_ignores_case_punctuation_and_unicode_form(cache, question):
+    assert cache.get(question) == "Câu trả lời về thịt bò"
+    assert cache.exact_hits == 1
+
+
+@pytest.mark.parametrize("question", ["Bơ có béo không?", "Bố có béo không", "Bo co beo khong"])
+def test_words_differing_only_in_diacritics_do_not_match(cache, question):
+    assert cache.get(question) is None
+
+
+@pytest.mark.parametrize("question", [
+    "Người tiểu đường không nên ăn gì?",
+    "Người tiểu đường nên tránh ăn gì?",
+    "Người tiểu đường chưa nên ăn gì?",
+    "Người tiểu đường nên hạn chế ăn gì?",
+])
+def test_negation_is_never_a_near_duplicate(cache, question):
+    assert cache.get(question) is None
+    assert cache.near_hits == 0
+
+
+def test_negated_question_is_cached_separately(cache):
+    cache.set("Người tiểu đường không nên ăn gì?", None, "Câu trả lời: không nên ăn")
+    assert cache.get("Người tiểu đường nên ăn gì?") == "Câu trả lời: nên ăn"
+    assert cache.get("người tiểu đường không nên ăn gì") == "Câu trả lời: không nên ăn"
+
+
+@pytest.mark.parametrize("question", ["Người bị tiểu đường nên ăn gì?", "Người tiểu đường nên ăn gì ạ?"])
+def test_near_duplicate_hit(cache, question):
+    assert cache.get(question) == "Câu trả lời: nên ăn"
+    assert cache.near_hits == 1
+
+
+def test_history_is_part_of_the_key():
+    cache = ChatResponseCache()
+    history = [{"role": "user", "content": "Tôi thích ăn bơ"}]
+    cache.set("Món đó có béo không?", history, "Bơ nhiều chất béo tốt")
+    assert cache.get("Món đó có béo không?", history) == "Bơ nhiều chất béo tốt"
+    assert cache.get("Món đó có béo không?", [{"role": "user", "content": "Tôi thích ăn bò"}]) is None
+    assert cache.get("Món đó có béo không?") is None
+
+
+def test_expired_entry_is_a_miss():
+    cache = ChatResponseCache(ttl_seconds=-1)
+    cache.set("Bò có béo không?", None, "cũ")
+    assert cache.get("Bò có béo không?") is None
+    assert cache.get_stats()["entries"] == 0
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("Người 80kg cần bao nhiêu protein mỗi ngày?", "Người 60kg cần bao nhiêu protein mỗi ngày?"),
+    ("Trẻ 3 tuổi nên uống bao nhiêu sữa?", "Trẻ 2 tuổi nên uống bao nhiêu sữa?"),
+    ("Người tiểu đường nên ăn gì vào bữa tối?", "Người tiểu đường nên ăn gì vào bữa sáng?"),
+])
+def test_questions_differing_in_facts_do_not_match(cached, asked):
+    cache = ChatResponseCache()
+    cache.set(cached, None, "Câu trả lời khác")
+    assert cache.get(asked) is None
+    assert cache.near_hits == 0
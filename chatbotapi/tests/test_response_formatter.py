@@ -0,0 +1,93 @@
+"""format_response / StreamFormatter: kết quả giống hệt _process_response/_prettify_text cũ (golden)"""
+import json
+import random
+
+import pytest
+
+from benchmarks.bench_response_formatter import legacy_process_response, make_json, make_text, stream_format
+from response_formatter import format_response
+
+ANSWERS = {
+    "plain": "Phở bò cung cấp khoảng 350 kcal mỗi tô vừa.",
+    "paragraphs": "Đoạn đầu tiên.\n\nĐoạn thứ hai   có  nhiều khoảng trắng.\n\n\nĐoạn ba.",
+    "markdown list": (
+        "**Với béo phì, bạn nên ưu tiên:**\n"
+        "✅ Nên ăn: Rau xanh, thịt nạc, cá\n"
+        "❌ Tránh: Cơm trắng, đồ chiên\n\n"
+        "Gợi ý bữa sáng: Yến mạch + sữa không đường\n"
+        "Gợi ý bữa trưa: Cơm gạo lứt + cá hấp\n\n"
+        "Ngoài ra hãy kết hợp tập luyện 30 phút/ngày nhé!"
+    ),
+    # Dòng trống không kết thúc khối liệt kê: đoạn văn sau đó vẫn thành item
+    "list then paragraph": "Nên ăn:\n- rau muống\n- cá hồi.\n\nUống đủ nước mỗi ngày.\nLưu ý:",
+    "header without items": "Lưu ý:\nHạn chế:\n* muối\n* đường",
+    "prefix header": "Bạn nên ăn nhiều rau\n+ rau cải\n+ bí đỏ",
+    "windows newlines": "Nên ăn:\r\n• gạo lứt\r\n• đậu phụ\r\rKết thúc",
+    "other line breaks": "Dòng một\u2028vẫn dòng một\x0bcòn nữa\nDòng hai\f",
+    "only markup": "** -- ✅",
+    "whitespace": "   \n\t ",
+    "empty": "",
+    "json": json.dumps({"title": "Chế độ ăn", "summary": "Ít đường", "bullets": ["Rau.", "", "Cá"],
+                        "meals": ["Sáng: phở", "Trưa: cơm"], "notes": "Tham khảo bác sĩ"}, ensure_ascii=False),
+    "json whitespace": '\n  {"title": "  Tiêu đề  "}  \n',
+    "json empty object": "{}",
+    "json wrong type": '{"title": 5, "summary": "Không dùng được"}',
+    "json list": '["Nên ăn:", "rau"]',
+    "json number": "42",
+    "invalid json": "{Nên ăn: rau, cá}",
+    "fenced json": '```json\n{"title": "Trong fence"}\n```',
+    "nbsp before json": '\u00a0{"title": "NBSP"}',
+}
+
+
+@pytest.mark.parametrize("name", ANSWERS)
+def test_matches_legacy(name):
+    text = ANSWERS[name]
+    assert format_response(text) == legacy_process_response(text)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("make", [make_text, make_json])
+def test_matches_legacy_on_generated_answers(make, seed):
+    text = make(4096, random.Random(seed))
+    assert format_response(text) == legacy_process_response(text)
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 3, 7, 40, 10 ** 6])
+@pytest.mark.parametrize("name", ANSWERS)
+def test_stream_deltas_join_to_formatted_answer(name, chunk_chars):
+    # Provider trả về text đã strip cho get_response → stream phải khớp format_response(text.strip())
+    text = ANSWERS[name]
+    assert stream_format(text, chunk_chars) == format_response(text.strip())
+
+
+def test_stream_emits_paragraphs_before_the_end():
+    from response_formatter import StreamFormatter
+
+    formatter = StreamFormatter()
+    assert formatter.feed("Đoạn **một**.\nĐoạn") == ["Đoạn một."]
+    assert formatter.feed(" hai.\nNên ăn:\n- rau\n") == [" Đoạn hai."]
+    # Khối liệt kê chỉ kết thúc ở header kế tiếp hoặc hết stream
+    assert formatter.feed("\n- cá\n") == []
+    assert formatter.close() == [" Nên ăn: rau, cá."]
+
+
+def test_stream_response_caches_the_same_answer(make_assistant, providers):
+    import asyncio
+
+    assistant = make_assistant()
+    answer = "Phở bò khoảng **350 kcal**.\n\nNên ăn kèm:\n- rau thơm\n- giá đỗ"
+
+    async def chunks(question, history):
+        for start in range(0, len(answer), 5):
+            yield answer[start:start + 5]
+
+    assistant._stream_provider_text = chunks
+
+    async def run():
+        return [delta async for delta in assistant.stream_response("Béo phì nên ăn gì?")]
+
+    deltas = asyncio.run(run())
+    assert len(deltas) > 1
+    assert "".join(deltas) == format_response(answer)
+    assert assistant.response_cache.get("Béo phì nên ăn gì?") == format_response(answer)
@@ -0,0 +1,220 @@
+"""Tracing: span lồng nhau qua contextvars, export OTLP/JSON theo batch, TracingMiddleware"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import tracing
+from conftest import make_jpeg
+from tracing import (
+    SPAN_KIND_SERVER, STATUS_ERROR, FileSpanExporter, Tracer, bind_context, parse_traceparent
+)
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.payloads = []
+        self.closed = False
+
+    def export(self, payload):
+        self.payloads.append(payload)
+
+    def close(self):
+        self.closed = True
+
+    @property
+    def spans(self):
+        return [
+            span
+            for payload in self.payloads
+            for resource_spans in payload["resourceSpans"]
+            for scope_spans in resource_spans["scopeSpans"]
+            for span in scope_spans["spans"]
+        ]
+
+
+def _attributes(span: dict) -> dict:
+    return {item["key"]: next(iter(item["value"].values())) for item in span["attributes"]}
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    """Tracer singleton export vào memory, không flush nền trong lúc test"""
+    exporter = MemoryExporter()
+    tracer = Tracer(exporter, flush_interval=3600)
+    monkeypatch.setattr(tracing, "_tracer_instance", tracer)
+    yield tracer
+    tracer.shutdown()
+
+
+def test_disabled_tracer_returns_noop_spans():
+    tracer = Tracer(None)
+    with tracer.start_span("work") as span:
+        span.set_attribute("ignored", 1)
+    assert span is tracing.NOOP_SPAN
+    assert tracer.start_server_span("GET /") is tracing.NOOP_SPAN
+    tracer.shutdown()
+
+
+def test_nested_spans_share_the_trace_and_link_parents(tracer):
+    with tracing.span("request", route="/chat") as root:
+        with tracing.span("cache.lookup") as child:
+            assert tracing.current_span() is child
+            child.set_attribute("hits", 3)
+        assert tracing.current_span() is root
+    assert tracing.current_span() is tracing.NOOP_SPAN
+
+    assert tracer.flush() == 2
+    child_data, root_data = tracer.exporter.spans
+    assert root_data["name"] == "request"
+    assert "parentSpanId" not in root_data
+    assert child_data["traceId"] == root_data["traceId"]
+    assert child_data["parentSpanId"] == root_data["spanId"]
+    # OTLP/JSON: int64 là string, thời gian là nano giây dạng string
+    assert {"key": "hits", "value": {"intValue": "3"}} in child_data["attributes"]
+    assert int(child_data["endTimeUnixNano"]) >= int(child_data["startTimeUnixNano"])
+    assert _attributes(tracer.exporter.payloads[0]["resourceSpans"][0]["resource"])["service.name"] == "chatbotapi"
+
+
+def test_exception_and_cancellation_are_recorded(tracer):
+    with pytest.raises(KeyError):
+        with tracing.span("lookup"):
+            raise KeyError("missing")
+
+    async def cancelled():
+        with tracing.span("hedge.loser"):
+            await asyncio.sleep(10)
+
+    async def scenario():
+        task = asyncio.ensure_future(cancelled())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    tracer.flush()
+    failed, loser = tracer.exporter.spans
+    assert failed["status"]["code"] == STATUS_ERROR
+    assert failed["events"][0]["name"] == "exception"
+    assert _attributes(failed["events"][0])["exception.type"] == "KeyError"
+    # Bị hủy (client ngắt kết nối / thua hedge) không phải lỗi
+    assert "status" not in loser
+    assert _attributes(loser)["cancelled"] is True
+
+
+def test_bind_context_carries_the_parent_span_to_thread_pool(tracer):
+    def work():
+        with tracing.span("db.query"):
+            return tracing.current_span().trace_id
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as executor, tracing.span("request") as root:
+            trace_id = await loop.run_in_executor(executor, bind_context(work))
+            unbound = await loop.run_in_executor(executor, work)
+        return root, trace_id, unbound
+
+    root, trace_id, unbound = asyncio.run(scenario())
+    assert trace_id == root.trace_id
+    assert unbound != root.trace_id
+    tracer.flush()
+    by_name = {}
+    for span in tracer.exporter.spans:
+        by_name.setdefault(span["name"], []).append(span)
+    bound_query = next(span for span in by_name["db.query"] if span["traceId"] == root.trace_id)
+    assert bound_query["parentSpanId"] == root.span_id
+
+
+def test_spans_are_exported_in_batches_and_flushed_on_shutdown():
+    exporter = MemoryExporter()
+    tracer = Tracer(exporter, batch_size=2, flush_interval=3600, max_queue_size=3)
+    for index in range(5):
+        tracer.start_span(f"span-{index}").end()
+    assert tracer.dropped == 2
+
+    tracer.shutdown()
+    assert exporter.closed
+    assert [len(payload["resourceSpans"][0]["scopeSpans"][0]["spans"]) for payload in exporter.payloads] == [2, 1]
+    assert tracer.get_stats()["exported"] == 3
+
+
+def test_sampled_out_trace_records_nothing():
+    exporter = MemoryExporter()
+    tracer = Tracer(exporter, sample_rate=0.0, flush_interval=3600)
+    with tracer.start_span("root") as root:
+        assert not root.recording
+        assert tracer.start_span("child") is tracing.NOOP_SPAN
+    tracer.shutdown()
+    assert exporter.payloads == []
+
+
+def test_parse_traceparent():
+    trace_id, parent_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+    assert parse_traceparent(f"00-{trace_id}-{parent_id}-01") == (trace_id, parent_id, True)
+    assert parse_traceparent(f"00-{trace_id.upper()}-{parent_id}-00") == (trace_id, parent_id, False)
+    for invalid in (None, "", "garbage", f"ff-{trace_id}-{parent_id}-01", f"00-{'0' * 32}-{parent_id}-01",
+                    f"00-{trace_id}-{'0' * 16}-01", f"00-{'z' * 32}-{parent_id}-01", f"00-{trace_id}-{parent_id}"):
+        assert parse_traceparent(invalid) is None
+
+
+def test_file_exporter_writes_one_otlp_json_line_per_batch(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = Tracer(FileSpanExporter(str(path)), batch_size=2, flush_interval=3600)
+    for index in range(3):
+        tracer.start_span(f"span-{index}").end()
+    tracer.shutdown()
+
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 2
+    names = [span["name"] for line in lines for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+    assert names == ["span-0", "span-1", "span-2"]
+
+
+def test_middleware_creates_server_span_with_request_id(client, tracer):
+    response = client.get("/health", headers={"X-Request-ID": "req-123"})
+    assert response.headers["x-request-id"] == "req-123"
+    generated = client.get("/no-such-page")
+    assert len(generated.headers["x-request-id"]) == 32
+    # /metrics không mở span nhưng vẫn có request ID
+    assert client.get("/metrics").headers["x-request-id"]
+
+    tracer.flush()
+    health, unmatched = tracer.exporter.spans
+    assert health["name"] == "GET /health"
+    assert health["kind"] == SPAN_KIND_SERVER
+    assert _attributes(health) == {
+        "http.request.method": "GET", "http.route": "/health", "url.path": "/health",
+        "request.id": "req-123", "http.response.status_code": "200"
+    }
+    assert unmatched["name"] == "GET unmatched"
+    assert _attributes(unmatched)["url.path"] == "/no-such-page"
+    assert _attributes(unmatched)["request.id"] == generated.headers["x-request-id"]
+
+
+def test_middleware_continues_upstream_trace_and_nests_stage_spans(client, tracer):
+    trace_id, parent_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+    response = client.post(
+        "/analyze-image", files={"file": ("pho-bo.jpg", make_jpeg(), "image/jpeg")},
+        headers={"traceparent": f"00-{trace_id}-{parent_id}-01"}
+    )
+    assert response.status_code == 200
+    # Upstream không sample → không ghi span nào
+    client.get("/health", headers={"traceparent": f"00-{trace_id}-{parent_id}-00"})
+
+    tracer.flush()
+    spans = tracer.exporter.spans
+    assert {span["traceId"] for span in spans} == {trace_id}
+    server = next(span for span in spans if span["name"] == "POST /analyze-image")
+    assert server["parentSpanId"] == parent_id
+    by_id = {span["spanId"]: span for span in spans}
+    stage_names = {"upload_spool", "image_cache_lookup", "preprocess", "perceptual_lookup", "image_cache_store"}
+    stages = [span for span in spans if span["name"] in stage_names]
+    assert {span["name"] for span in stages} == stage_names
+    for stage in stages:
+        # Mỗi bước là con (trực tiếp hoặc gián tiếp) của server span
+        ancestor = stage
+        while ancestor["spanId"] != server["spanId"]:
+            ancestor = by_id[ancestor["parentSpanId"]]
+        assert _attributes(stage)["request.id"] == response.headers["x-request-id"]
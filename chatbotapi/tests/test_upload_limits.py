@@ -0,0 +1,98 @@
+"""Giới hạn kích thước upload: 413 ngay từ Content-Length, khi đang nhận body, hoặc trước khi decode base64"""
+import asyncio
+import base64
+import hashlib
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from upload_handler import UploadSizeLimitMiddleware, UploadTooLargeError, spool_base64, spool_stream
+
+LIMIT = 1000
+
+
+@pytest.fixture
+def limited_client():
+    app = FastAPI()
+    app.add_middleware(UploadSizeLimitMiddleware, limits={"/upload": LIMIT})
+    app.state.calls = 0
+
+    @app.post("/upload")
+    async def upload(request: Request):
+        app.state.calls += 1
+        return {"size": len(await request.body())}
+
+    @app.post("/other")
+    async def other(request: Request):
+        return {"size": len(await request.body())}
+
+    with TestClient(app) as client:
+        yield client
+
+
+def _chunks(total: int, size: int = 100):
+    for _ in range(total // size):
+        yield b"x" * size
+
+
+def test_body_within_limit_passes(limited_client):
+    response = limited_client.post("/upload", content=b"x" * LIMIT)
+    assert response.status_code == 200
+    assert response.json() == {"size": LIMIT}
+
+
+def test_content_length_over_limit_is_rejected_before_the_handler(limited_client):
+    response = limited_client.post("/upload", content=b"x" * (LIMIT + 1))
+    assert response.status_code == 413
+    assert limited_client.app.state.calls == 0
+
+
+def test_chunked_body_over_limit_is_rejected_while_receiving(limited_client):
+    response = limited_client.post("/upload", content=_chunks(LIMIT * 3))
+    assert response.status_code == 413
+
+
+def test_unlimited_path_is_not_affected(limited_client):
+    assert limited_client.post("/other", content=b"x" * (LIMIT * 3)).status_code == 200
+
+
+def test_base64_over_limit_is_rejected_before_decoding():
+    data = base64.b64encode(b"x" * (LIMIT * 2)).decode("ascii")
+    with pytest.raises(UploadTooLargeError):
+        asyncio.run(spool_base64(data, max_bytes=LIMIT))
+
+
+def test_spool_stream_stops_at_the_limit():
+    async def stream():
+        for chunk in _chunks(LIMIT * 3):
+            yield chunk
+
+    with pytest.raises(UploadTooLargeError) as error:
+        asyncio.run(spool_stream(stream(), max_bytes=LIMIT))
+    assert error.value.status_code == 413
+
+
+def test_spooled_upload_hash_and_size():
+    async def stream():
+        for chunk in _chunks(LIMIT):
+            yield chunk
+
+    with asyncio.run(spool_stream(stream(), max_bytes=LIMIT)) as upload:
+        assert upload.size == LIMIT
+        assert upload.sha256 == hashlib.sha256(b"x" * LIMIT).hexdigest()
+        assert upload.read_bytes() == b"x" * LIMIT
+
+
+def test_analyze_nutrition_json_over_limit_returns_413(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "UPLOAD_BODY_LIMIT", LIMIT)
+    body = b'{"filename": "pho-bo.jpg", "image": "' + b"A" * (LIMIT * 2) + b'"}'
+    response = client.post("/analyze-nutrition", content=_chunks_of(body), headers={"content-type": "application/json"})
+    assert response.status_code == 413
+
+
+def _chunks_of(data: bytes, size: int = 256):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
@@ -0,0 +1,572 @@
+"""
+Tracing theo request (span tương thích OpenTelemetry, không cần opentelemetry-sdk)
+- Mỗi request HTTP có một request ID (header X-Request-ID của client hoặc tự sinh, trả lại
+  trong response) và một server span; nếu upstream gửi header W3C traceparent thì tiếp nối trace đó
+- Span con lồng nhau qua contextvars: tự đi theo asyncio task; việc chạy trên thread pool
+  dùng bind_context() để mang context (span cha + request ID) theo
+- Span đã kết thúc được gom theo batch, export trên thread nền theo định dạng OTLP/JSON:
+  file JSON lines (mỗi dòng một ExportTraceServiceRequest, đọc lại được bằng receiver otlpjson
+  của OpenTelemetry Collector) hoặc POST tới collector qua OTLP/HTTP (/v1/traces)
+- TRACING_EXPORTER=none (mặc định): span là no-op, chỉ còn request ID
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import httpx
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+REQUEST_ID_HEADER = "x-request-id"
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+_request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # OTLP/JSON: int64 encode dạng string
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class _NoopSpan:
+    """Span không ghi gì (tracing tắt hoặc trace không được sample)"""
+
+    __slots__ = ()
+
+    recording = False
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def add_event(self, name: str, **attributes):
+        pass
+
+    def set_status(self, code: int, message: str = ""):
+        pass
+
+    def record_exception(self, error: BaseException):
+        pass
+
+    def end(self, error: Optional[BaseException] = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _UnsampledSpan(_NoopSpan):
+    """Root của trace không được sample: vẫn là span hiện tại để span con cũng là no-op"""
+
+    __slots__ = ("_token",)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            pass
+        return False
+
+
+class Span:
+    """
+    Một span đang ghi. Dùng như context manager (trở thành span hiện tại, kết thúc khi thoát)
+    hoặc gọi end() thủ công (VD kết thúc trong done-callback của executor future)
+    """
+
+    __slots__ = ("tracer", "name", "kind", "trace_id", "span_id", "parent_id", "attributes", "events",
+                 "status", "status_message", "start_ns", "end_ns", "_started", "_token")
+
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str],
+                 kind: int, attributes: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.events = None
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        # Mốc wall-clock cho OTLP, thời lượng đo bằng perf_counter (không bị chỉnh giờ làm lệch)
+        self.start_ns = time.time_ns()
+        self._started = time.perf_counter_ns()
+        self.end_ns = None
+        self._token = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes):
+        if self.events is None:
+            self.events = []
+        self.events.append((time.time_ns(), name, attributes))
+
+    def set_status(self, code: int, message: str = ""):
+        self.status = code
+        self.status_message = message
+
+    def record_exception(self, error: BaseException):
+        self.status = STATUS_ERROR
+        self.status_message = str(error) or type(error).__name__
+        self.add_event("exception", **{
+            "exception.type": type(error).__name__,
+            "exception.message": str(error)
+        })
+
+    def end(self, error: Optional[BaseException] = None):
+        """Kết thúc span (gọi nhiều lần chỉ tính lần đầu)"""
+        if self.end_ns is not None:
+            return
+        if error is not None:
+            self.record_exception(error)
+        self.end_ns = self.start_ns + (time.perf_counter_ns() - self._started)
+        self.tracer._on_end(self)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Async generator bị đóng ở context khác
+            pass
+        if exc is None:
+            self.end()
+        elif isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+            # Client ngắt kết nối / thua hedge: không phải lỗi
+            self.attributes["cancelled"] = True
+            self.end()
+        else:
+            self.end(exc)
+        return False
+
+    def to_otlp(self) -> Dict:
+        data = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes)
+        }
+        if self.parent_id:
+            data["parentSpanId"] = self.parent_id
+        if self.events:
+            data["events"] = [
+                {"timeUnixNano": str(ts), "name": name, "attributes": _otlp_attributes(attributes)}
+                for ts, name, attributes in self.events
+            ]
+        if self.status != STATUS_UNSET:
+            data["status"] = {"code": self.status, "message": self.status_message}
+        return data
+
+
+def parse_traceparent(header: Optional[str]):
+    """
+    Header W3C traceparent "00-<trace_id>-<parent_id>-<flags>"
+
+    Returns:
+        (trace_id, parent_id, sampled) hoặc None nếu header không hợp lệ
+    """
+    if not header:
+        return None
+    parts = header.strip().lower().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    version, trace_id, parent_id, flags = parts[:4]
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    try:
+        int(trace_id, 16)
+        int(parent_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+    return trace_id, parent_id, sampled
+
+
+class FileSpanExporter:
+    """Ghi mỗi batch thành một dòng OTLP/JSON (append)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, payload: Dict):
+        self._file.write(json.dumps(payload, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class OTLPHttpSpanExporter:
+    """POST batch tới OpenTelemetry Collector (OTLP/HTTP, JSON encoding)"""
+
+    def __init__(self, endpoint: str, headers: Optional[Dict[str, str]] = None, timeout: float = 10.0):
+        endpoint = endpoint.rstrip("/")
+        self.url = endpoint if endpoint.endswith("/v1/traces") else endpoint + "/v1/traces"
+        self._client = httpx.Client(
+            timeout=timeout,
+            headers={"Content-Type": "application/json", **(headers or {})}
+        )
+
+    def export(self, payload: Dict):
+        response = self._client.post(self.url, content=json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        if response.status_code >= 300:
+            raise ValueError(f"Collector trả về {response.status_code}: {response.text[:200]}")
+
+    def close(self):
+        self._client.close()
+
+
+class Tracer:
+    """
+    Tạo span và export theo batch trên thread nền
+
+    Args:
+        exporter: FileSpanExporter / OTLPHttpSpanExporter (None = tắt tracing)
+        service_name: Resource attribute service.name
+        sample_rate: Tỉ lệ trace mới được ghi (trace tiếp nối từ upstream theo cờ sampled của upstream)
+        batch_size: Số span mỗi lần export; queue đủ batch thì export ngay không chờ flush_interval
+        flush_interval: Export định kỳ (giây)
+        max_queue_size: Queue đầy thì bỏ span mới (không block request)
+    """
+
+    def __init__(self, exporter=None, service_name: str = "chatbotapi", sample_rate: float = 1.0,
+                 batch_size: int = 256, flush_interval: float = 5.0, max_queue_size: int = 4096):
+        self.exporter = exporter
+        self.enabled = exporter is not None
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._resource = {"attributes": _otlp_attributes({
+            "service.name": service_name,
+            "telemetry.sdk.language": "python"
+        })}
+
+        self._queue: deque = deque()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+        self.export_errors = 0
+
+    def _sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def start_span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        """
+        Tạo span con của span hiện tại (hoặc root của trace mới).
+        Span không tự thành span hiện tại: dùng `with` hoặc gọi end()
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if parent is None:
+            if not self._sampled():
+                return _UnsampledSpan()
+            trace_id, parent_id = "%032x" % random.getrandbits(128), None
+        elif not parent.recording:
+            return NOOP_SPAN
+        else:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        request_id = _request_id.get()
+        if request_id is not None:
+            attributes["request.id"] = request_id
+        return Span(self, name, trace_id, parent_id, kind, attributes)
+
+    def start_server_span(self, name: str, traceparent: Optional[str] = None, **attributes):
+        """Root span của một request HTTP, tiếp nối trace của upstream nếu có traceparent hợp lệ"""
+        if not self.enabled:
+            return NOOP_SPAN
+        remote = parse_traceparent(traceparent)
+        if remote is None:
+            if not self._sampled():
+                return _UnsampledSpan()
+            trace_id, parent_id = "%032x" % random.getrandbits(128), None
+        else:
+            trace_id, parent_id, sampled = remote
+            if not sampled:
+                return _UnsampledSpan()
+        request_id = _request_id.get()
+        if request_id is not None:
+            attributes["request.id"] = request_id
+        return Span(self, name, trace_id, parent_id, SPAN_KIND_SERVER, attributes)
+
+    def _on_end(self, span: Span):
+        if len(self._queue) >= self.max_queue_size:
+            self.dropped += 1
+            return
+        self._queue.append(span)
+        if self._thread is None:
+            self._start_worker()
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start_worker(self):
+        with self._thread_lock:
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """Background thread: export khi đủ batch hoặc mỗi flush_interval"""
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            if self._stopping:
+                return
+
+    def _encode(self, spans: Sequence[Span]) -> Dict:
+        return {"resourceSpans": [{
+            "resource": self._resource,
+            "scopeSpans": [{
+                "scope": {"name": "chatbotapi.tracing"},
+                "spans": [span.to_otlp() for span in spans]
+            }]
+        }]}
+
+    def flush(self) -> int:
+        """Export mọi span đang chờ (chạy trên thread exporter hoặc lúc shutdown)"""
+        exported = 0
+        while self._queue:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.popleft())
+            except IndexError:
+                pass
+            try:
+                self.exporter.export(self._encode(batch))
+                exported += len(batch)
+            except Exception as e:
+                self.export_errors += 1
+                print(f"⚠️  Trace export failed ({len(batch)} spans dropped): {e}")
+        self.exported += exported
+        return exported
+
+    def shutdown(self):
+        """Export nốt span còn trong queue và đóng exporter"""
+        if not self.enabled:
+            return
+        with self._thread_lock:
+            self._stopping = True
+            thread = self._thread
+        if thread is not None:
+            self._wakeup.set()
+            thread.join(timeout=self.flush_interval + 10)
+        self.flush()
+        self.exporter.close()
+
+    def get_stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "queued": len(self._queue),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "export_errors": self.export_errors
+        }
+
+
+def _parse_headers(value: str) -> Dict[str, str]:
+    """OTEL_EXPORTER_OTLP_HEADERS: "key1=value1,key2=value2\""""
+    headers = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            key, val = pair.split("=", 1)
+            headers[key.strip()] = val.strip()
+    return headers
+
+
+def create_tracer() -> Tracer:
+    """Tạo Tracer với cấu hình từ biến môi trường"""
+    mode = os.getenv("TRACING_EXPORTER", "none").lower()
+    exporter = None
+    if mode == "file":
+        exporter = FileSpanExporter(os.getenv("TRACING_FILE", "traces.jsonl"))
+    elif mode == "otlp":
+        exporter = OTLPHttpSpanExporter(
+            os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"),
+            headers=_parse_headers(os.getenv("OTEL_EXPORTER_OTLP_HEADERS", "")),
+            timeout=float(os.getenv("OTEL_EXPORTER_OTLP_TIMEOUT", "10"))
+        )
+    elif mode not in ("none", "off", ""):
+        print(f"⚠️  Unknown TRACING_EXPORTER={mode!r}, tracing disabled")
+
+    tracer = Tracer(
+        exporter,
+        service_name=os.getenv("OTEL_SERVICE_NAME", "chatbotapi"),
+        sample_rate=float(os.getenv("TRACING_SAMPLE_RATE", "1.0")),
+        batch_size=int(os.getenv("TRACING_BATCH_SIZE", "256")),
+        flush_interval=float(os.getenv("TRACING_FLUSH_INTERVAL", "5")),
+        max_queue_size=int(os.getenv("TRACING_MAX_QUEUE", "4096"))
+    )
+    if tracer.enabled:
+        target = exporter.path if mode == "file" else exporter.url
+        print(f"✅ Tracing enabled ({mode} → {target}, sample rate {tracer.sample_rate})")
+    return tracer
+
+
+# Singleton instance
+_tracer_instance = None
+
+def get_tracer() -> Tracer:
+    """Get singleton tracer instance"""
+    global _tracer_instance
+    if _tracer_instance is None:
+        _tracer_instance = create_tracer()
+    return _tracer_instance
+
+def shutdown_tracer():
+    """Flush và đóng tracer (FastAPI shutdown)"""
+    global _tracer_instance
+    if _tracer_instance is not None:
+        _tracer_instance.shutdown()
+        _tracer_instance = None
+
+
+def span(name: str, **attributes):
+    """
+    Span con của span hiện tại, dùng như context manager
+
+        with span("image_cache.get", layer="l1") as s:
+            s.set_attribute("result", "hit")
+    """
+    return get_tracer().start_span(name, **attributes)
+
+
+def start_span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """Span kết thúc thủ công bằng end() (không thành span hiện tại)"""
+    return get_tracer().start_span(name, kind, **attributes)
+
+
+def current_span():
+    """Span hiện tại (NOOP_SPAN nếu không có), VD để thêm event vào span của bước đang chạy"""
+    return _current_span.get() or NOOP_SPAN
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def bind_context(func: Callable, *args) -> Callable:
+    """
+    Gói func để chạy trên thread pool với context hiện tại (span cha + request ID):
+
+        await loop.run_in_executor(executor, bind_context(func, arg))
+    """
+    return functools.partial(contextvars.copy_context().run, func, *args)
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware: gán request ID, mở server span cho mỗi request
+
+    - Request ID lấy từ header X-Request-ID (nếu client gửi, tối đa 128 ký tự) hoặc sinh mới,
+      luôn trả lại trong response header X-Request-ID
+    - Span name "<METHOD> <route>" với route là path đã đăng ký, path lạ → "unmatched"
+
+    Args:
+        route_paths: Hàm trả về tập path của các route (gọi ở request đầu tiên)
+    """
+
+    def __init__(self, app, route_paths: Callable[[], Iterable[str]], skip_paths: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.route_paths = route_paths
+        self.skip_paths = frozenset(skip_paths)
+        self._known_paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        traceparent = None
+        for key, value in scope.get("headers", ()):
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1").strip()[:128] or None
+            elif key == b"traceparent":
+                traceparent = value.decode("latin-1")
+        if request_id is None:
+            request_id = uuid.uuid4().hex
+        request_id_token = _request_id.set(request_id)
+        request_id_header = (REQUEST_ID_HEADER.encode(), request_id.encode("latin-1", "replace"))
+
+        path = scope.get("path", "")
+        method = scope.get("method", "")
+        if path in self.skip_paths:
+            server_span = NOOP_SPAN
+        else:
+            if self._known_paths is None:
+                self._known_paths = frozenset(self.route_paths())
+            route = path if path in self._known_paths else "unmatched"
+            server_span = get_tracer().start_server_span(
+                f"{method} {route}", traceparent,
+                **{"http.request.method": method, "http.route": route, "url.path": path}
+            )
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                server_span.set_attribute("http.response.status_code", message["status"])
+                if message["status"] >= 500:
+                    server_span.set_status(STATUS_ERROR)
+                message["headers"] = list(message.get("headers", ())) + [request_id_header]
+            await send(message)
+
+        try:
+            with server_span:
+                await self.app(scope, receive, send_with_request_id)
+        finally:
+            _request_id.reset(request_id_token)
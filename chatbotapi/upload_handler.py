@@ -0,0 +1,243 @@
+"""
+Xử lý upload ảnh với bộ nhớ giới hạn
+- Đọc upload theo chunk, vừa ghi vào SpooledTemporaryFile vừa tính SHA256 (không giữ nhiều bản copy)
+- Giới hạn kích thước (MAX_UPLOAD_BYTES) được kiểm tra ngay khi đọc, trước khi decode ảnh
+- Base64 được ước lượng kích thước trước khi decode, decode theo từng khối vào spool
+- UploadSizeLimitMiddleware từ chối body quá lớn ngay từ Content-Length / khi đang nhận body
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import tempfile
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+
+from metrics import stage_timer
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Ảnh nhỏ hơn ngưỡng này giữ trong memory, lớn hơn thì spool xuống disk
+SPOOL_MEMORY_BYTES = int(os.getenv("UPLOAD_SPOOL_MEMORY_BYTES", str(1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+# Số ký tự base64 mỗi lần decode (bội số của 4)
+BASE64_CHUNK_CHARS = CHUNK_SIZE // 3 * 4
+
+
+class UploadTooLargeError(HTTPException):
+    """Upload vượt MAX_UPLOAD_BYTES → 413"""
+
+    def __init__(self, max_bytes: int = MAX_UPLOAD_BYTES):
+        super().__init__(
+            status_code=413,
+            detail=f"Ảnh quá lớn (tối đa {max_bytes // (1024 * 1024)} MB)"
+        )
+
+
+class SpooledUpload:
+    """
+    Ảnh upload đã spool: file tạm + SHA256 + kích thước
+
+    Dùng như context manager để file tạm được đóng sau request
+    """
+
+    def __init__(self, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.max_bytes = max_bytes
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self.sha256: Optional[str] = None
+
+    def write(self, chunk: bytes):
+        """Ghi thêm một chunk, kiểm tra giới hạn trước khi ghi"""
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLargeError(self.max_bytes)
+        self._hasher.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self) -> "SpooledUpload":
+        """Kết thúc ghi: chốt hash và tua file về đầu"""
+        self.sha256 = self._hasher.hexdigest()
+        self.file.seek(0)
+        return self
+
+    def read_bytes(self) -> bytes:
+        """Đọc toàn bộ nội dung (chỉ dùng khi thực sự cần bytes, VD gửi lên Vision API)"""
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+        return data
+
+    def open_image(self):
+        """Mở ảnh bằng PIL trực tiếp từ file tạm (chỉ đọc header, lazy decode)"""
+        from PIL import Image
+        self.file.seek(0)
+        return Image.open(self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def spool_stream(chunks: AsyncIterator[bytes], max_bytes: int = MAX_UPLOAD_BYTES) -> SpooledUpload:
+    """Spool một luồng bytes bất kỳ (UploadFile, request.stream()...)"""
+    upload = SpooledUpload(max_bytes)
+    try:
+        async for chunk in chunks:
+            if chunk:
+                upload.write(chunk)
+    except BaseException:
+        upload.close()
+        raise
+    return upload.finish()
+
+
+async def _iter_upload_file(file: UploadFile) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def spool_upload_file(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> SpooledUpload:
+    """Spool UploadFile theo chunk thay vì await file.read() toàn bộ"""
+    with stage_timer("upload_spool"):
+        return await spool_stream(_iter_upload_file(file), max_bytes)
+
+
+def estimate_base64_size(data: str) -> int:
+    """Kích thước sau decode (ước lượng, không decode)"""
+    return len(data) * 3 // 4
+
+
+def _spool_base64_sync(data: str, max_bytes: int) -> SpooledUpload:
+    upload = SpooledUpload(max_bytes)
+    try:
+        # Bỏ prefix data URL nếu có: "data:image/jpeg;base64,...."
+        if data.startswith("data:"):
+            data = data.split(",", 1)[1]
+        # Base64 có xuống dòng (MIME) → bỏ whitespace để các khối decode thẳng hàng 4 ký tự
+        if "\n" in data or "\r" in data or " " in data:
+            data = "".join(data.split())
+        for start in range(0, len(data), BASE64_CHUNK_CHARS):
+            upload.write(base64.b64decode(data[start:start + BASE64_CHUNK_CHARS]))
+    except BaseException:
+        upload.close()
+        raise
+    return upload.finish()
+
+
+async def spool_base64(data: str, max_bytes: int = MAX_UPLOAD_BYTES) -> SpooledUpload:
+    """
+    Decode base64 theo từng khối vào spool (chạy trên thread pool)
+    Từ chối ngay nếu kích thước ước lượng vượt giới hạn, trước khi decode
+    """
+    if estimate_base64_size(data) > max_bytes + 3:
+        raise UploadTooLargeError(max_bytes)
+    loop = asyncio.get_running_loop()
+    with stage_timer("base64_decode"):
+        return await loop.run_in_executor(None, _spool_base64_sync, data, max_bytes)
+
+
+async def read_json_body(request, max_bytes: int) -> dict:
+    """Đọc JSON body theo stream, dừng ngay khi vượt max_bytes"""
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise UploadTooLargeError(max_upload_from_body_limit(max_bytes))
+    return json.loads(body)
+
+
+async def iter_ndjson(request, max_line_bytes: int) -> AsyncIterator[dict]:
+    """
+    Đọc body NDJSON theo stream, mỗi dòng một JSON object.
+    Chỉ giữ trong memory dòng đang đọc; dòng vượt max_line_bytes → 413
+    """
+    buffer = bytearray()
+    async for chunk in request.stream():
+        buffer.extend(chunk)
+        start = 0
+        while True:
+            newline = buffer.find(b"\n", start)
+            if newline < 0:
+                break
+            if newline - start > max_line_bytes:
+                raise UploadTooLargeError(max_upload_from_body_limit(max_line_bytes))
+            line = bytes(buffer[start:newline]).strip()
+            start = newline + 1
+            if line:
+                yield json.loads(line)
+        del buffer[:start]
+        if len(buffer) > max_line_bytes:
+            raise UploadTooLargeError(max_upload_from_body_limit(max_line_bytes))
+    line = bytes(buffer).strip()
+    if line:
+        yield json.loads(line)
+
+
+def body_limit_for_upload(max_bytes: int = MAX_UPLOAD_BYTES) -> int:
+    """Giới hạn body HTTP cho một ảnh: base64 phình ~4/3 + overhead JSON/multipart"""
+    return max_bytes * 4 // 3 + 64 * 1024
+
+
+def max_upload_from_body_limit(body_limit: int) -> int:
+    return (body_limit - 64 * 1024) * 3 // 4
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware: giới hạn kích thước body theo path
+    - Content-Length vượt giới hạn → 413 ngay, không đọc body
+    - Chunked body → đếm bytes khi nhận, vượt giới hạn → UploadTooLargeError (413)
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope.get("headers", []):
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                await self._reject(send, max_upload_from_body_limit(limit))
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise UploadTooLargeError(max_upload_from_body_limit(limit))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def _reject(self, send, max_bytes: int):
+        error = UploadTooLargeError(max_bytes)
+        body = json.dumps({"detail": error.detail}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": error.status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close")
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})